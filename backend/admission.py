@@ -0,0 +1,141 @@
+"""Admission control for CPU-bound endpoints.
+
+Requests wait in a bounded queue for one of `max_concurrent` slots. A client
+holding too many queued or running requests gets 429; a full queue, or a
+request that waited longer than `max_wait` seconds, gets 503. Both carry a
+Retry-After estimated from the queued cost and the observed seconds per unit
+of cost. With policy='sjf' the cheapest waiting request runs first.
+"""
+import heapq
+import itertools
+import math
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remi'))
+import metrics
+
+QUEUE_DEPTH = metrics.gauge('jammaster_admission_queue_depth', 'Requests waiting for a slot.')
+RUNNING = metrics.gauge('jammaster_admission_running', 'Requests holding a slot.')
+QUEUED_COST = metrics.gauge('jammaster_admission_queued_cost', 'Estimated cost of waiting requests.')
+REJECTIONS = metrics.counter('jammaster_admission_rejections_total', 'Requests turned away, by reason.')
+WAIT_SECONDS = metrics.histogram('jammaster_admission_wait_seconds', 'Time requests spent queued.')
+
+# cost units: one generated bar; every KB of prompt MIDI counts as about one bar
+PROMPT_BYTES_PER_UNIT = 1024
+# best-of-N candidates share each forward pass, so each extra one costs a fraction of a bar
+EXTRA_CANDIDATE_COST = 0.25
+
+def estimate_cost(prompt_bytes, n_target_bar, n_candidates=1):
+    bars = n_target_bar * (1 + EXTRA_CANDIDATE_COST * (n_candidates - 1))
+    return max(1.0, bars + prompt_bytes / float(PROMPT_BYTES_PER_UNIT))
+
+class Rejected(Exception):
+    def __init__(self, status, reason, retry_after):
+        super(Rejected, self).__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+class Ticket(object):
+    """An admitted request; leaving the with block frees its slot."""
+    def __init__(self, controller, client, cost):
+        self.controller = controller
+        self.client = client
+        self.cost = cost
+        self.started = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.controller._release(self)
+
+class AdmissionController(object):
+    def __init__(self, max_concurrent=1, max_queue=8, per_client=2, policy='fifo',
+                 max_wait=60.0, initial_seconds_per_cost=1.0):
+        if policy not in ('fifo', 'sjf'):
+            raise ValueError('unknown queue policy {!r}'.format(policy))
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.per_client = per_client
+        self.policy = policy
+        self.max_wait = max_wait
+        # moving average of observed service time per unit of cost
+        self.seconds_per_cost = initial_seconds_per_cost
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._order = itertools.count()
+        self._running = []
+        self._clients = {}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_concurrent=int(os.environ.get('JAMMASTER_MAX_CONCURRENT') or 1),
+            max_queue=int(os.environ.get('JAMMASTER_MAX_QUEUE') or 8),
+            per_client=int(os.environ.get('JAMMASTER_MAX_PER_CLIENT') or 2),
+            policy=os.environ.get('JAMMASTER_QUEUE_POLICY') or 'fifo',
+            max_wait=float(os.environ.get('JAMMASTER_MAX_QUEUE_WAIT') or 60))
+
+    def retry_after(self):
+        """Seconds until the current backlog should have drained, rounded up."""
+        backlog = sum(e[2].cost for e in self._waiting) + sum(t.cost for t in self._running)
+        return max(1, int(math.ceil(backlog * self.seconds_per_cost / self.max_concurrent)))
+
+    def admit(self, client, cost):
+        """Block until the request may run and return its Ticket, or raise Rejected."""
+        with self._cond:
+            if self._clients.get(client, 0) >= self.per_client:
+                REJECTIONS.inc(reason='per_client')
+                raise Rejected(429, 'too many requests from this client', self.retry_after())
+            if len(self._waiting) >= self.max_queue:
+                REJECTIONS.inc(reason='queue_full')
+                raise Rejected(503, 'server is saturated', self.retry_after())
+            ticket = Ticket(self, client, cost)
+            priority = cost if self.policy == 'sjf' else 0
+            entry = (priority, next(self._order), ticket)
+            heapq.heappush(self._waiting, entry)
+            self._clients[client] = self._clients.get(client, 0) + 1
+            self._update_gauges()
+            st = time.time()
+            while not (len(self._running) < self.max_concurrent and self._waiting[0] is entry):
+                remaining = self.max_wait - (time.time() - st)
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self._drop_client(client)
+                    self._update_gauges()
+                    self._cond.notify_all()
+                    REJECTIONS.inc(reason='wait_timeout')
+                    raise Rejected(503, 'timed out waiting for a slot', self.retry_after())
+                self._cond.wait(remaining)
+            heapq.heappop(self._waiting)
+            self._running.append(ticket)
+            self._update_gauges()
+            # the next waiter may fit in another free slot
+            self._cond.notify_all()
+        WAIT_SECONDS.observe(time.time() - st)
+        ticket.started = time.time()
+        return ticket
+
+    def _release(self, ticket):
+        elapsed = time.time() - ticket.started
+        with self._cond:
+            self._running.remove(ticket)
+            self._drop_client(ticket.client)
+            self.seconds_per_cost = 0.8 * self.seconds_per_cost + 0.2 * elapsed / ticket.cost
+            self._update_gauges()
+            self._cond.notify_all()
+
+    def _drop_client(self, client):
+        self._clients[client] -= 1
+        if not self._clients[client]:
+            del self._clients[client]
+
+    def _update_gauges(self):
+        QUEUE_DEPTH.set(len(self._waiting))
+        RUNNING.set(len(self._running))
+        QUEUED_COST.set(sum(e[2].cost for e in self._waiting))
@@ -0,0 +1,46 @@
+"""Request helpers shared by the converter and generation blueprints."""
+import os
+import tempfile
+
+from flask import request
+
+from artifacts import ArtifactStore
+
+def get_temp_dir():
+    """Get the appropriate temp directory for the current OS"""
+    return os.path.join(tempfile.gettempdir(), 'jamtemp')
+
+def parse_bool(value):
+    """Accept JSON booleans as well as form strings like true/false or 1/0"""
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('0', 'false', 'no', 'off', ''):
+        return False
+    raise ValueError(f"invalid boolean: {value}")
+
+def parse_optional_int(value):
+    """None or an empty string means the parameter was not given"""
+    if value is None or str(value).strip() == '':
+        return None
+    return int(value)
+
+def parse_optional_float(value):
+    if value is None or str(value).strip() == '':
+        return None
+    return float(value)
+
+def client_id():
+    """First hop of X-Forwarded-For when behind a proxy, else the peer address"""
+    forwarded = request.headers.get('X-Forwarded-For', '')
+    return forwarded.split(',')[0].strip() or request.remote_addr
+
+# Create temp directory if it doesn't exist
+os.makedirs(get_temp_dir(), exist_ok=True)
+
+# uploads and sanitized files; converter and generation workers must share
+# JAMMASTER_ARTIFACT_DIR when they run as separate services
+ARTIFACTS = ArtifactStore.from_env(os.path.join(get_temp_dir(), 'artifacts')).start_janitor(
+    float(os.environ.get('JAMMASTER_ARTIFACT_SWEEP_SECONDS') or 60))
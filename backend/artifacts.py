@@ -0,0 +1,167 @@
+"""Content-addressed store for uploaded and sanitized MIDI files.
+
+A file is stored once under the sha256 of its bytes, which is also the
+opaque id handed to clients, so re-uploading the same MIDI returns the same
+id. Every put or lookup refreshes the file's mtime, which serves as its last
+use time: files unused for `ttl` seconds expire, and while the store holds
+more than `max_bytes` the least recently used files are removed. sweep()
+applies both rules; start_janitor() runs it periodically in a daemon thread.
+Processes that share the directory share the store.
+"""
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remi'))
+import metrics
+
+ARTIFACTS = metrics.gauge('jammaster_artifacts', 'Files held in the artifact store.')
+ARTIFACT_BYTES = metrics.gauge('jammaster_artifact_bytes', 'Bytes held in the artifact store.')
+ARTIFACT_REMOVALS = metrics.counter('jammaster_artifact_removals_total', 'Artifacts removed, by reason.')
+
+ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+SUFFIX = '.mid'
+
+class ArtifactStore(object):
+    def __init__(self, directory, ttl=3600.0, max_bytes=256 << 20):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._janitor = None
+        # approximate between sweeps; a put that crosses max_bytes triggers one
+        self._bytes = sum(size for _, size, _ in self._scan())
+
+    @classmethod
+    def from_env(cls, default_directory):
+        return cls(
+            os.environ.get('JAMMASTER_ARTIFACT_DIR') or default_directory,
+            ttl=float(os.environ.get('JAMMASTER_ARTIFACT_TTL') or 3600),
+            max_bytes=int(os.environ.get('JAMMASTER_ARTIFACT_MAX_BYTES') or 256 << 20))
+
+    def _path(self, artifact_id):
+        return os.path.join(self.directory, artifact_id + SUFFIX)
+
+    def put(self, data):
+        """Store bytes and return their id; known content is only touched."""
+        artifact_id = hashlib.sha256(data).hexdigest()
+        path = self._path(artifact_id)
+        if self._touch(path):
+            return artifact_id
+        # write next to the target and rename, so readers never see a partial file
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+        with self._lock:
+            self._bytes += len(data)
+            over = self._bytes > self.max_bytes
+        if over:
+            self.sweep(keep=artifact_id)
+        return artifact_id
+
+    def put_file(self, path):
+        with open(path, 'rb') as f:
+            return self.put(f.read())
+
+    def path(self, artifact_id):
+        """Filesystem path of an artifact (for this process only), or None if
+        the id is malformed, unknown or expired."""
+        if not isinstance(artifact_id, str) or not ID_PATTERN.match(artifact_id):
+            return None
+        path = self._path(artifact_id)
+        return path if self._touch(path) else None
+
+    def get(self, artifact_id):
+        path = self.path(artifact_id)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            # evicted between the lookup and the read
+            return None
+
+    def delete(self, artifact_id):
+        path = self.path(artifact_id)
+        if path is not None:
+            self._remove(path, 'deleted')
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _scan(self):
+        """(path, size, last use) of every artifact, oldest first."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(SUFFIX) and ID_PATTERN.match(entry.name[:-len(SUFFIX)]):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+            elif entry.name.endswith('.tmp'):
+                # left behind by a writer that died before its rename
+                try:
+                    if time.time() - entry.stat().st_mtime > self.ttl:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+        entries.sort(key=lambda e: e[2])
+        return entries
+
+    def _remove(self, path, reason):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return
+        ARTIFACT_REMOVALS.inc(reason=reason)
+
+    def sweep(self, keep=None):
+        """Remove expired artifacts, then the least recently used ones until
+        the store fits in max_bytes. Returns the number removed."""
+        with metrics.span('artifact_sweep'):
+            now = time.time()
+            entries = self._scan()
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for path, size, last_used in entries:
+                if keep is not None and path == self._path(keep):
+                    continue
+                if now - last_used > self.ttl:
+                    reason = 'expired'
+                elif total > self.max_bytes:
+                    reason = 'evicted'
+                else:
+                    continue
+                self._remove(path, reason)
+                total -= size
+                removed += 1
+            with self._lock:
+                self._bytes = total
+            ARTIFACTS.set(len(entries) - removed)
+            ARTIFACT_BYTES.set(total)
+        return removed
+
+    def start_janitor(self, interval=60.0):
+        """Sweep every `interval` seconds in a daemon thread."""
+        if self._janitor is None:
+            def run():
+                while True:
+                    time.sleep(interval)
+                    try:
+                        self.sweep()
+                    except OSError as e:
+                        print('Artifact sweep failed: {}'.format(e))
+            self._janitor = threading.Thread(target=run, name='artifact-janitor', daemon=True)
+            self._janitor.start()
+        return self
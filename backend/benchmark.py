@@ -0,0 +1,300 @@
+"""Reproducible latency/throughput benchmark for the backend entry points.
+
+Run from the backend directory:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --output bench-new.json --baseline bench.json
+    python benchmark.py --soak 300     # model lifecycle leak check, exits 1 on growth
+    python benchmark.py --soak 20 --soak-max-rss-growth-mb 16   # quick check
+
+Every case reports p50/p95 latency, peak RSS and Python allocations (from one
+extra, untimed run under tracemalloc); generation cases also report tokens/sec.
+The JSON file is keyed by case name so two runs can be diffed directly.
+"""
+from glob import glob
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import tensorflow as tf
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+os.chdir(BACKEND_DIR)
+sys.path.insert(0, BACKEND_DIR)
+
+from remi.model import PopMusicTransformer, utils
+from converter.converter import process_midi_file
+
+DEFAULT_CHECKPOINT = './remi/REMI-tempo-chord-checkpoint'
+
+########################################
+# measurement helpers
+########################################
+def reset_peak_rss():
+    # Linux only: writing 5 resets VmHWM so the peak can be measured per case
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def peak_rss_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def current_rss_bytes():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def measure(fn, repeat, seed):
+    """Time `repeat` calls of fn(); fn may return a token count for tokens/sec."""
+    reset_peak_rss()
+    latencies = []
+    tokens = 0
+    for i in range(repeat):
+        np.random.seed(seed + i)
+        st = time.perf_counter()
+        n = fn()
+        latencies.append(time.perf_counter() - st)
+        if n is not None:
+            tokens += n
+    result = {
+        'repeat': repeat,
+        'p50_s': float(np.percentile(latencies, 50)),
+        'p95_s': float(np.percentile(latencies, 95)),
+        'mean_s': float(np.mean(latencies)),
+        'peak_rss_bytes': peak_rss_bytes()}
+    if tokens:
+        result['tokens'] = tokens
+        result['tokens_per_s'] = tokens / sum(latencies)
+    # allocation profile from one separate run so tracing does not skew timings
+    np.random.seed(seed)
+    tracemalloc.start()
+    blocks_before = sys.getallocatedblocks()
+    fn()
+    blocks_after = sys.getallocatedblocks()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result['alloc_peak_bytes'] = peak
+    result['alloc_blocks_delta'] = blocks_after - blocks_before
+    return result
+
+########################################
+# cases
+########################################
+def bench_model(args, results):
+    def load():
+        PopMusicTransformer(checkpoint=args.checkpoint, is_training=False).close()
+    results['model_init'] = measure(load, args.repeat_init, args.seed)
+
+    model = PopMusicTransformer(checkpoint=args.checkpoint, is_training=False)
+    data_files = sorted(glob('./remi/data/evaluation/*.midi'))[:args.n_files]
+    classical_files = sorted(glob('./remi/classical-data/*.mid'))[:args.n_files]
+    for name, files in [('data', data_files), ('classical', classical_files)]:
+        def extract(files=files):
+            return sum(len(model.extract_events(path)) for path in files)
+        results['extract_events/{}'.format(name)] = measure(extract, args.repeat, args.seed)
+
+    prompt = data_files[0] if data_files else None
+    out_dir = tempfile.mkdtemp(prefix='jam-bench-')
+    output_path = os.path.join(out_dir, 'out.midi')
+    last_words = None
+    for n_target_bar in args.n_target_bar:
+        for topk in args.topk:
+            for mode, prompt_path in [('scratch', None), ('prompt', prompt)]:
+                if mode == 'prompt' and prompt_path is None:
+                    continue
+                generated = []
+                def gen(prompt_path=prompt_path, n_target_bar=n_target_bar, topk=topk):
+                    words, _ = model.generate(
+                        n_target_bar=n_target_bar,
+                        temperature=args.temperature,
+                        topk=topk,
+                        output_path=output_path,
+                        prompt=prompt_path)
+                    generated.append(words)
+                    return len(words)
+                key = 'generate/{}/bars={}/topk={}'.format(mode, n_target_bar, topk)
+                results[key] = measure(gen, args.repeat, args.seed)
+                last_words = generated[-1]
+
+    if last_words is not None:
+        def write():
+            utils.write_midi(
+                words=last_words,
+                vocab=model.vocab,
+                output_path=output_path,
+                prompt_path=None)
+        results['write_midi'] = measure(write, args.repeat, args.seed)
+    model.close()
+
+def bench_converter(args, results):
+    files = sorted(glob('./remi/classical-data/*.mid'))[:args.n_files]
+    out_path = os.path.join(tempfile.mkdtemp(prefix='jam-bench-'), 'sanitized.mid')
+    devnull = open(os.devnull, 'w')
+    def sanitize():
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            for path in files:
+                process_midi_file(path, out_path)
+        finally:
+            sys.stdout = stdout
+    results['converter/process_midi_file'] = measure(sanitize, args.repeat, args.seed)
+
+def bench_api(args, results):
+    import app as backend_app
+    client = backend_app.app.test_client()
+    prompt = sorted(glob('./remi/data/evaluation/*.midi'))[0]
+    with open(prompt, 'rb') as f:
+        prompt_bytes = f.read()
+
+    def upload():
+        return client.post('/upload_midi', data={'file': (io.BytesIO(prompt_bytes), 'prompt.mid')},
+                           content_type='multipart/form-data').get_json()['id']
+
+    results['api/hello'] = measure(lambda: client.get('/hello'), args.repeat, args.seed)
+    results['api/upload_midi'] = measure(upload, args.repeat, args.seed)
+    def sanitize():
+        client.post('/sanitize_audio', json={'id': upload()})
+    results['api/sanitize_audio'] = measure(sanitize, args.repeat, args.seed)
+    # the checkpoint is provisioned and warmed in the background
+    while client.get('/ready').status_code != 200:
+        time.sleep(0.5)
+    def generate():
+        response = client.post('/generate', json={
+            'id': upload(),
+            'n_target_bar': args.n_target_bar[0],
+            'temperature': args.temperature,
+            'topk': args.topk[0]})
+        assert response.status_code == 200, response.get_data(as_text=True)
+    results['api/generate'] = measure(generate, args.repeat, args.seed)
+
+def soak(args):
+    """Construct and close models repeatedly; fail if RSS or load time keeps growing."""
+    rss, load_times = [], []
+    for i in range(args.soak):
+        st = time.perf_counter()
+        with PopMusicTransformer(checkpoint=args.checkpoint, is_training=False):
+            pass
+        load_times.append(time.perf_counter() - st)
+        gc.collect()
+        rss.append(current_rss_bytes())
+        if (i + 1) % 10 == 0:
+            print('soak {}/{}: rss={:.1f} MB load={:.2f}s'.format(i + 1, args.soak, rss[-1] / 2**20, load_times[-1]))
+    # the first loads grow the allocator pools; compare the start of the settled
+    # run with its end, so a short soak is as reliable as a long one
+    warmup = min(args.soak_warmup, args.soak // 2)
+    rss, load_times = rss[warmup:], load_times[warmup:]
+    window = max(1, len(rss) // 5)
+    rss_start, rss_end = np.median(rss[:window]), np.median(rss[-window:])
+    load_ratio = np.median(load_times[-window:]) / np.median(load_times[:window])
+    failures = []
+    if rss_end - rss_start > args.soak_max_rss_growth_mb * 2**20:
+        failures.append('RSS grew {:.1f} MB (max {} MB)'.format((rss_end - rss_start) / 2**20, args.soak_max_rss_growth_mb))
+    if load_ratio > args.soak_max_load_ratio:
+        failures.append('load time grew {:.2f}x (max {}x)'.format(load_ratio, args.soak_max_load_ratio))
+    report = {
+        'iterations': args.soak,
+        'warmup': warmup,
+        'rss_start_bytes': int(rss_start),
+        'rss_end_bytes': int(rss_end),
+        'rss_growth_bytes': int(rss_end - rss_start),
+        'load_time_ratio': float(load_ratio),
+        'failures': failures,
+        'passed': not failures}
+    print(json.dumps(report, indent=2))
+    for failure in failures:
+        print('soak failed: {}'.format(failure), file=sys.stderr)
+    return report
+
+########################################
+# report
+########################################
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR).decode().strip()
+    except Exception:
+        return None
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    print('{:<45} {:>10} {:>10} {:>8}'.format('case', 'base p50', 'new p50', 'change'))
+    for key, r in sorted(results.items()):
+        if key not in baseline:
+            continue
+        old, new = baseline[key]['p50_s'], r['p50_s']
+        print('{:<45} {:>10.4f} {:>10.4f} {:>7.1f}%'.format(key, old, new, 100.0 * (new - old) / old if old else 0.0))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark JamMaster backend entry points.')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT)
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--baseline', default=None, help='previous JSON output to compare against')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--repeat-init', type=int, default=3)
+    parser.add_argument('--n-files', type=int, default=5)
+    parser.add_argument('--n-target-bar', type=int, nargs='+', default=[4, 16])
+    parser.add_argument('--topk', type=int, nargs='+', default=[1, 5])
+    parser.add_argument('--temperature', type=float, default=1.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip', nargs='*', default=[], choices=['model', 'converter', 'api'])
+    parser.add_argument('--soak', type=int, default=0,
+                        help='only run the model lifecycle soak test with this many iterations')
+    parser.add_argument('--soak-max-rss-growth-mb', type=float, default=64.0)
+    parser.add_argument('--soak-max-load-ratio', type=float, default=1.5)
+    parser.add_argument('--soak-warmup', type=int, default=3,
+                        help='soak iterations left out of the comparison')
+    args = parser.parse_args()
+
+    if args.soak:
+        sys.exit(0 if soak(args)['passed'] else 1)
+
+    results = {}
+    if 'model' not in args.skip:
+        bench_model(args, results)
+    if 'converter' not in args.skip:
+        bench_converter(args, results)
+    if 'api' not in args.skip:
+        bench_api(args, results)
+
+    report = {
+        'meta': {
+            'git_revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'tensorflow': tf.__version__,
+            'cpu_count': os.cpu_count(),
+            'args': vars(args)},
+        'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Wrote {} cases to {}'.format(len(results), args.output))
+    if args.baseline:
+        compare(results, args.baseline)
+
+if __name__ == '__main__':
+    main()
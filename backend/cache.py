@@ -0,0 +1,385 @@
+"""Caches shared by the generation endpoints, over a pluggable byte store.
+
+A backend maps string keys to bytes with get(key) / set(key, value):
+
+- MemoryBackend: an LRU in this process, bounded by total bytes;
+- DiskBackend: one file per key in a directory (a volume shared by the
+  replicas of a host), least recently used files removed over max_bytes;
+- RedisBackend: any server speaking the Redis protocol, shared by all
+  replicas; bound it server-side (maxmemory with an LRU policy) or with a ttl.
+
+backend_from_url() picks one from a memory://, file:///dir or
+redis://host:port/db URL. Values are numpy arrays plus JSON metadata packed
+by pack(): integer arrays are stored in the narrowest dtype that holds their
+values, so token ids take two bytes each. On top of a backend, ArrayCache
+serves the prompt token and prompt memory caches of PopMusicTransformer and
+ResultCache the seeded /generate results. Backend errors are logged and
+treated as misses, so an unreachable cache only costs recomputation.
+"""
+import hashlib
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remi'))
+import metrics
+
+CACHE_ENTRIES = metrics.gauge('jammaster_cache_entries', 'Entries held by a local cache backend.')
+CACHE_BYTES = metrics.gauge('jammaster_cache_bytes', 'Bytes held by a local cache backend.')
+CACHE_LOOKUPS = metrics.counter('jammaster_cache_lookups_total', 'Cache lookups, by cache and outcome.')
+CACHE_ERRORS = metrics.counter('jammaster_cache_errors_total', 'Cache backend operations that failed.')
+
+########################################
+# serialization
+########################################
+MAGIC = b'JMC1'
+
+def _narrow(array):
+    """The smallest integer dtype that holds every value of an integer array."""
+    if array.dtype.kind not in 'iu' or array.size == 0:
+        return array
+    dtype = np.result_type(np.min_scalar_type(array.min()), np.min_scalar_type(array.max()))
+    return array.astype(dtype) if dtype.itemsize < array.dtype.itemsize else array
+
+def pack(arrays, meta=None):
+    """Serialize a dict of numpy arrays and JSON-able metadata to bytes."""
+    header = {'meta': meta, 'arrays': []}
+    buffers = []
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        stored = np.ascontiguousarray(_narrow(array))
+        header['arrays'].append([name, stored.dtype.str, array.dtype.str, list(array.shape)])
+        buffers.append(stored.tobytes())
+    # numpy scalars in the metadata are written as plain numbers
+    encoded = json.dumps(header, separators=(',', ':'), default=lambda o: o.item()).encode('utf-8')
+    return b''.join([MAGIC, struct.pack('<I', len(encoded)), encoded] + buffers)
+
+def unpack(data):
+    """(arrays, meta) of pack() output, with every array in its original dtype."""
+    if data[:4] != MAGIC:
+        raise ValueError('not a packed cache value')
+    (length,) = struct.unpack('<I', data[4:8])
+    header = json.loads(data[8:8 + length].decode('utf-8'))
+    offset = 8 + length
+    arrays = {}
+    for name, stored, dtype, shape in header['arrays']:
+        stored = np.dtype(stored)
+        count = int(np.prod(shape, dtype=np.int64))
+        array = np.frombuffer(data, dtype=stored, count=count, offset=offset).reshape(shape)
+        arrays[name] = array.astype(dtype) if stored != np.dtype(dtype) else array.copy()
+        offset += count * stored.itemsize
+    return arrays, header['meta']
+
+def digest(*parts):
+    """Hex sha256 over bytes or str parts, for building cache keys."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+########################################
+# backends
+########################################
+class MemoryBackend(object):
+    name = 'memory'
+
+    def __init__(self, max_bytes=256 << 20):
+        self.max_bytes = max_bytes
+        self._values = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._values.get(key)
+            if value is not None:
+                self._values.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._values.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._values[key] = value
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._values.popitem(last=False)
+                self._bytes -= len(evicted)
+            CACHE_ENTRIES.set(len(self._values), backend=self.name)
+            CACHE_BYTES.set(self._bytes, backend=self.name)
+
+    def delete(self, key):
+        with self._lock:
+            old = self._values.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+
+class DiskBackend(object):
+    """Files named by the hash of their key; mtime is the last use time."""
+    name = 'disk'
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._bytes = sum(size for _, size in self._scan())
+
+    def _path(self, key):
+        return os.path.join(self.directory, digest(key) + '.bin')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as f:
+            f.write(value)
+        path = self._path(key)
+        with self._lock:
+            try:
+                old_size = os.stat(path).st_size
+            except FileNotFoundError:
+                old_size = 0
+            os.replace(f.name, path)
+            self._bytes += len(value) - old_size
+            if self._bytes > self.max_bytes:
+                self._trim()
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _scan(self):
+        """(path, size) of every entry, least recently used first."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.bin'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        entries.sort()
+        return [(path, size) for _, path, size in entries]
+
+    def _trim(self):
+        # other processes may share the directory, so recount from the files
+        entries = self._scan()
+        total = sum(size for _, size in entries)
+        removed = 0
+        for path, size in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self._bytes = total
+        CACHE_ENTRIES.set(len(entries) - removed, backend=self.name)
+        CACHE_BYTES.set(total, backend=self.name)
+
+class RedisError(Exception):
+    pass
+
+class RedisBackend(object):
+    """A minimal client of the Redis protocol (RESP2): GET, SET, DEL.
+
+    One connection, used under a lock and reopened after a failure.
+    """
+    name = 'redis'
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None, ttl=None, timeout=2.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.ttl = ttl
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile('rb')
+        if self.password:
+            self._call('AUTH', self.password)
+        if self.db:
+            self._call('SELECT', self.db)
+
+    def _call(self, *args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self._sock.sendall(b''.join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('connection closed by the cache server')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        if kind == b'-':
+            raise RedisError(rest.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError('connection closed by the cache server')
+            return data[:-2]
+        if kind == b'*':
+            length = int(rest)
+            return None if length < 0 else [self._read_reply() for _ in range(length)]
+        raise RedisError('unexpected reply {!r}'.format(line))
+
+    def command(self, *args):
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._connect()
+                return self._call(*args)
+            except (OSError, ConnectionError):
+                self.close()
+                raise
+
+    def get(self, key):
+        return self.command('GET', key)
+
+    def set(self, key, value):
+        if self.ttl:
+            self.command('SET', key, value, 'EX', int(self.ttl))
+        else:
+            self.command('SET', key, value)
+
+    def delete(self, key):
+        self.command('DEL', key)
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._reader = None
+
+def backend_from_url(url, max_bytes=256 << 20):
+    """memory://, file:///path/to/dir or redis://[:password@]host[:port][/db][?ttl=seconds]"""
+    parsed = urlparse(url or 'memory://')
+    if parsed.scheme == 'memory':
+        return MemoryBackend(max_bytes)
+    if parsed.scheme == 'file':
+        return DiskBackend(parsed.path, max_bytes)
+    if parsed.scheme == 'redis':
+        ttl = parse_qs(parsed.query).get('ttl', [None])[0]
+        return RedisBackend(parsed.hostname or '127.0.0.1', parsed.port or 6379,
+                            db=int(parsed.path.strip('/') or 0), password=parsed.password,
+                            ttl=float(ttl) if ttl else None)
+    raise ValueError('unsupported cache url {!r}'.format(url))
+
+def backend_from_env():
+    return backend_from_url(
+        os.environ.get('JAMMASTER_CACHE_URL'),
+        max_bytes=int(os.environ.get('JAMMASTER_CACHE_MAX_BYTES') or 256 << 20))
+
+########################################
+# caches
+########################################
+class ArrayCache(object):
+    """Dicts of numpy arrays under a key prefix; what the model's caches use."""
+    def __init__(self, backend, namespace):
+        self.backend = backend
+        self.namespace = namespace
+
+    def _lookup(self, key):
+        try:
+            data = self.backend.get('{}:{}'.format(self.namespace, key))
+        except (OSError, ConnectionError, RedisError) as e:
+            CACHE_ERRORS.inc(backend=self.backend.name)
+            print('Cache get failed ({}): {}'.format(self.backend.name, e))
+            data = None
+        CACHE_LOOKUPS.inc(cache=self.namespace, outcome='hit' if data is not None else 'miss')
+        return None if data is None else unpack(data)
+
+    def _store(self, key, arrays, meta=None):
+        try:
+            self.backend.set('{}:{}'.format(self.namespace, key), pack(arrays, meta))
+        except (OSError, ConnectionError, RedisError) as e:
+            CACHE_ERRORS.inc(backend=self.backend.name)
+            print('Cache set failed ({}): {}'.format(self.backend.name, e))
+
+    def get(self, key):
+        """The arrays stored under key, or None."""
+        hit = self._lookup(key)
+        return None if hit is None else hit[0]
+
+    def put(self, key, arrays):
+        self._store(key, arrays)
+
+# parameters that only bound how long a run may take
+UNKEYED_PARAMS = ('timeout',)
+
+def result_key(prompt_bytes, checkpoint, backend, params):
+    """Cache key of a seeded request, or None if the request is not seeded.
+    The inference backend is part of the key: tf and numpy agree only to
+    float rounding, so a shared cache must not mix their results."""
+    if params.get('seed') is None:
+        return None
+    keyed = {k: v for k, v in params.items() if k not in UNKEYED_PARAMS}
+    return digest(hashlib.sha256(prompt_bytes).hexdigest(), checkpoint, backend, json.dumps(keyed, sort_keys=True))
+
+class ResultCache(ArrayCache):
+    """Seeded /generate results: with an explicit seed, generation is a function
+    of the prompt bytes, the checkpoint, the backend and the parameters, so a repeated
+    request can be answered with the MIDI produced the first time. Only runs
+    that completed are stored (a timeout depends on the machine, not the inputs)."""
+    def __init__(self, backend, namespace='result'):
+        super(ResultCache, self).__init__(backend, namespace)
+
+    def get(self, key):
+        """(midi bytes, info) stored under key, or None."""
+        if key is None:
+            return None
+        hit = self._lookup(key)
+        if hit is None:
+            return None
+        arrays, info = hit
+        return arrays['midi'].tobytes(), info
+
+    def put(self, key, midi, info):
+        if key is None or info['stop_reason'] != 'complete':
+            return
+        self._store(key, {'midi': np.frombuffer(midi, dtype=np.uint8)}, info)
@@ -0,0 +1,56 @@
+"""Converter role: sanitize and upload MIDI files.
+
+Only needs mido and numpy, so a worker with JAMMASTER_ROLE=converter starts
+without loading the model stack.
+"""
+import os
+import tempfile
+
+from flask import Blueprint, request
+
+from converter.converter import process_midi_file
+from api_utils import get_temp_dir, ARTIFACTS
+
+converter_api = Blueprint('converter', __name__)
+
+@converter_api.route('/sanitize_audio', methods=["POST"])
+def sanitize():
+    # Handle both JSON (an id from /upload_midi) and file upload
+    if request.files:
+        file = request.files['file']
+        if file.filename == '':
+            return {'error': 'No selected file'}, 400
+        inpath = ARTIFACTS.path(ARTIFACTS.put(file.read()))
+    else:
+        data = request.get_json()
+        inpath = ARTIFACTS.path(data.get('id'))
+        if inpath is None:
+            return {'error': 'Unknown or expired id'}, 404
+
+    # the converter writes to a path; the result is moved into the store
+    with tempfile.NamedTemporaryFile(dir=get_temp_dir(), suffix='.mid', delete=False) as temp_out:
+        outpath = temp_out.name
+    try:
+        process_midi_file(inpath, outpath)
+        output_id = ARTIFACTS.put_file(outpath)
+    finally:
+        os.unlink(outpath)
+    return {'message': 'Audio processed', 'id': output_id}, 200
+
+@converter_api.route('/upload_midi', methods=['POST'])
+def upload_midi():
+    if 'file' not in request.files:
+        return {'error': 'No file part in request'}, 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return {'error': 'No selected file'}, 400
+
+    upload_id = ARTIFACTS.put(file.read())
+    print(f"Stored MIDI upload: {upload_id}")
+
+    return {
+        'message': 'MIDI uploaded to temporary storage',
+        'id': upload_id,
+        'warning': f'Files unused for {ARTIFACTS.ttl:.0f} seconds are deleted'
+    }, 200
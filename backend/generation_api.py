@@ -0,0 +1,472 @@
+"""Generation role: model provisioning and the endpoints that run the model."""
+import os
+import sys
+import re
+import json
+import time
+import uuid
+import functools
+from flask import Blueprint, request, jsonify, Response
+
+from remi.model import PopMusicTransformer, default_backend
+from api_utils import get_temp_dir, parse_bool, parse_optional_int, parse_optional_float, client_id, ARTIFACTS
+
+# remi modules import each other as top-level modules; share the same instance
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remi'))
+import metrics
+import admission
+import rerank
+import sessions
+import cache
+import decode_state
+import provisioning
+import model_pool
+import workers
+
+generation_api = Blueprint('generation', __name__)
+
+ADMISSION = admission.AdmissionController.from_env()
+
+SESSIONS = sessions.SessionStore.from_env()
+
+# prompt words, prompt memory and seeded results; JAMMASTER_CACHE_URL points
+# replicas at a shared store
+CACHE = cache.backend_from_env()
+# seeded requests are deterministic, so their results can be reused
+RESULTS = cache.ResultCache(CACHE)
+
+# best-of-N requests are clamped to this many candidates
+MAX_CANDIDATES = int(os.environ.get('JAMMASTER_MAX_CANDIDATES') or 8)
+
+# longest generation a request may ask for
+MAX_TARGET_BARS = int(os.environ.get('JAMMASTER_MAX_TARGET_BARS') or 64)
+
+# regenerable results keep decoder snapshots of only their last this many bars
+SESSION_MAX_BARS = int(os.environ.get('JAMMASTER_SESSION_MAX_BARS') or 8)
+
+# upper bound on wall-clock time of one generation, whatever the request asks for
+MAX_GENERATE_SECONDS = float(os.environ.get('JAMMASTER_MAX_GENERATE_SECONDS') or 120)
+
+# decode state of running jobs; point at a persistent volume to survive restarts
+JOB_DIR = os.environ.get('JAMMASTER_JOB_DIR') or os.path.join(get_temp_dir(), 'jobs')
+os.makedirs(JOB_DIR, exist_ok=True)
+
+# when set, every /generate run is profiled into its own subdirectory (see remi/profiling.py)
+PROFILE_DIR = os.environ.get('JAMMASTER_PROFILE_DIR')
+
+def new_job():
+    """Issue a job id; the empty marker file records that this server issued it"""
+    job_id = uuid.uuid4().hex
+    open(os.path.join(JOB_DIR, f'{job_id}.job'), 'w').close()
+    return job_id
+
+def job_path(job_id):
+    """State file of a job id issued by new_job(), or None for any other id"""
+    if not re.match(r'^[0-9a-f]{32}$', str(job_id)) or not os.path.exists(os.path.join(JOB_DIR, f'{job_id}.job')):
+        return None
+    return os.path.join(JOB_DIR, f'{job_id}.npz')
+
+# model name (the `model` request parameter) -> checkpoint directory, bundled
+# under ./remi or stored under the same prefix in the model bucket
+CHECKPOINTS = {
+    'pop': 'REMI-tempo-checkpoint',
+    'pop-chord': 'REMI-tempo-chord-checkpoint',
+    'classical': 'REMI-finetune-classical-checkpoint',
+}
+DEFAULT_MODEL = os.environ.get('JAMMASTER_DEFAULT_MODEL') or 'pop-chord'
+
+def default_model_source(checkpoint):
+    """The checkpoint shipped with the image, else the one in the model bucket"""
+    local_path = os.path.join('./remi', checkpoint)
+    if provisioning.is_complete_checkpoint(local_path):
+        return provisioning.LocalSource(local_path)
+    bucket_name = os.environ.get('MODEL_BUCKET_NAME', 'jammaster-models-160279')
+    return provisioning.GCSSource(bucket_name, checkpoint)
+
+def load_model(path):
+    return PopMusicTransformer(checkpoint=path, is_training=False, cache=cache.ArrayCache(CACHE, 'prompt'))
+
+# loaded models stay in memory between requests, within JAMMASTER_MODEL_MEMORY bytes
+MODEL_POOL = model_pool.ModelPool.from_env(load_model)
+
+# with JAMMASTER_WORKERS=n, models run in n worker processes (each holding its
+# own pool) instead of on this process's request threads
+WORKERS = workers.WorkerPool.from_env()
+
+def run_generate(model_name, path, **kwargs):
+    """model.generate(output_path=None, **kwargs) with the rerank scorer, in a worker if there are any"""
+    if WORKERS is not None:
+        return WORKERS.generate(model_name, path, **kwargs)
+    # the lease returns the model to the pool even if generation fails
+    with MODEL_POOL.acquire(model_name, path) as model:
+        return model.generate(output_path=None, scorer=functools.partial(rerank.score_candidates, model.vocab),
+                              **kwargs)
+
+def run_resume_job(model_name, path, state_path, timeout):
+    if WORKERS is not None:
+        return WORKERS.resume_job(model_name, path, state_path, timeout=timeout)
+    with MODEL_POOL.acquire(model_name, path) as model:
+        return model.resume_job(state_path, None, timeout=timeout)
+
+def model_provisioner(name):
+    """Provisioner of one registered checkpoint; JAMMASTER_MODEL_SOURCE_<NAME> overrides
+    its source (JAMMASTER_MODEL_SOURCE for the default model)"""
+    env = 'JAMMASTER_MODEL_SOURCE'
+    if name != DEFAULT_MODEL:
+        env += '_' + name.upper().replace('-', '_')
+    # warming loads the model into the pool, so its first request does not pay for it
+    return provisioning.Provisioner.from_env(
+        default_model_source(CHECKPOINTS[name]), warm=functools.partial((WORKERS or MODEL_POOL).preload, name),
+        env=env)
+
+MODELS = model_pool.ModelRegistry({name: model_provisioner(name) for name in CHECKPOINTS}, DEFAULT_MODEL)
+
+# fetch and warm the default checkpoint in the background; the server answers right
+# away and /ready reports when generation can be served. Other models start on first use.
+PROVISIONER = MODELS.get(DEFAULT_MODEL)
+
+def model_not_ready(name):
+    return {'error': f'Model {name} is not ready yet. Please check the ready endpoint.',
+            'provisioning': MODELS.provisioners[name].status()}, 503, {'Retry-After': '10'}
+
+def unknown_model(name):
+    return {'error': f'Unknown model {name!r}', 'models': MODELS.names()}, 400
+
+def readiness():
+    """(ready, status) of the default model, for the app's /ready probe"""
+    return PROVISIONER.ready, PROVISIONER.status()
+
+@generation_api.route('/model_status', methods=['GET'])
+def model_status():
+    """Check model availability"""
+    return jsonify({
+        'model_available': PROVISIONER.ready,
+        'provisioning': PROVISIONER.status(),
+        'checkpoint_contents': os.listdir(PROVISIONER.path) if os.path.exists(PROVISIONER.path) else None,
+        'working_directory': os.getcwd()
+    })
+
+@generation_api.route('/models', methods=['GET'])
+def models():
+    """Models the `model` parameter accepts, their provisioning state and what is loaded"""
+    return jsonify({
+        'default': DEFAULT_MODEL,
+        'models': MODELS.status(),
+        'loaded': MODEL_POOL.loaded(),
+        'memory_budget': MODEL_POOL.max_bytes,
+        'workers': WORKERS.status() if WORKERS is not None else None
+    })
+
+@generation_api.route('/jobs', methods=['POST'])
+def create_job():
+    """Issue a job id for /generate. The client keeps it to call /resume_job
+    if the generation is cut short, even when no response arrives."""
+    return {'job_id': new_job()}
+
+@generation_api.route('/generate', methods=['POST'])
+def generate():
+    if request.method == 'POST':
+        print("=== GENERATE ENDPOINT CALLED ===")
+        
+        # Default parameters
+        default_params = {
+            'n_target_bar': 8,
+            'temperature': 0.5,
+            'topk': 10,
+            'constrained': False,
+            'prompt_bars': None,
+            'max_tokens': None,
+            'timeout': None,
+            'speculative': 0,
+            'n_candidates': 1,
+            'seed': None
+        }
+
+        # Handle both JSON and file upload
+        if request.files:
+            file = request.files['file']
+            if file.filename == '':
+                return {'error': 'No selected file'}, 400
+            
+            prompt_id = ARTIFACTS.put(file.read())
+            
+            # Extract parameters from form data
+            params = {
+                'n_target_bar': request.form.get('n_target_bar', default_params['n_target_bar']),
+                'temperature': request.form.get('temperature', default_params['temperature']),
+                'topk': request.form.get('topk', default_params['topk']),
+                'constrained': request.form.get('constrained', default_params['constrained']),
+                'prompt_bars': request.form.get('prompt_bars', default_params['prompt_bars']),
+                'max_tokens': request.form.get('max_tokens', default_params['max_tokens']),
+                'timeout': request.form.get('timeout', default_params['timeout']),
+                'speculative': request.form.get('speculative', default_params['speculative']),
+                'n_candidates': request.form.get('n_candidates', default_params['n_candidates']),
+                'seed': request.form.get('seed', default_params['seed'])
+            }
+            job_id = request.form.get('job_id')
+            regenerable = request.form.get('regenerable', False)
+            model_name = request.form.get('model') or DEFAULT_MODEL
+        else:
+            data = request.get_json()
+            prompt_id = data.get('id')
+            
+            # Extract parameters from JSON
+            params = {
+                'n_target_bar': data.get('n_target_bar', default_params['n_target_bar']),
+                'temperature': data.get('temperature', default_params['temperature']),
+                'topk': data.get('topk', default_params['topk']),
+                'constrained': data.get('constrained', default_params['constrained']),
+                'prompt_bars': data.get('prompt_bars', default_params['prompt_bars']),
+                'max_tokens': data.get('max_tokens', default_params['max_tokens']),
+                'timeout': data.get('timeout', default_params['timeout']),
+                'speculative': data.get('speculative', default_params['speculative']),
+                'n_candidates': data.get('n_candidates', default_params['n_candidates']),
+                'seed': data.get('seed', default_params['seed'])
+            }
+            job_id = data.get('job_id')
+            regenerable = data.get('regenerable', False)
+            model_name = data.get('model') or DEFAULT_MODEL
+
+        print(f"Input id: {prompt_id}")
+        print(f"Model: {model_name}, parameters: {params}")
+
+        if model_name not in CHECKPOINTS:
+            return unknown_model(model_name)
+        provisioner = MODELS.get(model_name)
+        if not provisioner.ready:
+            return model_not_ready(model_name)
+
+        # Validate and convert parameters
+        try:
+            generation_params = {
+                'n_target_bar': int(params['n_target_bar']),
+                'temperature': float(params['temperature']),
+                'topk': int(params['topk']),
+                'constrained': parse_bool(params['constrained']),
+                'prompt_bars': parse_optional_int(params['prompt_bars']),
+                'max_tokens': parse_optional_int(params['max_tokens']),
+                'timeout': min(parse_optional_float(params['timeout']) or MAX_GENERATE_SECONDS,
+                               MAX_GENERATE_SECONDS),
+                'speculative': int(params['speculative']),
+                'n_candidates': max(1, min(int(params['n_candidates']), MAX_CANDIDATES)),
+                'seed': parse_optional_int(params['seed'])
+            }
+            check_target_bars(generation_params['n_target_bar'])
+            if generation_params['speculative'] < 0:
+                raise ValueError(f"speculative must be 0 or more, not {generation_params['speculative']}")
+            regenerable = parse_bool(regenerable)
+            print(f"Converted parameters: {generation_params}")
+        except ValueError as e:
+            print(f"Parameter conversion error: {e}")
+            return {'error': f'Invalid parameter value: {str(e)}'}, 400
+
+        # with a job id (issued by /jobs) the decode state is saved at every
+        # bar, so /resume_job can finish the generation if this worker is restarted
+        state_path = None
+        if job_id:
+            state_path = job_path(job_id)
+            if state_path is None:
+                return {'error': 'Unknown job_id; job ids are issued by POST /jobs'}, 400
+            if generation_params['n_candidates'] > 1:
+                return {'error': 'job_id is only supported with n_candidates=1'}, 400
+
+        # read the prompt now; the janitor may expire the file during generation
+        prompt_bytes = ARTIFACTS.get(prompt_id)
+        if prompt_bytes is None:
+            print(f"ERROR: Unknown or expired input id: {prompt_id}")
+            return {'error': 'Unknown or expired id'}, 404
+        
+        input_size = len(prompt_bytes)
+        print(f"Input file size: {input_size} bytes")
+
+        # a seeded request that already ran is answered without the model
+        result_key = cache.result_key(prompt_bytes, CHECKPOINTS[model_name], default_backend(), generation_params)
+        cached = RESULTS.get(result_key)
+        if cached is not None:
+            print("Returning cached result")
+            midi_data, info = cached
+            return midi_response(midi_data, dict(info), cache_hit=True)
+
+        # wait for a generation slot, or tell the client when to come back
+        try:
+            ticket = ADMISSION.admit(
+                client_id(), admission.estimate_cost(
+                    input_size, generation_params['n_target_bar'], generation_params['n_candidates']))
+        except admission.Rejected as e:
+            print(f"Request rejected ({e.status}): {e.reason}")
+            return {'error': e.reason}, e.status, {'Retry-After': str(e.retry_after)}
+
+        try:
+            with ticket:
+                # per-bar decoder snapshots make the result regenerable from its last bars;
+                # they are large, so only recorded on request
+                snapshots = {} if regenerable and generation_params['n_candidates'] == 1 else None
+                profile = None
+                if PROFILE_DIR:
+                    profile = os.path.join(PROFILE_DIR, time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8])
+                with metrics.span('generate'):
+                    _, info = run_generate(
+                        model_name, provisioner.path,
+                        **generation_params,
+                        prompt=prompt_bytes,
+                        snapshots=snapshots,
+                        state_path=state_path,
+                        profile=profile,
+                        max_snapshots=SESSION_MAX_BARS)
+            finish_job(state_path, info)
+
+            session_id = None
+            if snapshots:
+                session_id = SESSIONS.put(
+                    prompt_bytes, generation_params, info['original_length'], snapshots, model=model_name)
+            
+            midi_data = info.pop('midi')
+            print(f"Output size: {len(midi_data)} bytes")
+            if profile:
+                print(f"Profile: {info.pop('profile')}")
+            RESULTS.put(result_key, midi_data, info)
+            
+            # Compare input and output sizes
+            if input_size == len(midi_data):
+                print("WARNING: Input and output files are the same size - possible issue")
+            
+            return midi_response(midi_data, info, session_id)
+            
+        except Exception as e:
+            print(f"GENERATION ERROR: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            return {'error': str(e)}, 500
+    
+def check_target_bars(n_target_bar):
+    if not 1 <= n_target_bar <= MAX_TARGET_BARS:
+        raise ValueError(f"n_target_bar must be between 1 and {MAX_TARGET_BARS}, not {n_target_bar}")
+
+def finish_job(state_path, info):
+    """Drop the state and id of a completed job; an early stop keeps it resumable"""
+    if state_path and info['stop_reason'] == 'complete':
+        for path in [state_path, os.path.splitext(state_path)[0] + '.job']:
+            if os.path.exists(path):
+                os.unlink(path)
+
+def midi_response(midi_data, info, session_id=None, cache_hit=False):
+    headers = {
+        "Content-Disposition": "attachment;filename=generated.mid",
+        "X-Generation-Stop-Reason": info['stop_reason'],
+        "X-Generated-Bars": str(info['n_bars']),
+        "X-Candidate-Scores": json.dumps([
+            {k: round(v, 4) if isinstance(v, float) else v for k, v in c.items()}
+            for c in info.get('candidates', [])], separators=(',', ':'))}
+    if session_id:
+        headers["X-Session-Id"] = session_id
+    if info.get('fallbacks'):
+        # requested features that were turned off, e.g. speculative_no_draft
+        headers["X-Generation-Fallbacks"] = ",".join(info['fallbacks'])
+    if cache_hit:
+        # cached results carry no session; /regenerate needs a fresh run
+        headers["X-Result-Cache"] = "hit"
+    return Response(midi_data, mimetype="audio/midi", headers=headers)
+
+@generation_api.route('/regenerate', methods=['POST'])
+def regenerate():
+    """Regenerate a previous /generate result from bar `from_bar` onward.
+
+    JSON: session_id (the X-Session-Id header of a /generate call made with
+    regenerable=true; its last JAMMASTER_SESSION_MAX_BARS bars can be
+    regenerated), from_bar, and optionally
+    new n_target_bar / temperature / topk / constrained / max_tokens / timeout
+    and a seed (by default the regenerated bars are sampled afresh).
+    Bars before from_bar are kept and not re-encoded.
+    """
+    data = request.get_json() or {}
+    session = SESSIONS.get(data.get('session_id'))
+    if session is None:
+        return {'error': 'Unknown or expired session'}, 404
+    provisioner = MODELS.get(session.model)
+    if not provisioner.ready:
+        return model_not_ready(session.model)
+
+    try:
+        from_bar = int(data.get('from_bar', 0))
+        generation_params = dict(session.params)
+        for name, parse in [('n_target_bar', int), ('temperature', float), ('topk', int),
+                            ('constrained', parse_bool), ('max_tokens', parse_optional_int)]:
+            if name in data:
+                generation_params[name] = parse(data[name])
+        check_target_bars(generation_params['n_target_bar'])
+        generation_params['seed'] = parse_optional_int(data.get('seed'))
+        if 'timeout' in data:
+            generation_params['timeout'] = min(
+                parse_optional_float(data['timeout']) or MAX_GENERATE_SECONDS, MAX_GENERATE_SECONDS)
+    except ValueError as e:
+        return {'error': f'Invalid parameter value: {str(e)}'}, 400
+    if from_bar not in session.snapshots:
+        return {'error': f'No snapshot for bar {from_bar}',
+                'available_bars': sorted(session.snapshots)}, 400
+
+    try:
+        ticket = ADMISSION.admit(
+            client_id(), admission.estimate_cost(0, max(1, generation_params['n_target_bar'] - from_bar)))
+    except admission.Rejected as e:
+        return {'error': e.reason}, e.status, {'Retry-After': str(e.retry_after)}
+
+    try:
+        with ticket:
+            snapshots = session.snapshots_before(from_bar)
+            with metrics.span('regenerate'):
+                _, info = run_generate(
+                    session.model, provisioner.path,
+                    **generation_params,
+                    prompt=session.prompt_bytes,
+                    snapshots=snapshots,
+                    resume=session.resume_from(from_bar),
+                    max_snapshots=SESSION_MAX_BARS)
+        session_id = SESSIONS.put(session.prompt_bytes, generation_params, session.original_length, snapshots,
+                                  session_id=session.session_id, model=session.model)
+        return midi_response(info.pop('midi'), info, session_id)
+    except Exception as e:
+        print(f"REGENERATION ERROR: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return {'error': str(e)}, 500
+
+@generation_api.route('/resume_job', methods=['POST'])
+def resume_job():
+    """Continue a /generate call made with a job_id from POST /jobs from its last saved bar.
+
+    JSON: job_id and optionally timeout. The job keeps saving its state, so
+    it can be resumed again if this attempt is interrupted too.
+    """
+    data = request.get_json() or {}
+    state_path = job_path(data.get('job_id'))
+    if state_path is None or not os.path.exists(state_path):
+        return {'error': 'Unknown job'}, 404
+    try:
+        timeout = min(parse_optional_float(data.get('timeout')) or MAX_GENERATE_SECONDS, MAX_GENERATE_SECONDS)
+    except ValueError as e:
+        return {'error': f'Invalid parameter value: {str(e)}'}, 400
+    bars, _, params, checkpoint = decode_state.read_header(state_path)
+    model_name = MODELS.name_for_checkpoint(checkpoint) if checkpoint else DEFAULT_MODEL
+    if model_name is None:
+        return {'error': f'The model of this job ({checkpoint}) is not served here'}, 400
+    provisioner = MODELS.get(model_name)
+    if not provisioner.ready:
+        return model_not_ready(model_name)
+
+    try:
+        ticket = ADMISSION.admit(
+            client_id(), admission.estimate_cost(0, max(1, params['n_target_bar'] - bars)))
+    except admission.Rejected as e:
+        return {'error': e.reason}, e.status, {'Retry-After': str(e.retry_after)}
+
+    try:
+        with ticket:
+            with metrics.span('resume_job'):
+                _, info = run_resume_job(model_name, provisioner.path, state_path, timeout)
+        finish_job(state_path, info)
+        return midi_response(info.pop('midi'), info)
+    except Exception as e:
+        print(f"RESUME ERROR: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return {'error': str(e)}, 500
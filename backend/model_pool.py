@@ -0,0 +1,162 @@
+"""Servable checkpoints by name and an LRU of loaded models bounded by memory.
+
+ModelRegistry maps a model name (the `model` request parameter) to the
+Provisioner of its checkpoint. ModelPool keeps loaded models between
+requests; acquire() returns a Lease that holds a reference, and whenever
+the estimated size of all loaded models exceeds max_bytes the least
+recently used models without references are closed.
+"""
+import glob
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remi'))
+import metrics
+
+LOADED_MODELS = metrics.gauge('jammaster_loaded_models', 'Models held in memory by the pool.')
+LOADED_BYTES = metrics.gauge('jammaster_loaded_model_bytes', 'Estimated memory of the loaded models.')
+MODEL_LOADS = metrics.counter('jammaster_model_loads_total', 'Models loaded into the pool, by name.')
+MODEL_EVICTIONS = metrics.counter('jammaster_model_evictions_total', 'Models closed to stay within the memory budget.')
+
+def model_bytes(model):
+    """Memory estimate of a loaded model: the size of the weights it read."""
+    if model.backend.name == 'numpy':
+        paths = [os.path.join(model.checkpoint, 'weights.npz')]
+    else:
+        paths = glob.glob(os.path.join(model.checkpoint, 'model.data-*'))
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+class ModelRegistry(object):
+    def __init__(self, provisioners, default):
+        if default not in provisioners:
+            raise ValueError('default model {!r} is not registered'.format(default))
+        self.provisioners = provisioners
+        self.default = default
+
+    def names(self):
+        return sorted(self.provisioners)
+
+    def get(self, name):
+        """The Provisioner of a model, started on first use; KeyError if unknown."""
+        return self.provisioners[name].start()
+
+    def name_for_checkpoint(self, path):
+        """Registered name whose checkpoint directory has the same basename as path."""
+        basename = os.path.basename(os.path.normpath(path))
+        for name, provisioner in self.provisioners.items():
+            if os.path.basename(os.path.normpath(provisioner.path)) == basename:
+                return name
+        return None
+
+    def status(self):
+        return {name: provisioner.status() for name, provisioner in sorted(self.provisioners.items())}
+
+class Lease(object):
+    """A loaded model in use; leaving the with block returns it to the pool."""
+    def __init__(self, pool, name, model):
+        self.pool = pool
+        self.name = name
+        self.model = model
+
+    def __enter__(self):
+        return self.model
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.pool._release(self.name)
+
+class _Entry(object):
+    def __init__(self, model, nbytes):
+        self.model = model
+        self.nbytes = nbytes
+        self.refs = 0
+
+class ModelPool(object):
+    def __init__(self, loader, max_bytes=2 << 30, sizer=model_bytes):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.sizer = sizer
+        self._entries = OrderedDict()
+        self._loading = set()
+        self._bytes = 0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_env(cls, loader):
+        return cls(loader, max_bytes=int(os.environ.get('JAMMASTER_MODEL_MEMORY') or 2 << 30))
+
+    def acquire(self, name, path):
+        """Lease the model `name`, loading it from path if it is not in memory."""
+        with self._cond:
+            # one load per model; other requests for it wait and share the result
+            while name in self._loading:
+                self._cond.wait()
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry.refs += 1
+                self._entries.move_to_end(name)
+                return Lease(self, name, entry.model)
+            self._loading.add(name)
+        try:
+            with metrics.span('model_load'):
+                model = self.loader(path)
+            entry = _Entry(model, self.sizer(model))
+        except Exception:
+            with self._cond:
+                self._loading.discard(name)
+                self._cond.notify_all()
+            raise
+        MODEL_LOADS.inc(model=name)
+        print('Loaded model {} from {} (~{:.0f} MB)'.format(name, path, entry.nbytes / 1e6))
+        with self._cond:
+            self._loading.discard(name)
+            entry.refs = 1
+            self._entries[name] = entry
+            self._bytes += entry.nbytes
+            self._evict()
+            self._cond.notify_all()
+        return Lease(self, name, entry.model)
+
+    def preload(self, name, path):
+        with self.acquire(name, path):
+            pass
+
+    def loaded(self):
+        with self._cond:
+            return [{'model': name, 'bytes': entry.nbytes, 'in_use': entry.refs}
+                    for name, entry in self._entries.items()]
+
+    def close(self):
+        with self._cond:
+            for entry in self._entries.values():
+                entry.model.close()
+            self._entries.clear()
+            self._bytes = 0
+            self._update_gauges()
+
+    def _release(self, name):
+        with self._cond:
+            self._entries[name].refs -= 1
+            # a model leased while over budget may be evictable now
+            self._evict()
+
+    def _evict(self):
+        # least recently used first; models in use are skipped, so the pool can
+        # stay over budget until they are released
+        for name in list(self._entries):
+            if self._bytes <= self.max_bytes:
+                break
+            entry = self._entries[name]
+            if entry.refs > 0:
+                continue
+            del self._entries[name]
+            self._bytes -= entry.nbytes
+            entry.model.close()
+            MODEL_EVICTIONS.inc()
+            print('Evicted model {} to stay within {:.0f} MB'.format(name, self.max_bytes / 1e6))
+        self._update_gauges()
+
+    def _update_gauges(self):
+        LOADED_MODELS.set(len(self._entries))
+        LOADED_BYTES.set(self._bytes)
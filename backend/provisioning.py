@@ -0,0 +1,380 @@
+"""Fetch, verify and cache a model checkpoint without blocking server start.
+
+A source serves the checkpoint files plus a manifest.json listing each
+file's size and sha256 (`python provisioning.py manifest DIR` writes one):
+
+  LocalSource   a directory, used in place
+  HTTPSource    any static file server that honours Range requests
+  GCSSource     gs://bucket/prefix over the Cloud Storage HTTP API; without
+                a manifest it falls back to the bucket listing's md5 hashes
+
+Remote files are fetched in parallel into a cache directory that several
+containers on one host can share: an flock on <cache>/<name>.lock makes one
+process download while the others wait, interrupted downloads resume from
+their .part file with a Range request, and every file is checked against
+the manifest before it is moved into place. Provisioner.start() does all of
+this in a background thread, then warms the model, and retries with backoff
+on failure; Provisioner.ready flips once the model is usable.
+"""
+import base64
+import binascii
+import hashlib
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, so containers may download twice
+    fcntl = None
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remi'))
+import metrics
+
+READY = metrics.gauge('jammaster_model_ready', '1 once the model checkpoint is provisioned and warm.')
+DOWNLOADED_BYTES = metrics.counter('jammaster_model_download_bytes_total', 'Checkpoint bytes fetched from the source.')
+FETCH_FAILURES = metrics.counter('jammaster_model_fetch_failures_total', 'Failed checkpoint file fetch attempts.')
+
+MANIFEST = 'manifest.json'
+COMPLETE_MARKER = '.complete'
+CHUNK_SIZE = 1 << 20
+
+def file_digest(path, algorithm='sha256'):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def build_manifest(directory):
+    """{'files': {name: {'size', 'sha256'}}} for the regular files in directory."""
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name in (MANIFEST, COMPLETE_MARKER) or name.endswith('.part') or not os.path.isfile(path):
+            continue
+        files[name] = {'size': os.path.getsize(path), 'sha256': file_digest(path)}
+    return {'files': files}
+
+def write_manifest(directory):
+    manifest = build_manifest(directory)
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+def verify_file(path, entry):
+    """True if the file at path has the size and hash the manifest entry lists."""
+    if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+        return False
+    for algorithm in ('sha256', 'md5'):
+        if algorithm in entry:
+            return file_digest(path, algorithm) == entry[algorithm]
+    return True
+
+def is_complete_checkpoint(directory):
+    """A TF checkpoint directory with its dictionary, index and data files."""
+    if not os.path.isdir(directory):
+        return False
+    names = os.listdir(directory)
+    return ('dictionary.pkl' in names and 'model.index' in names
+            and any(name.startswith('model.data-') for name in names))
+
+def _safe_name(name):
+    return name and not os.path.isabs(name) and os.path.normpath(name) == name and not name.startswith('..')
+
+class LocalSource(object):
+    def __init__(self, root):
+        self.root = root
+        self.name = os.path.basename(os.path.normpath(root))
+
+    def __repr__(self):
+        return 'LocalSource({!r})'.format(self.root)
+
+    def local_path(self):
+        """Directory the checkpoint can be used from without copying, if any."""
+        return self.root
+
+    def manifest(self):
+        path = os.path.join(self.root, MANIFEST)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def open(self, name, offset=0):
+        """(stream, start): a file-like stream of name from byte start."""
+        f = open(os.path.join(self.root, name), 'rb')
+        f.seek(offset)
+        return f, offset
+
+class HTTPSource(object):
+    def __init__(self, base_url, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.name = urllib.parse.unquote(self.base_url.rsplit('/', 1)[-1])
+        self.timeout = timeout
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.base_url)
+
+    def local_path(self):
+        return None
+
+    def headers(self):
+        return {}
+
+    def _urlopen(self, url, offset=0):
+        headers = self.headers()
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout)
+
+    def manifest(self):
+        with self._urlopen('{}/{}'.format(self.base_url, MANIFEST)) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def open(self, name, offset=0):
+        response = self._urlopen('{}/{}'.format(self.base_url, urllib.parse.quote(name)), offset)
+        # a server that ignores Range answers 200 with the whole file
+        return response, offset if response.status == 206 else 0
+
+class GCSSource(HTTPSource):
+    """gs://bucket/prefix. On GCP the default service account's token from the
+    metadata server is sent; elsewhere requests are anonymous."""
+    API = 'https://storage.googleapis.com'
+    METADATA_TOKEN_URL = 'http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token'
+
+    def __init__(self, bucket, prefix, timeout=60):
+        super(GCSSource, self).__init__('{}/{}/{}'.format(self.API, bucket, prefix.strip('/')), timeout)
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self._token = None
+        self._token_expiry = 0
+        self._token_lock = threading.Lock()
+
+    def headers(self):
+        with self._token_lock:
+            if self._token_expiry is not None and time.time() > self._token_expiry:
+                try:
+                    request = urllib.request.Request(self.METADATA_TOKEN_URL, headers={'Metadata-Flavor': 'Google'})
+                    with urllib.request.urlopen(request, timeout=2) as response:
+                        token = json.loads(response.read().decode('utf-8'))
+                    self._token = token['access_token']
+                    self._token_expiry = time.time() + token.get('expires_in', 300) - 60
+                except (OSError, ValueError, KeyError):
+                    # not on GCP: stay anonymous and stop asking
+                    self._token, self._token_expiry = None, None
+            return {'Authorization': 'Bearer {}'.format(self._token)} if self._token else {}
+
+    def manifest(self):
+        try:
+            return super(GCSSource, self).manifest()
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                raise
+        # no manifest uploaded: use the sizes and md5 hashes of the bucket listing
+        files = {}
+        page_token = None
+        while True:
+            query = {'prefix': self.prefix + '/', 'fields': 'items(name,size,md5Hash),nextPageToken'}
+            if page_token:
+                query['pageToken'] = page_token
+            url = '{}/storage/v1/b/{}/o?{}'.format(self.API, self.bucket, urllib.parse.urlencode(query))
+            with self._urlopen(url) as response:
+                listing = json.loads(response.read().decode('utf-8'))
+            for item in listing.get('items', []):
+                name = item['name'][len(self.prefix) + 1:]
+                if name and '/' not in name:
+                    files[name] = {'size': int(item['size']),
+                                   'md5': binascii.hexlify(base64.b64decode(item['md5Hash'])).decode('ascii')}
+            page_token = listing.get('nextPageToken')
+            if not page_token:
+                return {'files': files}
+
+def source_from_url(url):
+    """gs://bucket/prefix, http(s)://... or a local directory (optionally file://)."""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == 'gs':
+        return GCSSource(parsed.netloc, parsed.path)
+    if parsed.scheme in ('http', 'https'):
+        return HTTPSource(url)
+    if parsed.scheme == 'file':
+        return LocalSource(urllib.parse.unquote(parsed.path))
+    return LocalSource(url)
+
+class Provisioner(object):
+    """Makes the checkpoint of `source` available under `path` and warms it.
+
+    warm(path), if given, runs after the files are in place (for example to
+    load the model once); ready is True only after it returned.
+    """
+    def __init__(self, source, cache_dir, workers=4, retries=3, warm=None, max_backoff=300):
+        self.source = source
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.retries = retries
+        self.warm = warm
+        self.max_backoff = max_backoff
+        self.path = source.local_path() or os.path.join(cache_dir, source.name)
+        self.state = 'pending'
+        self.error = None
+        self.attempts = 0
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, default_source, warm=None, env='JAMMASTER_MODEL_SOURCE'):
+        """Source URL from the `env` variable if set, cache and workers from the environment."""
+        url = os.environ.get(env)
+        return cls(
+            source_from_url(url) if url else default_source,
+            os.environ.get('JAMMASTER_MODEL_CACHE') or os.path.join(tempfile.gettempdir(), 'jammaster-models'),
+            workers=int(os.environ.get('JAMMASTER_MODEL_FETCH_WORKERS') or 4),
+            warm=warm)
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def status(self):
+        return {'state': self.state, 'source': repr(self.source), 'path': self.path,
+                'attempts': self.attempts, 'error': self.error}
+
+    def start(self):
+        """Provision and warm in a daemon thread, retrying until it succeeds."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='provisioner', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        backoff = 1
+        while True:
+            self.attempts += 1
+            try:
+                self.ensure()
+                if self.warm is not None:
+                    self.state = 'warming'
+                    with metrics.span('model_warm'):
+                        self.warm(self.path)
+                self.state = 'ready'
+                self.error = None
+                READY.set(1)
+                print('Model ready at {}'.format(self.path))
+                return
+            except Exception as e:
+                traceback.print_exc()
+                self.state = 'failed'
+                self.error = str(e)
+                print('Provisioning from {} failed ({}); retrying in {}s'.format(self.source, e, backoff))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def ensure(self):
+        """Block until every checkpoint file is present and verified; return the path."""
+        self.state = 'fetching'
+        with metrics.span('model_provision'):
+            manifest = self.source.manifest()
+            if self.source.local_path():
+                # used in place; only checked when the directory ships a manifest
+                if manifest is not None:
+                    bad = [name for name, entry in manifest['files'].items()
+                           if not verify_file(os.path.join(self.path, name), entry)]
+                    if bad:
+                        raise ValueError('{} do not match {}'.format(', '.join(sorted(bad)), MANIFEST))
+                return self.path
+            if manifest is None or not manifest.get('files'):
+                raise ValueError('{} lists no checkpoint files'.format(self.source))
+            for name in manifest['files']:
+                if not _safe_name(name):
+                    raise ValueError('unsafe file name {!r} in manifest'.format(name))
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.cache_dir, '{}.lock'.format(self.source.name)), 'w') as lock:
+                if fcntl is not None:
+                    # another container on this host may be filling the same cache
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                self._fill_cache(manifest)
+        return self.path
+
+    def _fill_cache(self, manifest):
+        marker = os.path.join(self.path, COMPLETE_MARKER)
+        fingerprint = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()
+        if os.path.exists(marker):
+            # verified by an earlier run: only check that nothing was truncated or removed since
+            with open(marker) as f:
+                complete = f.read().strip() == fingerprint
+            paths = [(os.path.join(self.path, name), entry) for name, entry in manifest['files'].items()]
+            if complete and all(os.path.isfile(path) and os.path.getsize(path) == entry['size']
+                                for path, entry in paths):
+                return
+            os.unlink(marker)
+        missing = [(name, entry) for name, entry in sorted(manifest['files'].items())
+                   if not verify_file(os.path.join(self.path, name), entry)]
+        if missing:
+            print('Fetching {} checkpoint files ({:.1f} MB) from {}'.format(
+                len(missing), sum(entry['size'] for _, entry in missing) / 1e6, self.source))
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                # list() re-raises the first failure
+                list(pool.map(lambda item: self._fetch(*item), missing))
+        with open(os.path.join(self.path, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        with open(marker, 'w') as f:
+            f.write(fingerprint)
+
+    def _fetch(self, name, entry):
+        """Download one file, resuming from its .part file, and verify it."""
+        final = os.path.join(self.path, name)
+        part = final + '.part'
+        for attempt in range(self.retries):
+            try:
+                offset = os.path.getsize(part) if os.path.exists(part) else 0
+                if offset > entry['size']:
+                    offset = 0
+                if offset < entry['size']:
+                    stream, start = self.source.open(name, offset)
+                    with stream, open(part, 'ab' if start else 'wb') as f:
+                        for block in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                            f.write(block)
+                            DOWNLOADED_BYTES.inc(len(block))
+                received = os.path.getsize(part)
+                if received < entry['size']:
+                    # connection dropped early; the next attempt resumes from here
+                    raise IOError('{} ended after {} of {} bytes'.format(name, received, entry['size']))
+                if verify_file(part, entry):
+                    os.replace(part, final)
+                    return
+                # wrong bytes, not just too few: start this file over
+                os.unlink(part)
+                raise ValueError('{} failed verification'.format(name))
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                FETCH_FAILURES.inc()
+                if attempt == self.retries - 1:
+                    raise
+                print('Fetching {} failed ({}); retrying'.format(name, e))
+                time.sleep(2 ** attempt)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Checkpoint manifests and provisioning.')
+    subparsers = parser.add_subparsers(dest='command')
+    manifest_parser = subparsers.add_parser('manifest', help='write manifest.json for a checkpoint directory')
+    manifest_parser.add_argument('directory')
+    fetch_parser = subparsers.add_parser('fetch', help='provision a checkpoint into the cache')
+    fetch_parser.add_argument('source', help='gs://bucket/prefix, http(s) URL or directory')
+    fetch_parser.add_argument('--cache', default=os.path.join(tempfile.gettempdir(), 'jammaster-models'))
+    fetch_parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+    if args.command == 'manifest':
+        manifest = write_manifest(args.directory)
+        print('{} files listed in {}'.format(len(manifest['files']), os.path.join(args.directory, MANIFEST)))
+    elif args.command == 'fetch':
+        print(Provisioner(source_from_url(args.source), args.cache, workers=args.workers).ensure())
+    else:
+        parser.print_help()
@@ -0,0 +1,352 @@
+import numpy as np
+
+# numpy must match the Keras LayerNormalization default used in modules.py
+LAYER_NORM_EPSILON = 1e-3
+
+class InferenceBackend(object):
+    """What PopMusicTransformer.generate needs from a forward pass.
+
+    init_state(batch_size) returns an opaque memory state equivalent to the
+    zero memory the model was trained with; forward(x, state) feeds word ids
+    x [batch, qlen] and returns (logits [qlen, batch, n_token], new state);
+    rewind(state, n) forgets the last n fed positions (n <= slack).
+    snapshot(state) returns the memory window as per-layer (k, v) arrays
+    [mem_len, batch, n_head, d_head], independent of later steps, and
+    restore(snapshot) turns one back into a state; snapshots are the same
+    for every backend.
+    """
+    name = None
+    slack = 0
+
+    def init_state(self, batch_size):
+        raise NotImplementedError
+
+    def forward(self, x, state):
+        raise NotImplementedError
+
+    def rewind(self, state, n):
+        raise NotImplementedError
+
+    def snapshot(self, state):
+        raise NotImplementedError
+
+    def restore(self, snapshot):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class TFBackend(InferenceBackend):
+    """The cached key/value graph of a loaded model, run in its TF session.
+
+    The state keeps `slack` rows beyond mem_len so it can be rewound; only
+    the last mem_len rows are fed as memory. Inputs of up to `slack` words
+    (speculative verification) attend through a sliding mem_len window, as
+    if fed one at a time; longer ones (prompts) as one segment, like
+    NumpyBackend.
+    """
+    name = 'tf'
+
+    def __init__(self, model, slack=16):
+        self.model = model
+        self.slack = slack
+
+    def init_state(self, batch_size):
+        return self.model.init_kv_state(batch_size, self.model.mem_len + self.slack)
+
+    def forward(self, x, state):
+        m = self.model.mem_len
+        memory = [(k[-m:], v[-m:]) for k, v in state]
+        window = m if np.shape(x)[1] <= self.slack else None
+        logits, new_state = self.model.run_kv(x, memory, keep=m + self.slack, window=window)
+        # inputs shorter than slack: carry the older rows over from the previous state
+        if len(new_state[0][0]) < m + self.slack:
+            extra = m + self.slack - len(new_state[0][0])
+            new_state = [(np.concatenate([k[-m-extra:-m], nk]), np.concatenate([v[-m-extra:-m], nv]))
+                         for (k, v), (nk, nv) in zip(state, new_state)]
+        return logits, new_state
+
+    def rewind(self, state, n):
+        assert n <= self.slack, 'cannot rewind {} positions with slack {}'.format(n, self.slack)
+        if n == 0:
+            return state
+        return [(k[:-n], v[:-n]) for k, v in state]
+
+    def snapshot(self, state):
+        # forward() never writes into state arrays, so the window can be shared
+        m = self.model.mem_len
+        return [(k[-m:], v[-m:]) for k, v in state]
+
+    def restore(self, snapshot):
+        pad = np.zeros((self.slack,) + snapshot[0][0].shape[1:], dtype=np.float32)
+        return [(np.concatenate([pad, k]), np.concatenate([pad, v])) for k, v in snapshot]
+
+########################################
+# numpy forward pass
+########################################
+def positional_embedding(pos_seq, d_model):
+    inv_freq = 1 / (10000 ** (np.arange(0, d_model, 2.0) / d_model))
+    sinusoid_inp = np.outer(pos_seq, inv_freq)
+    return np.concatenate([np.sin(sinusoid_inp), np.cos(sinusoid_inp)], -1).astype(np.float32)
+
+def dense(x, kernel):
+    # one 2-D matmul; [qlen, batch, d] @ [d, f] would run as qlen small products
+    return (x.reshape(-1, x.shape[-1]) @ kernel).reshape(x.shape[:-1] + (kernel.shape[1],))
+
+def layer_norm(x, gamma, beta):
+    mean = x.mean(-1, keepdims=True)
+    var = ((x - mean) ** 2).mean(-1, keepdims=True)
+    return (x - mean) / np.sqrt(var + LAYER_NORM_EPSILON) * gamma + beta
+
+def softmax(x, axis):
+    x = x - x.max(axis=axis, keepdims=True)
+    e = np.exp(x)
+    return e / e.sum(axis=axis, keepdims=True)
+
+class RingState(object):
+    """Per-layer key/value ring buffers.
+
+    k, v are [n_layer, capacity, batch, n_head, d_head]; absolute position t
+    lives in slot t % capacity and `pos` is the next position to write. The
+    initial mem_len positions are the zero memory, so pos starts at mem_len.
+    """
+    def __init__(self, k, v, pos):
+        self.k = k
+        self.v = v
+        self.pos = pos
+
+    @property
+    def capacity(self):
+        return self.k.shape[1]
+
+class NumpyBackend(InferenceBackend):
+    """Pure-NumPy port of modules.transformer_kv for inference.
+
+    Weights come from the weights.npz written by
+    PopMusicTransformer.export_numpy_weights(), so this backend runs without
+    importing TensorFlow. Keys/values live in preallocated ring buffers:
+    a single-token step scores all slots in place instead of copying the
+    memory window, and positional terms come from precomputed tables.
+    """
+    name = 'numpy'
+
+    def __init__(self, weights, n_layer, n_head, d_head, mem_len, slack=16):
+        self.n_layer = n_layer
+        self.n_head = n_head
+        self.d_head = d_head
+        self.mem_len = mem_len
+        self.slack = slack
+        self.lookup_table = weights['lookup_table']
+        self.d_model = self.lookup_table.shape[1]
+        self.softmax_b = weights['softmax_b']
+        self.r_w_bias = weights['r_w_bias']
+        self.r_r_bias = weights['r_r_bias']
+        self.layers = []
+        for i in range(n_layer):
+            layer = {}
+            for name in ['qkv', 'r', 'o', 'attn_norm/gamma', 'attn_norm/beta',
+                         'ff_1/kernel', 'ff_1/bias', 'ff_2/kernel', 'ff_2/bias',
+                         'ff_norm/gamma', 'ff_norm/beta', 'r_table']:
+                layer[name] = weights['layer_{}/{}'.format(i, name)]
+            self.layers.append(layer)
+        self.scale = 1 / (d_head ** 0.5)
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint, n_layer, n_head, d_head, mem_len, **kwargs):
+        path = '{}/weights.npz'.format(checkpoint)
+        try:
+            weights = dict(np.load(path))
+        except IOError:
+            raise IOError('{} not found; export it once with '
+                          'PopMusicTransformer(checkpoint).export_numpy_weights()'.format(path))
+        return cls(weights, n_layer, n_head, d_head, mem_len, **kwargs)
+
+    def init_state(self, batch_size):
+        shape = (self.n_layer, self.mem_len + self.slack, batch_size, self.n_head, self.d_head)
+        return RingState(np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32), self.mem_len)
+
+    def rewind(self, state, n):
+        # the ring keeps `slack` positions beyond the memory window, so stepping back is free
+        assert n <= self.slack, 'cannot rewind {} positions with slack {}'.format(n, self.slack)
+        state.pos -= n
+        return state
+
+    def snapshot(self, state):
+        window = (state.pos - self.mem_len + np.arange(self.mem_len)) % state.capacity
+        return [(state.k[i][window], state.v[i][window]) for i in range(self.n_layer)]
+
+    def restore(self, snapshot):
+        state = self.init_state(snapshot[0][0].shape[1])
+        for i, (k, v) in enumerate(snapshot):
+            state.k[i, :self.mem_len] = k
+            state.v[i, :self.mem_len] = v
+        return state
+
+    def _r_table(self, layer, length):
+        # projected positions by distance; extended on demand for very long inputs
+        table = layer['r_table']
+        if len(table) < length:
+            pos_emb = positional_embedding(np.arange(length, dtype=np.float32), self.d_model)
+            table = layer['r_table'] = (pos_emb @ layer['r']).reshape(length, self.n_head, self.d_head)
+        return table
+
+    def _feed_forward(self, layer, x):
+        h = np.maximum(dense(x, layer['ff_1/kernel']) + layer['ff_1/bias'], 0)
+        h = np.maximum(dense(h, layer['ff_2/kernel']) + layer['ff_2/bias'], 0)
+        return layer_norm(h + x, layer['ff_norm/gamma'], layer['ff_norm/beta'])
+
+    def forward(self, x, state):
+        x = np.asarray(x).T  # [qlen, batch]
+        qlen, bsz = x.shape
+        output = self.lookup_table[x] * (self.d_model ** 0.5)
+        step = self._step if qlen <= self.slack else self._chunk
+        for i, layer in enumerate(self.layers):
+            heads = dense(output, layer['qkv']).reshape(qlen, bsz, 3, self.n_head, self.d_head)
+            attn_vec = step(i, layer, heads, state)
+            attn_out = dense(attn_vec.reshape(qlen, bsz, -1), layer['o'])
+            output = layer_norm(attn_out + output, layer['attn_norm/gamma'], layer['attn_norm/beta'])
+            output = self._feed_forward(layer, output)
+        logits = dense(output, self.lookup_table.T) + self.softmax_b
+        state.pos += qlen
+        return logits, state
+
+    def _step(self, i, layer, heads, state):
+        # up to `slack` queries against every ring slot in place, masking
+        # slots outside each query's window (older, or still in its future)
+        qlen = heads.shape[0]
+        cap = state.capacity
+        slots = (state.pos + np.arange(qlen)) % cap
+        state.k[i, slots] = heads[:, :, 1]
+        state.v[i, slots] = heads[:, :, 2]
+        dist = (state.pos + np.arange(qlen)[:, None] - np.arange(cap)[None, :]) % cap
+        valid = dist <= self.mem_len
+        table = self._r_table(layer, self.mem_len + 1)
+        q = heads[:, :, 0]
+        ac = np.einsum('ibnd,sbnd->isbn', q + self.r_w_bias, state.k[i])
+        bd_by_dist = np.einsum('ibnd,pnd->ipbn', q + self.r_r_bias, table[:self.mem_len + 1])
+        bd = np.take_along_axis(bd_by_dist, np.minimum(dist, self.mem_len)[:, :, None, None], axis=1)
+        score = (ac + bd) * self.scale
+        score[~valid] = -1e30
+        prob = softmax(score, 1)
+        return np.einsum('isbn,sbnd->ibnd', prob, state.v[i])
+
+    def _chunk(self, i, layer, heads, state):
+        # several queries: linearize the window, attend as modules.transformer_kv does
+        qlen, bsz = heads.shape[:2]
+        cap = state.capacity
+        window = (state.pos - self.mem_len + np.arange(self.mem_len)) % cap
+        k = np.concatenate([state.k[i][window], heads[:, :, 1]], 0)
+        v = np.concatenate([state.v[i][window], heads[:, :, 2]], 0)
+        klen = self.mem_len + qlen
+        table = self._r_table(layer, klen)
+        # batched matmuls over [batch, head, ...] layouts
+        q = heads[:, :, 0].transpose(1, 2, 0, 3)
+        ac = (q + self.r_w_bias[:, None]) @ k.transpose(1, 2, 3, 0)
+        bd_by_dist = (q + self.r_r_bias[:, None]) @ table[:klen].transpose(1, 2, 0)
+        # query i sits at mem_len + i, key j is mem_len + i - j positions back
+        dist = self.mem_len + np.arange(qlen)[:, None] - np.arange(klen)[None, :]
+        bd = np.take_along_axis(bd_by_dist, np.maximum(dist, 0)[None, None], axis=3)
+        score = (ac + bd) * self.scale
+        score[..., dist < 0] = -1e30
+        prob = softmax(score, 3)
+        # keep the newest positions that fit in the ring
+        keep = min(qlen, cap)
+        slots = (state.pos + np.arange(qlen - keep, qlen)) % cap
+        state.k[i][slots] = heads[qlen - keep:, :, 1]
+        state.v[i][slots] = heads[qlen - keep:, :, 2]
+        return (prob @ v.transpose(1, 2, 0, 3)).transpose(2, 0, 1, 3)
+
+def compare_backends(model, numpy_backend, words, steps=8):
+    """Max absolute logit difference between model.backend and numpy_backend
+    over a prompt followed by `steps` single-token steps, then over feeds of
+    2..slack words, which must also match feeding the same words one at a
+    time on either backend, and over a word fed after rewinding part of such
+    a feed (as speculate() does), which must match never having fed the
+    rewound words."""
+    x = np.array([words])
+    tf_state = model.backend.init_state(1)
+    np_state = numpy_backend.init_state(1)
+    tf_logits, tf_state = model.backend.forward(x, tf_state)
+    np_logits, np_state = numpy_backend.forward(x, np_state)
+    max_diff = float(np.abs(tf_logits - np_logits).max())
+    word = int(np.argmax(tf_logits[-1, 0]))
+    for _ in range(steps):
+        tf_logits, tf_state = model.backend.forward(np.array([[word]]), tf_state)
+        np_logits, np_state = numpy_backend.forward(np.array([[word]]), np_state)
+        max_diff = max(max_diff, float(np.abs(tf_logits - np_logits).max()))
+        word = int(np.argmax(tf_logits[-1, 0]))
+    tf_snapshot = model.backend.snapshot(tf_state)
+    np_snapshot = numpy_backend.snapshot(np_state)
+    for qlen in range(2, min(model.backend.slack, numpy_backend.slack, len(words)) + 1):
+        chunk = np.array([words[-qlen:]])
+        results = []
+        for backend, snapshot in [(model.backend, tf_snapshot), (numpy_backend, np_snapshot)]:
+            logits, _ = backend.forward(chunk, backend.restore(snapshot))
+            state = backend.restore(snapshot)
+            stepwise = []
+            for j in range(qlen):
+                step_logits, state = backend.forward(chunk[:, j:j+1], state)
+                stepwise.append(step_logits[0])
+            max_diff = max(max_diff, float(np.abs(logits - np.stack(stepwise)).max()))
+            results.append(logits)
+        max_diff = max(max_diff, float(np.abs(results[0] - results[1]).max()))
+    n = min(model.backend.slack, numpy_backend.slack, len(words) - 1)
+    chunk, word = np.array([words[-n-1:-1]]), np.array([words[-1:]])
+    for rewound in sorted({1, n // 2, n} - {0}):
+        results = []
+        for backend, snapshot in [(model.backend, tf_snapshot), (numpy_backend, np_snapshot)]:
+            _, state = backend.forward(chunk, backend.restore(snapshot))
+            logits, _ = backend.forward(word, backend.rewind(state, rewound))
+            state = backend.restore(snapshot)
+            if rewound < n:
+                _, state = backend.forward(chunk[:, :n-rewound], state)
+            expected, _ = backend.forward(word, state)
+            max_diff = max(max_diff, float(np.abs(logits - expected).max()))
+            results.append(logits)
+        max_diff = max(max_diff, float(np.abs(results[0] - results[1]).max()))
+    return max_diff
+
+def check_random_init(dictionary_path, steps=8, seed=0):
+    """compare_backends() on a randomly initialized model, which needs no
+    trained weights: the model is built in a temporary checkpoint directory
+    holding only the dictionary, and its weights are exported there. The
+    prompt is random words, longer than one x_len segment."""
+    import shutil
+    import tempfile
+    from model import PopMusicTransformer
+    checkpoint = tempfile.mkdtemp(prefix='remi-backends-')
+    try:
+        shutil.copy(dictionary_path, checkpoint)
+        with PopMusicTransformer(checkpoint=checkpoint, is_training=False, backend='tf') as model:
+            model.export_numpy_weights()
+            numpy_backend = NumpyBackend.from_checkpoint(
+                checkpoint, model.n_layer, model.n_head, model.d_head, model.mem_len)
+            rng = np.random.RandomState(seed)
+            words = rng.randint(model.n_token, size=model.x_len + 3 * numpy_backend.slack).tolist()
+            return compare_backends(model, numpy_backend, words, steps=steps)
+    finally:
+        shutil.rmtree(checkpoint)
+
+if __name__ == '__main__':
+    import argparse
+    from model import PopMusicTransformer
+    parser = argparse.ArgumentParser(description='Export NumPy weights and check them against the TF graph.')
+    parser.add_argument('--checkpoint', default='REMI-tempo-chord-checkpoint')
+    parser.add_argument('--prompt', default='./data/evaluation/000.midi')
+    parser.add_argument('--steps', type=int, default=32)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    parser.add_argument('--random-init', action='store_true',
+                        help='check a randomly initialized model with the dictionary of --checkpoint; '
+                             'exports nothing to --checkpoint')
+    args = parser.parse_args()
+    if args.random_init:
+        diff = check_random_init('{}/dictionary.pkl'.format(args.checkpoint), steps=args.steps)
+    else:
+        with PopMusicTransformer(checkpoint=args.checkpoint, is_training=False, backend='tf') as model:
+            model.export_numpy_weights()
+            numpy_backend = NumpyBackend.from_checkpoint(
+                args.checkpoint, model.n_layer, model.n_head, model.d_head, model.mem_len)
+            words = model.events_to_words(model.extract_events(args.prompt))
+            diff = compare_backends(model, numpy_backend, words, steps=args.steps)
+    print('max |logit difference| = {:.3g}'.format(diff))
+    raise SystemExit(0 if diff <= args.tolerance else 1)
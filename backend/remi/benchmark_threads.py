@@ -0,0 +1,86 @@
+from model import PopMusicTransformer
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+
+########################################
+# thread-count x concurrency matrix
+########################################
+# Every cell loads a fresh model with the given intra-op thread count and
+# serves `concurrency` simultaneous generate() calls from it, the way the
+# API does under load. Pick the cell with the best throughput whose p95
+# still fits the latency budget of the container size you deploy.
+
+def parse_int_list(text):
+    return [int(v) for v in text.split(',') if v.strip()]
+
+def run_cell(args, intra_op_threads, concurrency, out_dir):
+    model = PopMusicTransformer(
+        checkpoint=args.checkpoint,
+        is_training=False,
+        intra_op_threads=intra_op_threads,
+        inter_op_threads=args.inter_op_threads,
+        cpu_affinity=args.cpu_affinity)
+
+    def one_request(i):
+        st = time.time()
+        model.generate(
+            n_target_bar=args.n_target_bar,
+            temperature=args.temperature,
+            topk=args.topk,
+            output_path=os.path.join(out_dir, 'bench-{}-{}-{}.midi'.format(intra_op_threads, concurrency, i)),
+            prompt=args.prompt)
+        return time.time() - st
+
+    # warm up the session once so graph optimisation is not measured
+    one_request(-1)
+    latencies = []
+    st = time.time()
+    for _ in range(args.rounds):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies.extend(pool.map(one_request, range(concurrency)))
+    wall = time.time() - st
+    model.close()
+    return {
+        'intra_op_threads': intra_op_threads,
+        'inter_op_threads': args.inter_op_threads,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'p50_s': float(np.percentile(latencies, 50)),
+        'p95_s': float(np.percentile(latencies, 95)),
+        'throughput_rps': len(latencies) / wall}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark session thread settings against concurrent requests.')
+    parser.add_argument('--checkpoint', default='REMI-tempo-chord-checkpoint')
+    parser.add_argument('--threads', default='1,2,4,8', help='intra-op thread counts to try')
+    parser.add_argument('--concurrency', default='1,2,4', help='simultaneous requests to try')
+    parser.add_argument('--inter-op-threads', type=int, default=None)
+    parser.add_argument('--cpu-affinity', default=None, help='pin the session to CPUs, e.g. "0-3"')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--n-target-bar', type=int, default=4)
+    parser.add_argument('--temperature', type=float, default=1.2)
+    parser.add_argument('--topk', type=int, default=5)
+    parser.add_argument('--prompt', default=None)
+    parser.add_argument('--output', default=None, help='write results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    out_dir = tempfile.mkdtemp(prefix='remi-bench-')
+    print('{:>8} {:>11} {:>8} {:>8} {:>10}'.format('threads', 'concurrency', 'p50(s)', 'p95(s)', 'req/s'))
+    for intra_op_threads in parse_int_list(args.threads):
+        for concurrency in parse_int_list(args.concurrency):
+            r = run_cell(args, intra_op_threads, concurrency, out_dir)
+            results.append(r)
+            print('{:>8} {:>11} {:>8.2f} {:>8.2f} {:>10.3f}'.format(
+                intra_op_threads, concurrency, r['p50_s'], r['p95_s'], r['throughput_rps']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Serialized decode state of a single-candidate generate() run.
+
+A state file is an .npz written at a bar boundary with everything
+needed to continue the run in another process: the words so far, the
+decoder memory in the backend-neutral snapshot format, the bar and token
+counters, the numpy RNG state, the generation parameters and the prompt
+MIDI bytes. Files are replaced atomically, so a process killed mid-write
+leaves the previous state intact.
+
+save_async() hands the write to a background thread so decoding does not
+wait for it; a state superseded before its turn is skipped, only the
+newest one per path is written. wait() blocks until a path is up to date.
+The memory is stored uncompressed, as float32 noise barely compresses.
+"""
+import io
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+import metrics
+
+WRITE_ERRORS = metrics.counter('remi_decode_state_write_errors_total', 'Background decode state writes that failed.')
+
+VERSION = 1
+
+def save(path, words, kv_snapshot, bars, n_tokens, original_length, params,
+         prompt_bytes=None, rng_state=None, checkpoint=None):
+    if rng_state is None:
+        rng_state = np.random.get_state()
+    kind, keys, pos, has_gauss, cached_gaussian = rng_state
+    arrays = {
+        'version': np.array(VERSION),
+        'words': np.asarray(words, dtype=np.int64),
+        # [n_layer, mem_len, batch, n_head, d_head]
+        'k': np.stack([k for k, _ in kv_snapshot]),
+        'v': np.stack([v for _, v in kv_snapshot]),
+        'counters': np.array([bars, n_tokens, original_length], dtype=np.int64),
+        'params': np.array(json.dumps(params)),
+        'rng_kind': np.array(kind),
+        'rng_keys': np.asarray(keys, dtype=np.uint32),
+        'rng_pos': np.array([pos, has_gauss], dtype=np.int64),
+        'rng_gauss': np.array(cached_gaussian, dtype=np.float64),
+        'prompt': np.frombuffer(prompt_bytes or b'', dtype=np.uint8),
+        # directory name of the checkpoint that produced the memory
+        'checkpoint': np.array(checkpoint or '')}
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False) as f:
+        f.write(buf.getvalue())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f.name, path)
+
+class StateWriter(object):
+    """Runs save() in a daemon thread, keeping only the newest pending state per path."""
+
+    def __init__(self):
+        self._pending = {}
+        self._writing = set()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, path, *args, **kwargs):
+        """save(path, *args, **kwargs) later; the arrays passed must not change afterwards."""
+        if kwargs.get('rng_state') is None:
+            # the default is the caller's global RNG, not the writer thread's view of it later
+            kwargs['rng_state'] = np.random.get_state()
+        with self._cond:
+            self._pending[path] = (args, kwargs)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='decode-state-writer', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                path = next(iter(self._pending))
+                args, kwargs = self._pending.pop(path)
+                self._writing.add(path)
+            try:
+                save(path, *args, **kwargs)
+            except Exception as e:
+                WRITE_ERRORS.inc()
+                print('Saving decode state to {} failed: {}'.format(path, e))
+            finally:
+                with self._cond:
+                    self._writing.discard(path)
+                    self._cond.notify_all()
+
+    def wait(self, path):
+        """Block until no write of path is pending or running."""
+        with self._cond:
+            while path in self._pending or path in self._writing:
+                self._cond.wait()
+
+WRITER = StateWriter()
+save_async = WRITER.submit
+wait = WRITER.wait
+
+def read_header(path):
+    """(bars, n_tokens, params, checkpoint) of a state file, without reading the memory."""
+    wait(path)
+    with np.load(path, allow_pickle=False) as data:
+        bars, n_tokens, _ = (int(c) for c in data['counters'])
+        return bars, n_tokens, json.loads(str(data['params'])), str(data['checkpoint']) or None
+
+def load(path):
+    """Return a dict with the fields passed to save()."""
+    wait(path)
+    with np.load(path, allow_pickle=False) as data:
+        if int(data['version']) != VERSION:
+            raise ValueError('unsupported decode state version {} in {}'.format(int(data['version']), path))
+        bars, n_tokens, original_length = (int(c) for c in data['counters'])
+        pos, has_gauss = (int(p) for p in data['rng_pos'])
+        return {
+            'words': data['words'].tolist(),
+            'kv_snapshot': list(zip(data['k'], data['v'])),
+            'bars': bars,
+            'n_tokens': n_tokens,
+            'original_length': original_length,
+            'params': json.loads(str(data['params'])),
+            'rng_state': (str(data['rng_kind']), data['rng_keys'], pos, has_gauss, float(data['rng_gauss'])),
+            'prompt_bytes': data['prompt'].tobytes() or None,
+            'checkpoint': str(data['checkpoint']) or None}
@@ -0,0 +1,39 @@
+import numpy as np
+import vocabulary
+
+# REMI event families that may directly follow each family, as produced by
+# utils.item2event and consumed by utils.write_midi:
+#   Bar -> Position -> Note Velocity -> Note On -> Note Duration
+#              Position -> Chord
+#              Position -> Tempo Class -> Tempo Value
+# a group ends either at the next Position or at the next Bar.
+FOLLOWERS = {
+    'Bar': ['Position'],
+    'Position': ['Note Velocity', 'Chord', 'Tempo Class'],
+    'Note Velocity': ['Note On'],
+    'Note On': ['Note Duration'],
+    'Note Duration': ['Position', 'Bar'],
+    'Chord': ['Position', 'Bar'],
+    'Tempo Class': ['Tempo Value'],
+    'Tempo Value': ['Position', 'Bar'],
+}
+
+class RemiGrammar(object):
+    """Transition table over word ids derived from the vocabulary's event families.
+
+    `allowed[prev]` is a boolean mask of the words that may follow `prev`;
+    `logit_mask[prev]` is the same mask as 0 / -inf, ready to be added to logits.
+    """
+    def __init__(self, vocab):
+        self.allowed = np.ones((vocab.n_token, vocab.n_token), dtype=bool)
+        for name, followers in FOLLOWERS.items():
+            codes = [vocabulary.FAMILY_CODES[f] for f in followers]
+            rows = vocab.family == vocabulary.FAMILY_CODES[name]
+            mask = np.isin(vocab.family, codes)
+            if mask.any():
+                # a family whose followers are all absent stays unconstrained
+                self.allowed[rows] = mask
+        self.logit_mask = np.where(self.allowed, 0.0, -np.inf).astype(np.float32)
+
+    def constrain(self, logits, previous_word):
+        return logits + self.logit_mask[previous_word]
@@ -1,25 +1,90 @@
 import sys
 import os
+import io
+import hashlib
 
 # Add the remi directory explicitly to the path
 sys.path.append(os.path.dirname(__file__))
 
-import tensorflow as tf
 import numpy as np
 import miditoolkit
-import modules
 import pickle
 import utils
 import time
+import metrics
+import grammar
+import vocabulary
+import backends
+import ngram
+import decode_state
+import profiling
+
+# TensorFlow is only needed by the 'tf' backend and for training, so the numpy
+# backend can serve without importing it
+tf = None
+modules = None
+
+def _import_tensorflow():
+    global tf, modules
+    if tf is None:
+        import tensorflow
+        import modules as transformer_modules
+        tf, modules = tensorflow, transformer_modules
+
+OOV_REPLACEMENTS = metrics.counter(
+    'remi_oov_replacements_total', 'Out-of-vocabulary events mapped to the nearest dictionary entry.')
+OOV_DROPPED = metrics.counter(
+    'remi_oov_dropped_total', 'Out-of-vocabulary events dropped while preparing training data.')
+GENERATED_TOKENS = metrics.counter('remi_generated_tokens_total', 'Tokens sampled by generate().')
+GENERATED_BARS = metrics.counter('remi_generated_bars_total', 'Bars completed by generate().')
+TRAINING_LOSS = metrics.gauge('remi_training_loss', 'Loss of the most recent finetune step.')
+GENERATION_STOPS = metrics.counter('remi_generation_stops_total', 'generate() calls by stop reason.')
+SPECULATIVE_PROPOSED = metrics.counter('remi_speculative_proposed_total', 'Draft words proposed for verification.')
+SPECULATIVE_ACCEPTED = metrics.counter('remi_speculative_accepted_total', 'Draft words accepted by the transformer.')
+GENERATION_FALLBACKS = metrics.counter(
+    'remi_generation_fallbacks_total', 'Requested generate() features that were turned off, by reason.')
+
+# server-wide bound on sampling steps, scaled by the number of requested bars
+MAX_TOKENS_PER_BAR = int(os.environ.get('REMI_MAX_TOKENS_PER_BAR') or 512)
+
+def default_backend():
+    """Inference backend of models built without an explicit one (REMI_BACKEND, else 'tf')."""
+    return os.environ.get('REMI_BACKEND') or 'tf'
+
+def _int_from_env(value, name):
+    if value is None:
+        value = os.environ.get(name)
+    if value is None or value == '':
+        return None
+    return int(value)
+
+def parse_cpu_list(cpus):
+    """Parse a CPU list such as "0-3,6" (or an iterable of ints) into a set."""
+    if cpus is None or cpus == '':
+        return None
+    if not isinstance(cpus, str):
+        return set(int(c) for c in cpus)
+    result = set()
+    for part in cpus.split(','):
+        part = part.strip()
+        if '-' in part:
+            start, end = part.split('-')
+            result.update(range(int(start), int(end) + 1))
+        elif part:
+            result.add(int(part))
+    return result
 
 class PopMusicTransformer(object):
     ########################################
     # initialize
     ########################################
-    def __init__(self, checkpoint, is_training=False):
+    def __init__(self, checkpoint, is_training=False,
+                 intra_op_threads=None, inter_op_threads=None, cpu_affinity=None, backend=None, cache=None):
         # load dictionary
         self.dictionary_path = '{}/dictionary.pkl'.format(checkpoint)
         self.event2word, self.word2event = pickle.load(open(self.dictionary_path, 'rb'))
+        self.vocab = vocabulary.Vocabulary(self.event2word, self.word2event)
+        self.grammar = grammar.RemiGrammar(self.vocab)
         # model settings
         self.x_len = 512
         self.mem_len = 512
@@ -38,13 +103,50 @@ class PopMusicTransformer(object):
             self.batch_size = 4
         else:
             self.batch_size = 1
+        self.checkpoint = checkpoint
         self.checkpoint_path = '{}/model'.format(checkpoint)
-        self.load_model()
+        # n-gram draft for speculative decoding, loaded on first use (see ngram.py)
+        self.draft_path = '{}/ngram.pkl'.format(checkpoint)
+        self.draft = None
+        # optional store of prompt words and encoded prompt memory: an object
+        # with get(key) -> dict of arrays or None and put(key, arrays)
+        self.cache = cache
+        # session threading (falls back to environment, then to TF defaults)
+        self.intra_op_threads = _int_from_env(intra_op_threads, 'REMI_INTRA_OP_THREADS')
+        self.inter_op_threads = _int_from_env(inter_op_threads, 'REMI_INTER_OP_THREADS')
+        if cpu_affinity is None:
+            cpu_affinity = os.environ.get('REMI_CPU_AFFINITY')
+        self.cpu_affinity = parse_cpu_list(cpu_affinity)
+        if self.cpu_affinity and self.intra_op_threads is None:
+            self.intra_op_threads = len(self.cpu_affinity)
+        # inference backend: 'tf' (session over the cached key/value graph) or 'numpy'
+        if backend is None:
+            backend = default_backend()
+        if backend == 'numpy' and not self.is_training:
+            self.sess = None
+            self.graph = None
+            self.backend = backends.NumpyBackend.from_checkpoint(
+                checkpoint, self.n_layer, self.n_head, self.d_head, self.mem_len)
+        elif backend in ('tf', 'numpy'):
+            self.load_model()
+            self.backend = backends.TFBackend(self)
+        else:
+            raise ValueError('unknown backend {!r}'.format(backend))
 
     ########################################
     # load model
     ########################################
     def load_model(self):
+        _import_tensorflow()
+        # each instance owns its graph, so building another model (or closing
+        # this one) never touches the ops and variables of other instances
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self._build_graph()
+        # nothing may add ops after loading; catches per-request graph growth early
+        self.graph.finalize()
+
+    def _build_graph(self):
         # placeholders
         self.x = tf.compat.v1.placeholder(tf.int32, shape=[self.batch_size, None])
         self.y = tf.compat.v1.placeholder(tf.int32, shape=[self.batch_size, None])
@@ -53,6 +155,7 @@ class PopMusicTransformer(object):
         self.global_step = tf.compat.v1.train.get_or_create_global_step()
         initializer = tf.compat.v1.initializers.random_normal(stddev=0.02, seed=None)
         proj_initializer = tf.compat.v1.initializers.random_normal(stddev=0.01, seed=None)
+        self.layers = []
         with tf.compat.v1.variable_scope(tf.compat.v1.get_variable_scope()):
             xx = tf.transpose(self.x, [1, 0])
             yy = tf.transpose(self.y, [1, 0])
@@ -82,7 +185,10 @@ class PopMusicTransformer(object):
                 target_perms=None,
                 head_target=None,
                 untie_r=False,
-                proj_same_dim=True)
+                proj_same_dim=True,
+                layers=self.layers)
+            if not self.is_training:
+                self._build_kv_graph(initializer, proj_initializer)
         self.avg_loss = tf.reduce_mean(loss)
         # vars
         if self.is_training:
@@ -108,25 +214,128 @@ class PopMusicTransformer(object):
         else:
             # For training, include all variables
             self.saver = tf.compat.v1.train.Saver()
+        # initializer ops are built before the first run; adding ops to a graph a session has run is deprecated
+        global_init = tf.compat.v1.global_variables_initializer()
+        local_init = tf.compat.v1.local_variables_initializer()
             
         # Session setup
         config = tf.compat.v1.ConfigProto(allow_soft_placement=True)
         config.gpu_options.allow_growth = True
-        self.sess = tf.compat.v1.Session(config=config)
+        if self.intra_op_threads is not None:
+            config.intra_op_parallelism_threads = self.intra_op_threads
+        if self.inter_op_threads is not None:
+            config.inter_op_parallelism_threads = self.inter_op_threads
+        if self.intra_op_threads is not None or self.inter_op_threads is not None or self.cpu_affinity:
+            # TF shares one process-wide pool sized by the first session unless asked otherwise
+            config.use_per_session_threads = True
+        self.sess = self._create_session(config)
         
         # Initialize variables and restore from checkpoint
-        self.sess.run(tf.compat.v1.global_variables_initializer())
+        self.sess.run(global_init)
         try:
             self.saver.restore(self.sess, self.checkpoint_path)
             print(f"Model restored from {self.checkpoint_path}")
         except Exception as e:
             print(f"Warning during model restoration: {e}")
             print("Continuing with partially restored model")
+        # derived inference tables are computed from the restored weights
+        self.sess.run(local_init)
+
+    def _build_kv_graph(self, initializer, proj_initializer):
+        # inference path that caches projected keys/values instead of hidden states
+        kv_shape = [None, None, self.n_head, self.d_head]
+        self.kv_x = tf.compat.v1.placeholder(tf.int32, shape=[None, None])
+        self.kv_mems_i = [(tf.compat.v1.placeholder(tf.float32, kv_shape),
+                           tf.compat.v1.placeholder(tf.float32, kv_shape)) for _ in range(self.n_layer)]
+        # sliding attention window of run_kv(window=...); by default the input is one segment
+        self.kv_window = tf.compat.v1.placeholder_with_default(tf.int32.max, shape=[])
+        # projected relative positions for every distance one x_len chunk can see
+        tables = modules.relative_position_tables(
+            self.layers, self.mem_len + self.x_len, self.d_model, self.n_head, self.d_head)
+        self.r_tables = [
+            tf.compat.v1.Variable(t, trainable=False, name='r_table_{}'.format(i),
+                                  collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES])
+            for i, t in enumerate(tables)]
+        self.kv_logits, self.new_kv = modules.transformer_kv(
+            dec_inp=tf.transpose(self.kv_x, [1, 0]),
+            kv_mems=self.kv_mems_i,
+            n_token=self.n_token,
+            n_layer=self.n_layer,
+            d_model=self.d_model,
+            d_embed=self.d_embed,
+            n_head=self.n_head,
+            d_head=self.d_head,
+            layers=self.layers,
+            initializer=initializer,
+            proj_initializer=proj_initializer,
+            r_tables=self.r_tables,
+            window=self.kv_window)
+
+    def _create_session(self, config):
+        if not self.cpu_affinity or not hasattr(os, 'sched_setaffinity'):
+            return tf.compat.v1.Session(graph=self.graph, config=config)
+        # the session spawns its thread pools on creation and they inherit the
+        # affinity of the creating thread, so pin only while creating it
+        previous = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, self.cpu_affinity)
+        try:
+            return tf.compat.v1.Session(graph=self.graph, config=config)
+        finally:
+            os.sched_setaffinity(0, previous)
+
+    ########################################
+    # cached key/value inference
+    ########################################
+    def init_kv_state(self, batch_size, length=None):
+        """Zero memory, equivalent to the zero hidden-state mems used for training."""
+        shape = (length or self.mem_len, batch_size, self.n_head, self.d_head)
+        return [(np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32))
+                for _ in range(self.n_layer)]
+
+    def run_kv(self, x, kv_state, keep=None, window=None):
+        """Feed x [batch, qlen] after kv_state; returns logits [qlen, batch, n_token] and the
+        new state, the last `keep` (default mem_len) keys/values of every layer.
+        window limits each position to the keys at most that far back (see
+        modules.transformer_kv)."""
+        keep = keep or self.mem_len
+        feed_dict = {self.kv_x: x}
+        if window is not None:
+            feed_dict[self.kv_window] = window
+        for (k, v), (k_np, v_np) in zip(self.kv_mems_i, kv_state):
+            feed_dict[k] = k_np
+            feed_dict[v] = v_np
+        _logits, _new_kv = profiling.run(self.sess, [self.kv_logits, self.new_kv], feed_dict)
+        return _logits, [(k[-keep:], v[-keep:]) for k, v in _new_kv]
+
+    def export_numpy_weights(self, path=None):
+        """Write the inference weights and relative position tables for backends.NumpyBackend."""
+        if path is None:
+            path = '{}/weights.npz'.format(self.checkpoint)
+        variables = {v.op.name: v for v in self.graph.get_collection(tf.compat.v1.GraphKeys.GLOBAL_VARIABLES)}
+        fetches = {
+            'lookup_table': variables['transformer/normal_embed/lookup_table'],
+            'softmax_b': variables['transformer/normal_softmax/bias'],
+            'r_w_bias': variables['transformer/r_w_bias'],
+            'r_r_bias': variables['transformer/r_r_bias']}
+        for i, layer in enumerate(self.layers):
+            prefix = 'layer_{}/'.format(i)
+            for name in ['qkv', 'r', 'o']:
+                fetches[prefix + name] = layer[name].kernel
+            for name in ['ff_1', 'ff_2']:
+                fetches[prefix + name + '/kernel'] = layer[name].kernel
+                fetches[prefix + name + '/bias'] = layer[name].bias
+            for name in ['attn_norm', 'ff_norm']:
+                fetches[prefix + name + '/gamma'] = layer[name].gamma
+                fetches[prefix + name + '/beta'] = layer[name].beta
+            fetches[prefix + 'r_table'] = self.r_tables[i]
+        np.savez(path, **self.sess.run(fetches))
+        print('Exported numpy weights to {}'.format(path))
+        return path
 
     ########################################
     # temperature sampling
     ########################################
-    def temperature_sampling(self, logits, temperature, topk):
+    def temperature_sampling(self, logits, temperature, topk, rng=np.random):
         probs = np.exp(logits / temperature) / np.sum(np.exp(logits / temperature))
         if topk == 1:
             prediction = np.argmax(probs)
@@ -137,29 +346,118 @@ class PopMusicTransformer(object):
             # normalize probs
             candi_probs /= sum(candi_probs)
             # choose by predicted probs
-            prediction = np.random.choice(candi_index, size=1, p=candi_probs)[0]
+            prediction = rng.choice(candi_index, size=1, p=candi_probs)[0]
         return prediction
 
+    def sampling_probs(self, logits, temperature, topk):
+        """The full-vocabulary distribution temperature_sampling draws from."""
+        logits = logits.astype(np.float64)
+        probs = np.exp(logits / temperature) / np.sum(np.exp(logits / temperature))
+        dist = np.zeros_like(probs)
+        if topk == 1:
+            dist[np.argmax(probs)] = 1
+        else:
+            candi_index = np.argsort(probs)[::-1][:topk]
+            dist[candi_index] = probs[candi_index] / np.sum(probs[candi_index])
+        return dist
+
+    ########################################
+    # speculative decoding
+    ########################################
+    def load_draft(self):
+        if self.draft is None:
+            self.draft = ngram.NgramDraft.load(self.draft_path)
+        return self.draft
+
+    def speculate(self, words, kv_state, n_draft, temperature, topk, constrained=False, rng=np.random):
+        """One speculative step after `words`, whose last word has not been fed yet.
+
+        The n-gram draft proposes n_draft words and the transformer scores them
+        all in one forward pass. Each is accepted with probability min(1, p/q);
+        the first rejected one is resampled from max(0, p - q), and if all are
+        accepted one more word is sampled from p, so the output is distributed
+        exactly as plain sampling. Returns the new words and the state after
+        feeding all of them but the last.
+        """
+        draft = self.load_draft()
+        n_draft = min(n_draft, self.backend.slack)
+        context = list(words[-draft.order:])
+        drafted, proposals = [], []
+        with metrics.span('draft'):
+            for _ in range(n_draft):
+                q = draft.probs(context)
+                if constrained:
+                    q = q * self.grammar.allowed[context[-1]]
+                    q /= q.sum()
+                word = rng.choice(len(q), p=q)
+                drafted.append(word)
+                proposals.append(q)
+                context.append(word)
+        with metrics.span('sess_run'):
+            logits, kv_state = self.backend.forward(np.array([[words[-1]] + drafted]), kv_state)
+        SPECULATIVE_PROPOSED.inc(n_draft)
+        accepted = []
+        previous = words[-1]
+        with metrics.span('sampling'):
+            for j, (word, q) in enumerate(zip(drafted, proposals)):
+                p = self._target_probs(logits[j, 0], previous, temperature, topk, constrained)
+                if rng.random_sample() < min(1.0, p[word] / q[word]):
+                    accepted.append(word)
+                    previous = word
+                    continue
+                SPECULATIVE_ACCEPTED.inc(j)
+                residual = np.maximum(p - q, 0)
+                if residual.sum() > 0:
+                    p = residual / residual.sum()
+                accepted.append(rng.choice(len(p), p=p))
+                # forget the fed draft words from the rejected one on
+                return accepted, self.backend.rewind(kv_state, n_draft - j)
+            SPECULATIVE_ACCEPTED.inc(n_draft)
+            p = self._target_probs(logits[n_draft, 0], previous, temperature, topk, constrained)
+            accepted.append(rng.choice(len(p), p=p))
+        return accepted, kv_state
+
+    def _target_probs(self, logits, previous_word, temperature, topk, constrained):
+        if constrained:
+            logits = self.grammar.constrain(logits, previous_word)
+        return self.sampling_probs(logits, temperature, topk)
+
     ########################################
     # extract events for prompt continuation
     ########################################
     def _find_closest_velocity(self, velocity):
         """Find the closest available velocity in the dictionary."""
-        available_velocities = []
-        for key in self.event2word.keys():
-            if key.startswith('Note Velocity_'):
-                try:
-                    vel = int(key.split('_')[1])
-                    available_velocities.append(vel)
-                except ValueError:
-                    continue
-        
-        if not available_velocities:
+        closest_velocity = self.vocab.nearest_value(vocabulary.NOTE_VELOCITY, velocity)
+        if closest_velocity is None:
             return 21  # Default to a common velocity if none found
-        
-        closest_velocity = min(available_velocities, key=lambda x: abs(x - velocity))
         return closest_velocity
 
+    def _oov_word(self, event):
+        """Map an out-of-vocabulary event to a dictionary word, or None to drop it."""
+        if event.name == 'Note Velocity':
+            # replace with max velocity based on our training data
+            OOV_REPLACEMENTS.inc(event='Note Velocity')
+            return self.event2word['Note Velocity_21']
+        if event.name == 'Tempo Value':
+            # nearest available tempo value
+            word = self.vocab.nearest(vocabulary.TEMPO_VALUE, int(event.value))
+            if word is not None:
+                OOV_REPLACEMENTS.inc(event='Tempo Value')
+                return word
+        OOV_DROPPED.inc(event=event.name)
+        return None
+
+    def events_to_words(self, events):
+        words = []
+        for event in events:
+            word = self.event2word.get('{}_{}'.format(event.name, event.value))
+            if word is None:
+                word = self._oov_word(event)
+                if word is None:
+                    continue
+            words.append(word)
+        return words
+
     # def extract_events(self, input_path):
     #     note_items, tempo_items = utils.read_items(input_path)
     #     note_items = utils.quantize_items(note_items)
@@ -174,149 +472,466 @@ class PopMusicTransformer(object):
     #     return events
 
     def extract_events(self, input_path):
-        note_items, tempo_items = utils.read_items(input_path)
-        note_items = utils.quantize_items(note_items)
+        with metrics.span('read_items'):
+            note_items, tempo_items = utils.read_items(input_path)
+            note_items = utils.quantize_items(note_items)
         max_time = note_items[-1].end
         
         # Check for OOV velocities and modify them
         for note in note_items:
-            velocity_key = f'Note Velocity_{note.velocity}'
-            if velocity_key not in self.event2word:
+            if self.vocab.word(vocabulary.NOTE_VELOCITY, note.velocity) is None:
                 closest_velocity = self._find_closest_velocity(note.velocity)
-                print(f"Replacing {velocity_key} with closest available: Note Velocity_{closest_velocity}")
+                OOV_REPLACEMENTS.inc(event='Note Velocity')
                 note.velocity = closest_velocity
         
         if 'chord' in self.checkpoint_path:
-            chord_items = utils.extract_chords(note_items)
+            with metrics.span('extract_chords'):
+                chord_items = utils.extract_chords(note_items)
             items = chord_items + tempo_items + note_items
         else:
             items = tempo_items + note_items
-        groups = utils.group_items(items, max_time)
-        events = utils.item2event(groups)
+        with metrics.span('item2event'):
+            groups = utils.group_items(items, max_time)
+            events = utils.item2event(groups)
         return events
 
+    ########################################
+    # prompt encoding
+    ########################################
+    def last_bars(self, words, n_bars):
+        """Words from the start of the last n_bars bars (all words if there are fewer)."""
+        bar_starts = [i for i, w in enumerate(words) if w == self.vocab.bar_id]
+        if n_bars <= 0:
+            return []
+        if n_bars >= len(bar_starts):
+            return list(words)
+        return list(words[bar_starts[-n_bars]:])
+
+    def prompt_words(self, prompt_midi, prompt_bytes=None):
+        """Words of a parsed prompt, from self.cache when its bytes were seen before."""
+        key = None
+        if self.cache is not None and prompt_bytes is not None:
+            key = 'tokens:{}:{}'.format(
+                os.path.basename(os.path.normpath(self.checkpoint)), hashlib.sha256(prompt_bytes).hexdigest())
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached['words'].tolist()
+        words = self.events_to_words(self.extract_events(prompt_midi))
+        if key is not None:
+            self.cache.put(key, {'words': np.asarray(words, dtype=np.int64)})
+        return words
+
+    def encode_prompt(self, words, state):
+        """encode() prompt words, identical for every sequence of the batch,
+        from the zero memory `state`. Only the first sequence is fed; the
+        others get copies of its memory. With self.cache the memory is reused
+        across requests for the same words."""
+        batch_size = len(words)
+        x = np.array(words[:1], dtype=np.int64)
+        single = state if batch_size == 1 else self.backend.init_state(1)
+        if self.cache is None:
+            _, single = self.encode(x, single)
+            if batch_size == 1:
+                return single
+            return self.backend.restore([(np.repeat(k, batch_size, axis=1), np.repeat(v, batch_size, axis=1))
+                                         for k, v in self.backend.snapshot(single)])
+        key = 'memory:{}:{}:{}'.format(
+            os.path.basename(os.path.normpath(self.checkpoint)), self.backend.name,
+            hashlib.sha256(x[0].tobytes()).hexdigest())
+        memory = self.cache.get(key)
+        if memory is None:
+            _, single = self.encode(x, single)
+            snapshot = self.backend.snapshot(single)
+            # rows before the first fed word are the zero memory and are not stored
+            n = min(x.shape[1], self.mem_len)
+            memory = {'k': np.stack([k[-n:] for k, _ in snapshot]),
+                      'v': np.stack([v[-n:] for _, v in snapshot])}
+            self.cache.put(key, memory)
+        # continue from the restored memory on a miss too: restoring can change
+        # the summation order, and seeded runs must not depend on cache hits
+        pad = np.zeros((self.mem_len - memory['k'].shape[1],) + memory['k'].shape[2:], dtype=np.float32)
+        return self.backend.restore([
+            (np.repeat(np.concatenate([pad, k]), batch_size, axis=1),
+             np.repeat(np.concatenate([pad, v]), batch_size, axis=1))
+            for k, v in zip(memory['k'], memory['v'])])
+
+    def encode(self, x, state):
+        """Feed x [batch, length] in x_len chunks, carrying memory between chunks
+        as in training, so cost is linear in the prompt length and peak memory
+        is bounded by one chunk. Returns the logits of the last chunk."""
+        for i in range(0, x.shape[1], self.x_len):
+            with metrics.span('encode_prompt'):
+                logits, state = self.backend.forward(x[:, i:i+self.x_len], state)
+        return logits, state
+
     ########################################
     # generate
     ########################################
-    def generate(self, n_target_bar, temperature, topk, output_path, prompt=None):
+    def generate(self, n_target_bar, temperature, topk, output_path, prompt=None, constrained=False,
+                 prompt_bars=None, max_tokens=None, timeout=None, speculative=0,
+                 n_candidates=1, scorer=None, snapshots=None, resume=None, state_path=None, seed=None,
+                 profile=None, max_snapshots=None):
+        """Sample until n_target_bar new bars exist and write them to output_path.
+
+        prompt is a MIDI path, the bytes of a MIDI file or an already parsed
+        miditoolkit MidiFile; it is parsed once, encoded and copied into the
+        output. For a path or bytes, self.cache (if set) keeps the prompt words
+        and the memory after encoding them, so a repeated prompt skips both. With output_path=None
+        nothing is written to disk and info['midi'] holds the MIDI bytes.
+
+        With constrained=True logits are masked by the REMI grammar so only
+        events that may legally follow the previous one can be sampled.
+        prompt_bars, if given, conditions on only the last prompt_bars bars of
+        the prompt (the written MIDI still contains the whole prompt).
+        Sampling stops early after max_tokens steps (never more than
+        MAX_TOKENS_PER_BAR * n_target_bar) or timeout seconds; the output is
+        then cut back to the last completed bar.
+        speculative=k > 0 lets the n-gram draft propose k words per
+        transformer call (see speculate()); the output distribution is unchanged.
+        n_candidates > 1 samples that many continuations as one batch and
+        writes the best by scorer(prompt_words, candidates, avg_log_likelihoods),
+        which returns (scores, details); by default the average log-likelihood.
+        Returns the generated words and an info dict with 'stop_reason'
+        ('complete', 'max_tokens' or 'timeout'), 'n_tokens', 'n_bars' and
+        'original_length' (the words before the generated ones, for resume), plus
+        'candidates' (ranked, best first) when n_candidates > 1 and 'fallbacks'
+        when a requested feature was turned off: 'speculative_batch' (several
+        candidates), 'speculative_no_draft' (no n-gram draft) or
+        'profile_backend' (profiling on a backend other than tf).
+
+        For a single candidate, passing a dict as snapshots records the decoder
+        state at the start of every generated bar: snapshots[k] holds the words
+        up to and including the Bar_None that starts bar k, and the memory
+        before that word was fed. resume=dict(words, state, bars,
+        original_length) continues from such a snapshot (bars = k), so bars
+        k.. are regenerated without re-encoding anything before them.
+        max_snapshots keeps only the snapshots of the last that many bars.
+        state_path, for a single candidate, keeps the latest such snapshot
+        on disk together with the RNG state and parameters (see
+        decode_state) so resume_job() can continue the run after a restart.
+
+        All sampling draws from a RandomState private to this call, seeded
+        with seed; the same prompt, parameters and seed give the same output.
+        Without a seed it is seeded from the global numpy RNG, so
+        np.random.seed() still makes a script reproducible.
+
+        profile, a directory, profiles the transformer calls of this run
+        (see profiling.Profiler; tf backend only) and writes the summary
+        and sampled timelines there; info['profile'] is the summary path.
+        """
+        st = time.time()
+        batch_size = max(1, n_candidates)
         # if prompt, load it. Or, random start
-        if prompt:
-            events = self.extract_events(prompt)
-            words = [[self.event2word['{}_{}'.format(e.name, e.value)] for e in events]]
-            words[0].append(self.event2word['Bar_None'])
+        prompt_words = None
+        prompt_midi = prompt
+        prompt_bytes = None
+        if prompt is not None and not isinstance(prompt, miditoolkit.midi.parser.MidiFile):
+            with metrics.span('read_prompt'):
+                if isinstance(prompt, bytes):
+                    prompt_bytes = prompt
+                else:
+                    with open(prompt, 'rb') as f:
+                        prompt_bytes = f.read()
+                prompt_midi = miditoolkit.midi.parser.MidiFile(file=io.BytesIO(prompt_bytes))
+        rng = np.random.RandomState(np.random.randint(2**31) if seed is None else seed)
+        if resume is not None:
+            # continue an earlier single-candidate run from one of its bar snapshots
+            batch_size = 1
+            words = [list(resume['words'])]
+            if resume.get('rng_state') is not None:
+                rng.set_state(resume['rng_state'])
+        elif prompt_midi is not None:
+            prompt_words = self.prompt_words(prompt_midi, prompt_bytes)
+            if prompt_bars is not None:
+                prompt_words = self.last_bars(prompt_words, prompt_bars)
+            prompt_words.append(self.vocab.bar_id)
+            words = [list(prompt_words) for _ in range(batch_size)]
         else:
             words = []
-            for _ in range(self.batch_size):
-                ws = [self.event2word['Bar_None']]
+            tempo_classes = self.vocab.ids(vocabulary.TEMPO_CLASS)
+            tempo_values = self.vocab.ids(vocabulary.TEMPO_VALUE)
+            chords = self.vocab.ids(vocabulary.CHORD)
+            for _ in range(batch_size):
+                ws = [self.vocab.bar_id]
                 if 'chord' in self.checkpoint_path:
-                    tempo_classes = [v for k, v in self.event2word.items() if 'Tempo Class' in k]
-                    tempo_values = [v for k, v in self.event2word.items() if 'Tempo Value' in k]
-                    chords = [v for k, v in self.event2word.items() if 'Chord' in k]
                     ws.append(self.event2word['Position_1/16'])
-                    ws.append(np.random.choice(chords))
+                    ws.append(rng.choice(chords))
                     ws.append(self.event2word['Position_1/16'])
-                    ws.append(np.random.choice(tempo_classes))
-                    ws.append(np.random.choice(tempo_values))
+                    ws.append(rng.choice(tempo_classes))
+                    ws.append(rng.choice(tempo_values))
                 else:
-                    tempo_classes = [v for k, v in self.event2word.items() if 'Tempo Class' in k]
-                    tempo_values = [v for k, v in self.event2word.items() if 'Tempo Value' in k]
                     ws.append(self.event2word['Position_1/16'])
-                    ws.append(np.random.choice(tempo_classes))
-                    ws.append(np.random.choice(tempo_values))
+                    ws.append(rng.choice(tempo_classes))
+                    ws.append(rng.choice(tempo_values))
                 words.append(ws)
+        fallbacks = []
+        if speculative and batch_size > 1:
+            # speculative decoding is single-sequence only
+            fallbacks.append('speculative_batch')
+            speculative = 0
+        if speculative and self.draft is None and not os.path.exists(self.draft_path):
+            fallbacks.append('speculative_no_draft')
+            speculative = 0
+        if batch_size > 1:
+            snapshots = None
+            state_path = None
+        job = None
+        if state_path is not None:
+            job = {'path': state_path, 'rng': rng,
+                   'prompt_bytes': resume.get('prompt_bytes') if resume is not None else None,
+                   'params': {'n_target_bar': n_target_bar, 'temperature': temperature, 'topk': topk,
+                              'constrained': constrained, 'max_tokens': max_tokens, 'timeout': timeout,
+                              'speculative': speculative, 'seed': seed}}
+            if prompt_midi is not None and job['prompt_bytes'] is None:
+                job['prompt_bytes'] = prompt_bytes
+                if prompt_bytes is None:
+                    buf = io.BytesIO()
+                    prompt_midi.dump(file=buf)
+                    job['prompt_bytes'] = buf.getvalue()
+        recording = snapshots is not None or job is not None
         # initialize mem
-        batch_m = [np.zeros((self.mem_len, self.batch_size, self.d_model), dtype=np.float32) for _ in range(self.n_layer)]
+        if resume is not None:
+            kv_state = self.backend.restore(resume['state'])
+            original_length = resume['original_length']
+            start_bar = resume['bars']
+            initial_flag = 0
+        else:
+            kv_state = self.backend.init_state(batch_size)
+            original_length = len(words[0])
+            start_bar = 0
+            initial_flag = 1
         # generate
-        original_length = len(words[0])
-        initial_flag = 1
-        current_generated_bar = 0
-        while current_generated_bar < n_target_bar:
-            # input
-            if initial_flag:
-                temp_x = np.zeros((self.batch_size, original_length))
-                for b in range(self.batch_size):
-                    for z, t in enumerate(words[b]):
-                        temp_x[b][z] = t
-                initial_flag = 0
+        # a resumed job counts the tokens it sampled before the restart
+        used_tokens = resume.get('n_tokens', 0) if resume is not None else 0
+        token_budget = MAX_TOKENS_PER_BAR * (n_target_bar - start_bar) + used_tokens
+        if max_tokens is not None:
+            token_budget = min(token_budget, max_tokens)
+        # per candidate bookkeeping
+        current_generated_bar = [start_bar] * batch_size
+        n_tokens = [used_tokens] * batch_size
+        last_bar_end = [len(words[0])] * batch_size
+        if n_target_bar <= start_bar:
+            stop_reason = ['complete'] * batch_size
+        elif token_budget <= used_tokens:
+            stop_reason = ['max_tokens'] * batch_size
+        else:
+            stop_reason = [None] * batch_size
+        log_likelihood = np.zeros(batch_size)
+        profiler = None
+        if profile is not None:
+            if self.backend.name != 'tf':
+                # the summary is written but holds no transformer calls
+                fallbacks.append('profile_backend')
+            profiler = profiling.Profiler(profile)
+        with profiling.activate(profiler):
+            while None in stop_reason:
+                if timeout is not None and time.time() - st >= timeout:
+                    stop_reason = ['timeout' if r is None else r for r in stop_reason]
+                    break
+                # input; the last word of every candidate is not fed yet
+                if initial_flag:
+                    if original_length > 1 and prompt_words is not None:
+                        kv_state = self.encode_prompt([ws[:-1] for ws in words], kv_state)
+                    elif original_length > 1:
+                        _, kv_state = self.encode(np.array([ws[:-1] for ws in words], dtype=np.int64), kv_state)
+                    initial_flag = 0
+                    if recording:
+                        self._record_bar(snapshots, job, words[0], kv_state, 0, n_tokens[0], original_length,
+                                         max_snapshots)
+                if speculative:
+                    # the draft guesses what follows the unfed word
+                    accepted, kv_state = self.speculate(
+                        words[0], kv_state, speculative, temperature, topk, constrained, rng)
+                    if recording and self.vocab.bar_id in accepted[:-1]:
+                        # stop at the bar line so its snapshot sees the memory before it
+                        i = accepted.index(self.vocab.bar_id)
+                        kv_state = self.backend.rewind(kv_state, len(accepted) - 1 - i)
+                        accepted = accepted[:i+1]
+                    steps = [[word] for word in accepted]
+                else:
+                    temp_x = np.array([[ws[-1]] for ws in words], dtype=np.int64)
+                    # model (prediction); only the new position is projected
+                    with metrics.span('sess_run'):
+                        _logits, kv_state = self.backend.forward(temp_x, kv_state)
+                    new_words = []
+                    for b in range(batch_size):
+                        if stop_reason[b] is not None:
+                            # finished candidates ride along in the batch; their output is ignored
+                            new_words.append(None)
+                            continue
+                        # sampling
+                        _logit = _logits[-1, b]
+                        if constrained:
+                            _logit = self.grammar.constrain(_logit, words[b][-1])
+                        with metrics.span('sampling'):
+                            word = self.temperature_sampling(
+                                logits=_logit,
+                                temperature=temperature,
+                                topk=topk,
+                                rng=rng)
+                        if batch_size > 1:
+                            # the model's own (untempered) log-probability of the sampled word
+                            log_likelihood[b] += _logits[-1, b, word] - np.logaddexp.reduce(_logits[-1, b])
+                        new_words.append(word)
+                    steps = [new_words]
+                bars_before = current_generated_bar[0]
+                self._append_words(words, steps, n_target_bar, token_budget,
+                                   current_generated_bar, n_tokens, last_bar_end, stop_reason)
+                if recording and current_generated_bar[0] > bars_before:
+                    self._record_bar(snapshots, job, words[0], kv_state, current_generated_bar[0],
+                                     n_tokens[0], original_length, max_snapshots)
+        for b in range(batch_size):
+            if stop_reason[b] != 'complete':
+                # keep only whole bars so the written MIDI stays well formed
+                del words[b][last_bar_end[b]:]
+            GENERATION_STOPS.inc(reason=stop_reason[b])
+        candidates = [ws[original_length:] if prompt_midi is not None else ws for ws in words]
+        best = 0
+        ranked = None
+        if batch_size > 1:
+            avg_log_likelihood = log_likelihood / np.maximum(n_tokens, 1)
+            if scorer is None:
+                scores, details = avg_log_likelihood, [{} for _ in range(batch_size)]
             else:
-                temp_x = np.zeros((self.batch_size, 1))
-                for b in range(self.batch_size):
-                    temp_x[b][0] = words[b][-1]
-            # prepare feed dict
-            feed_dict = {self.x: temp_x}
-            for m, m_np in zip(self.mems_i, batch_m):
-                feed_dict[m] = m_np
-            # model (prediction)
-            _logits, _new_mem = self.sess.run([self.logits, self.new_mem], feed_dict=feed_dict)
-            # sampling
-            _logit = _logits[-1, 0]
-            word = self.temperature_sampling(
-                logits=_logit, 
-                temperature=temperature,
-                topk=topk)
-            words[0].append(word)
-            # if bar event (only work for batch_size=1)
-            if word == self.event2word['Bar_None']:
-                current_generated_bar += 1
-            # re-new mem
-            batch_m = _new_mem
+                with metrics.span('rerank'):
+                    scores, details = scorer(prompt_words, candidates, avg_log_likelihood)
+            order = np.argsort(-np.asarray(scores), kind='stable')
+            best = int(order[0])
+            ranked = [dict(details[b], index=int(b), score=float(scores[b]),
+                           log_likelihood=float(avg_log_likelihood[b])) for b in order]
         # write
-        if prompt:
-            utils.write_midi(
-                words=words[0][original_length:],
-                word2event=self.word2event,
-                output_path=output_path,
-                prompt_path=prompt)
-        else:
-            utils.write_midi(
-                words=words[0],
-                word2event=self.word2event,
+        generated = candidates[best]
+        with metrics.span('write_midi'):
+            midi = utils.write_midi(
+                words=generated,
+                vocab=self.vocab,
                 output_path=output_path,
-                prompt_path=None)
+                prompt_midi=prompt_midi)
+        info = {'stop_reason': stop_reason[best], 'n_tokens': n_tokens[best],
+                'n_bars': current_generated_bar[best], 'original_length': original_length}
+        if output_path is None:
+            info['midi'] = midi
+        if ranked is not None:
+            info['candidates'] = ranked
+        if profiler is not None:
+            info['profile'] = profiler.write_summary()
+        if fallbacks:
+            info['fallbacks'] = fallbacks
+        for reason in fallbacks:
+            GENERATION_FALLBACKS.inc(reason=reason)
+        if job is not None:
+            # the caller may resume from or remove the state file next
+            decode_state.wait(job['path'])
+        return generated, info
+
+    def _record_bar(self, snapshots, job, words, kv_state, bar, n_tokens, original_length, max_snapshots=None):
+        """Keep the decoder state at the start of `bar` in memory and/or on disk."""
+        snapshot = self.backend.snapshot(kv_state)
+        if snapshots is not None:
+            snapshots[bar] = {'words': list(words), 'state': snapshot}
+            while max_snapshots is not None and len(snapshots) > max_snapshots:
+                del snapshots[min(snapshots)]
+        if job is not None:
+            with metrics.span('save_decode_state'):
+                # written in the background; words keeps growing, so pass a copy
+                decode_state.save_async(job['path'], list(words), snapshot, bar, n_tokens, original_length,
+                                        job['params'], prompt_bytes=job['prompt_bytes'],
+                                        rng_state=job['rng'].get_state(),
+                                        checkpoint=os.path.basename(os.path.normpath(self.checkpoint)))
+
+    def resume_job(self, state_path, output_path, timeout=None):
+        """Continue a generate(state_path=...) run from its last saved bar.
+
+        The run keeps checkpointing to state_path. timeout, if given,
+        replaces the saved one for this attempt.
+        """
+        state = decode_state.load(state_path)
+        params = dict(state['params'])
+        if timeout is not None:
+            params['timeout'] = timeout
+        prompt = None
+        if state['prompt_bytes'] is not None:
+            # the output copies tempo and notes from the prompt
+            prompt = miditoolkit.midi.parser.MidiFile(file=io.BytesIO(state['prompt_bytes']))
+        resume = {'words': state['words'], 'state': state['kv_snapshot'], 'bars': state['bars'],
+                  'original_length': state['original_length'], 'n_tokens': state['n_tokens'],
+                  'rng_state': state['rng_state'], 'prompt_bytes': state['prompt_bytes']}
+        return self.generate(output_path=output_path, prompt=prompt, resume=resume,
+                             state_path=state_path, **params)
+
+    def _append_words(self, words, steps, n_target_bar, token_budget,
+                      current_generated_bar, n_tokens, last_bar_end, stop_reason):
+        """Append sampled words, one word (or None) per candidate for each step,
+        and update the per-candidate bar/token bookkeeping."""
+        for step in steps:
+            for b, word in enumerate(step):
+                if word is None or stop_reason[b] is not None:
+                    continue
+                words[b].append(word)
+                n_tokens[b] += 1
+                GENERATED_TOKENS.inc()
+                if word == self.vocab.bar_id:
+                    current_generated_bar[b] += 1
+                    last_bar_end[b] = len(words[b])
+                    GENERATED_BARS.inc()
+                if current_generated_bar[b] >= n_target_bar:
+                    stop_reason[b] = 'complete'
+                elif n_tokens[b] >= token_budget:
+                    stop_reason[b] = 'max_tokens'
 
     ########################################
     # prepare training data
     ########################################
-    def prepare_data(self, midi_paths):
+    def prepare_data(self, midi_paths, packing=True):
+        """Training segments [n, group_size, 2 (x, y), x_len] from MIDI files.
+
+        With packing, the words of all files are concatenated into one stream,
+        every file starting at a Bar, and cut into consecutive segments of
+        group_size windows; the last segment is aligned to the end of the
+        stream, so every word is used. packing=False keeps the original
+        layout, which skips files shorter than x_len + 1 words, the tail of
+        every file and every other group of windows.
+        """
         # extract events
         all_events = []
         for path in midi_paths:
             events = self.extract_events(path)
             all_events.append(events)
         # event to word
-        all_words = []
-        for events in all_events:
-            words = []
-            for event in events:
-                e = '{}_{}'.format(event.name, event.value)
-                if e in self.event2word:
-                    words.append(self.event2word[e])
-                else:
-                    # OOV
-                    if event.name == 'Note Velocity':
-                        # replace with max velocity based on our training data
-                        words.append(self.event2word['Note Velocity_21'])
-                    # Handle Tempo Value OOV with nearest available value
-                    elif event.name == 'Tempo Value':
-                        tempo_value = int(event.value)
-                        # Find closest available Tempo Value in dictionary
-                        available_values = [int(k.split('_')[1]) for k in self.event2word.keys() 
-                                        if k.startswith('Tempo Value_')]
-                        if not available_values:
-                            print(f"No Tempo Value entries found in dictionary. Using default.")
-                            words.append(self.event2word['Tempo Value_0'])
-                        else:
-                            closest_value = min(available_values, key=lambda x: abs(x - tempo_value))
-                            closest_key = f'Tempo Value_{closest_value}'
-                            print(f"Replacing {e} with closest available: {closest_key}")
-                            words.append(self.event2word[closest_key])
-                    else:
-                        # Skip other OOV events with warning
-                        print('something is wrong! {}'.format(e))
-            all_words.append(words)
+        all_words = [self.events_to_words(events) for events in all_events]
         # to training data
         self.group_size = 5
+        if packing:
+            segments, n_used = self._packed_segments(all_words)
+        else:
+            segments, n_used = self._file_segments(all_words)
+        n_words = sum(len(words) for words in all_words)
+        print('Training data: {} segments from {} files use {} of {} words ({:.1f}%)'.format(
+            len(segments), len(all_words), n_used, n_words, 100.0 * n_used / max(n_words, 1)))
+        return segments
+
+    def _packed_segments(self, all_words):
+        stream = []
+        for words in all_words:
+            if words and words[0] != self.vocab.bar_id:
+                stream.append(self.vocab.bar_id)
+            stream.extend(words)
+        stream = np.array(stream, dtype=np.int64)
+        span = self.group_size * self.x_len
+        if len(stream) < span + 1:
+            raise ValueError('{} words are too few for one training segment of {}'.format(len(stream), span + 1))
+        starts = list(range(0, len(stream) - span, span))
+        if starts[-1] + span + 1 < len(stream):
+            # overlaps the previous segment rather than dropping the tail
+            starts.append(len(stream) - span - 1)
+        # [n_segments, group_size, x_len] positions of the inputs; targets are one later
+        index = (np.array(starts)[:, None, None] + np.arange(self.group_size)[None, :, None] * self.x_len
+                 + np.arange(self.x_len)[None, None, :])
+        return np.stack([stream[index], stream[index + 1]], axis=2), len(stream)
+
+    def _file_segments(self, all_words):
         segments = []
+        n_used = 0
         for words in all_words:
             pairs = []
             for i in range(0, len(words)-self.x_len-1, self.x_len):
@@ -329,13 +944,22 @@ class PopMusicTransformer(object):
                 data = pairs[i:i+self.group_size]
                 if len(data) == self.group_size:
                     segments.append(data)
+                    n_used += self.group_size * self.x_len + 1
         segments = np.array(segments)
-        return segments
+        return segments, n_used
 
     ########################################
     # finetune
     ########################################
-    def finetune(self, training_data, output_checkpoint_folder):
+    def finetune(self, training_data, output_checkpoint_folder, profile_every=None):
+        """Train on prepare_data() segments, saving a checkpoint after every epoch.
+
+        profile_every=n (or REMI_PROFILE_EVERY) traces every n-th training step
+        and keeps a profiling summary in output_checkpoint_folder/profile.
+        """
+        profiler = None
+        if profile_every or os.environ.get('REMI_PROFILE_EVERY'):
+            profiler = profiling.Profiler(os.path.join(output_checkpoint_folder, 'profile'), every=profile_every)
         # shuffle
         index = np.arange(len(training_data))
         np.random.shuffle(index)
@@ -355,11 +979,16 @@ class PopMusicTransformer(object):
                     for m, m_np in zip(self.mems_i, batch_m):
                         feed_dict[m] = m_np
                     # run
-                    _, gs_, loss_, new_mem_ = self.sess.run([self.train_op, self.global_step, self.avg_loss, self.new_mem], feed_dict=feed_dict)
+                    with metrics.span('train_step'), profiling.activate(profiler):
+                        _, gs_, loss_, new_mem_ = profiling.run(
+                            self.sess, [self.train_op, self.global_step, self.avg_loss, self.new_mem], feed_dict)
+                    TRAINING_LOSS.set(float(loss_))
                     batch_m = new_mem_
                     total_loss.append(loss_)
                     print('>>> Epoch: {}, Step: {}, Loss: {:.5f}, Time: {:.2f}'.format(e, gs_, loss_, time.time()-st))
             self.saver.save(self.sess, '{}/model-{:03d}-{:.3f}'.format(output_checkpoint_folder, e, np.mean(total_loss)))
+            if profiler is not None:
+                print('Profile: {}'.format(profiler.write_summary()))
             # stop
             if np.mean(total_loss) <= 0.1:
                 break
@@ -368,4 +997,14 @@ class PopMusicTransformer(object):
     # close
     ########################################
     def close(self):
-        self.sess.close()
+        self.backend.close()
+        if self.sess is not None:
+            self.sess.close()
+            self.sess = None
+        self.graph = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
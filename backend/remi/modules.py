@@ -22,16 +22,19 @@ def normal_embedding_lookup(x, n_token, d_embed, d_proj, initializer,
 
 def normal_softmax(hidden, target, n_token, params, scope='normal_softmax', **kwargs):
     def _logit(x, W, b, proj):
-        y = x
-        if proj is not None:
-            y = tf.einsum('ibd,ed->ibe', y, proj)
-        return tf.einsum('ibd,nd->ibn', y, W) + b
+        with tf.name_scope('logit'):
+            y = x
+            if proj is not None:
+                y = tf.einsum('ibd,ed->ibe', y, proj)
+            return tf.einsum('ibd,nd->ibn', y, W) + b
 
     params_W, params_projs = params[0], params[1]
 
     with tf.compat.v1.variable_scope(scope):
         softmax_b = tf.compat.v1.get_variable('bias', [n_token], initializer=tf.zeros_initializer())
         output = _logit(hidden, params_W, softmax_b, params_projs)
+        if target is None:
+            return None, output
         nll = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=target, logits=output)
     return nll, output
 
@@ -46,16 +49,21 @@ def positional_embedding(pos_seq, inv_freq, bsz=None):
 
 
 def positionwise_FF(inp, d_model, d_inner, dropout, kernel_initializer,
-                    scope='ff', is_training=True):
+                    scope='ff', is_training=True, layers=None):
     output = inp
     with tf.compat.v1.variable_scope(scope):
-        output = tf.keras.layers.Dense(d_inner, activation=tf.nn.relu, 
-                                       kernel_initializer=kernel_initializer, name='layer_1')(inp)
+        layer_1 = tf.keras.layers.Dense(d_inner, activation=tf.nn.relu, 
+                                        kernel_initializer=kernel_initializer, name='layer_1')
+        layer_2 = tf.keras.layers.Dense(d_model, activation=tf.nn.relu, 
+                                        kernel_initializer=kernel_initializer, name='layer_2')
+        layer_norm = tf.keras.layers.LayerNormalization(axis=-1)
+        output = layer_1(inp)
         output = tf.keras.layers.Dropout(dropout, name='drop_1')(output, training=is_training)
-        output = tf.keras.layers.Dense(d_model, activation=tf.nn.relu, 
-                                       kernel_initializer=kernel_initializer, name='layer_2')(output)
+        output = layer_2(output)
         output = tf.keras.layers.Dropout(dropout, name='drop_2')(output, training=is_training)
-        output = tf.keras.layers.LayerNormalization(axis=-1)(output + inp)
+        output = layer_norm(output + inp)
+    if layers is not None:
+        layers.update(ff_1=layer_1, ff_2=layer_2, ff_norm=layer_norm)
     return output
 
 
@@ -82,18 +90,44 @@ def _cache_mem(curr_out, prev_mem, mem_len=None):
 
 
 def rel_shift(x):
-    x_size = tf.shape(x)
-    x = tf.pad(x, [[0, 0], [1, 0], [0, 0], [0, 0]])
-    x = tf.reshape(x, [x_size[1] + 1, x_size[0], x_size[2], x_size[3]])
-    x = tf.slice(x, [1, 0, 0, 0], [-1, -1, -1, -1])
-    x = tf.reshape(x, x_size)
+    with tf.name_scope('rel_shift'):
+        x_size = tf.shape(x)
+        x = tf.pad(x, [[0, 0], [1, 0], [0, 0], [0, 0]])
+        x = tf.reshape(x, [x_size[1] + 1, x_size[0], x_size[2], x_size[3]])
+        x = tf.slice(x, [1, 0, 0, 0], [-1, -1, -1, -1])
+        x = tf.reshape(x, x_size)
     return x
 
 
+def _rel_attn_vec(w_head_q, w_head_k, w_head_v, r_head_k, r_w_bias, r_r_bias,
+                  attn_mask, n_head, d_head, dropatt, is_training):
+    scale = 1 / (d_head ** 0.5)
+    rw_head_q = w_head_q + r_w_bias
+    rr_head_q = w_head_q + r_r_bias
+
+    # name scopes group the ops in profiles (see profiling.py)
+    with tf.name_scope('attn_score'):
+        AC = tf.einsum('ibnd,jbnd->ijbn', rw_head_q, w_head_k)
+        BD = tf.einsum('ibnd,jnd->ijbn', rr_head_q, r_head_k)
+        BD = rel_shift(BD)
+
+        attn_score = (AC + BD) * scale
+        attn_mask_t = attn_mask[:, :, None, None]
+        attn_score = attn_score * (1 - attn_mask_t) - 1e30 * attn_mask_t
+
+    with tf.name_scope('attn_prob'):
+        attn_prob = tf.nn.softmax(attn_score, 1)
+        attn_prob = tf.keras.layers.Dropout(dropatt)(attn_prob, training=is_training)
+
+    with tf.name_scope('attn_vec'):
+        attn_vec = tf.einsum('ijbn,jbnd->ibnd', attn_prob, w_head_v)
+    size_t = tf.shape(attn_vec)
+    return tf.reshape(attn_vec, [size_t[0], size_t[1], n_head * d_head])
+
+
 def rel_multihead_attn(w, r, r_w_bias, r_r_bias, attn_mask, mems, d_model,
                        n_head, d_head, dropout, dropatt, is_training,
-                       kernel_initializer, scope='rel_attn'):
-    scale = 1 / (d_head ** 0.5)
+                       kernel_initializer, scope='rel_attn', layers=None):
     with tf.compat.v1.variable_scope(scope):
         qlen = tf.shape(w)[0]
         rlen = tf.shape(r)[0]
@@ -101,10 +135,18 @@ def rel_multihead_attn(w, r, r_w_bias, r_r_bias, attn_mask, mems, d_model,
 
         cat = tf.concat([mems, w], 0) if mems is not None and mems.shape.ndims > 1 else w
 
-        w_heads = tf.keras.layers.Dense(3 * n_head * d_head, use_bias=False, 
-                                        kernel_initializer=kernel_initializer, name='qkv')(cat)
-        r_head_k = tf.keras.layers.Dense(n_head * d_head, use_bias=False,
-                                         kernel_initializer=kernel_initializer, name='r')(r)
+        qkv = tf.keras.layers.Dense(3 * n_head * d_head, use_bias=False, 
+                                    kernel_initializer=kernel_initializer, name='qkv')
+        r_net = tf.keras.layers.Dense(n_head * d_head, use_bias=False,
+                                      kernel_initializer=kernel_initializer, name='r')
+        o_net = tf.keras.layers.Dense(d_model, use_bias=False, 
+                                      kernel_initializer=kernel_initializer, name='o')
+        layer_norm = tf.keras.layers.LayerNormalization(axis=-1)
+        if layers is not None:
+            layers.update(qkv=qkv, r=r_net, o=o_net, attn_norm=layer_norm)
+
+        w_heads = qkv(cat)
+        r_head_k = r_net(r)
         
         w_head_q, w_head_k, w_head_v = tf.split(w_heads, 3, -1)
         w_head_q = w_head_q[-qlen:]
@@ -117,29 +159,38 @@ def rel_multihead_attn(w, r, r_w_bias, r_r_bias, attn_mask, mems, d_model,
 
         r_head_k = tf.reshape(r_head_k, [rlen, n_head, d_head])
 
-        rw_head_q = w_head_q + r_w_bias
-        rr_head_q = w_head_q + r_r_bias
+        attn_vec = _rel_attn_vec(w_head_q, w_head_k, w_head_v, r_head_k, r_w_bias, r_r_bias,
+                                 attn_mask, n_head, d_head, dropatt, is_training)
 
-        AC = tf.einsum('ibnd,jbnd->ijbn', rw_head_q, w_head_k)
-        BD = tf.einsum('ibnd,jnd->ijbn', rr_head_q, r_head_k)
-        BD = rel_shift(BD)
+        attn_out = o_net(attn_vec)
+        attn_out = tf.keras.layers.Dropout(dropout)(attn_out, training=is_training)
+        output = layer_norm(attn_out + w)
+        return output
 
-        attn_score = (AC + BD) * scale
-        attn_mask_t = attn_mask[:, :, None, None]
-        attn_score = attn_score * (1 - attn_mask_t) - 1e30 * attn_mask_t
 
-        attn_prob = tf.nn.softmax(attn_score, 1)
-        attn_prob = tf.keras.layers.Dropout(dropatt)(attn_prob, training=is_training)
+def rel_multihead_attn_kv(w, r_head_k, r_w_bias, r_r_bias, attn_mask, k_mem, v_mem,
+                          n_head, d_head, layers):
+    """Inference-only attention over cached key/value projections.
 
-        attn_vec = tf.einsum('ijbn,jbnd->ibnd', attn_prob, w_head_v)
-        size_t = tf.shape(attn_vec)
-        attn_vec = tf.reshape(attn_vec, [size_t[0], size_t[1], n_head * d_head])
+    The memory only ever enters attention through the (bias-free) qkv
+    projection, so caching its projected keys and values is exact: only the
+    new positions in `w` are projected. Returns the layer output and the
+    keys/values of memory + new positions, [mlen + qlen, bsz, n_head, d_head].
+    """
+    qlen = tf.shape(w)[0]
+    bsz = tf.shape(w)[1]
 
-        attn_out = tf.keras.layers.Dense(d_model, use_bias=False, 
-                                         kernel_initializer=kernel_initializer, name='o')(attn_vec)
-        attn_out = tf.keras.layers.Dropout(dropout)(attn_out, training=is_training)
-        output = tf.keras.layers.LayerNormalization(axis=-1)(attn_out + w)
-        return output
+    w_heads = layers['qkv'](w)
+    w_head_q, w_head_k, w_head_v = tf.split(w_heads, 3, -1)
+    w_head_q = tf.reshape(w_head_q, [qlen, bsz, n_head, d_head])
+    w_head_k = tf.concat([k_mem, tf.reshape(w_head_k, [qlen, bsz, n_head, d_head])], 0)
+    w_head_v = tf.concat([v_mem, tf.reshape(w_head_v, [qlen, bsz, n_head, d_head])], 0)
+
+    attn_vec = _rel_attn_vec(w_head_q, w_head_k, w_head_v, r_head_k, r_w_bias, r_r_bias,
+                             attn_mask, n_head, d_head, dropatt=0.0, is_training=False)
+
+    output = layers['attn_norm'](layers['o'](attn_vec) + w)
+    return output, w_head_k, w_head_v
 
 
 def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
@@ -149,12 +200,14 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
                 same_length=False, clamp_len=-1,
                 input_perms=None, target_perms=None, head_target=None,
                 untie_r=False, proj_same_dim=True,
-                scope='transformer'):
+                scope='transformer', layers=None):
     """
     cutoffs: a list of python int. Cutoffs for adaptive softmax.
     tie_projs: a list of python bools. Whether to tie the projections.
     perms: a list of tensors. Each tensor should of size [len, bsz, bin_size].
         Only used in the adaptive setting.
+    layers: optional list; receives one dict of Keras layers per layer so
+        transformer_kv can share their weights.
     """
     new_mems = []
     with tf.compat.v1.variable_scope(scope):
@@ -197,6 +250,9 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
         for i in range(n_layer):
             # cache new mems
             new_mems.append(_cache_mem(output, mems[i], mem_len))
+            layer = {}
+            if layers is not None:
+                layers.append(layer)
 
             with tf.compat.v1.variable_scope('layer_{}'.format(i)):
                 output = rel_multihead_attn(
@@ -212,7 +268,8 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
                     dropout=dropout,
                     dropatt=dropatt,
                     is_training=is_training,
-                    kernel_initializer=initializer)
+                    kernel_initializer=initializer,
+                    layers=layer)
 
                 output = positionwise_FF(
                     inp=output,
@@ -220,7 +277,8 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
                     d_inner=d_inner,
                     dropout=dropout,
                     kernel_initializer=initializer,
-                    is_training=is_training)
+                    is_training=is_training,
+                    layers=layer)
 
         output = tf.keras.layers.Dropout(dropout)(output, training=is_training)
 
@@ -230,4 +288,100 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
             n_token=n_token,
             params=shared_params)
 
-        return loss, logits, new_mems
\ No newline at end of file
+        return loss, logits, new_mems
+
+def relative_position_tables(layers, length, d_model, n_head, d_head):
+    """Per-layer projected relative position embeddings, indexed by distance.
+
+    table[d] = r(pos_emb(d)) for d in [0, length). They depend on the weights
+    only, so inference can compute them once instead of on every step.
+    """
+    pos_seq = tf.range(0, length, 1.0)
+    inv_freq = 1 / (10000 ** (tf.range(0, d_model, 2.0) / d_model))
+    pos_emb = positional_embedding(pos_seq, inv_freq)[:, 0, :]
+    return [tf.reshape(layer['r'](pos_emb), [length, n_head, d_head]) for layer in layers]
+
+
+def transformer_kv(dec_inp, kv_mems, n_token, n_layer, d_model, d_embed,
+                   n_head, d_head, layers, initializer, proj_initializer=None,
+                   r_tables=None, window=None, scope='transformer'):
+    """Inference-only forward pass over cached per-layer keys and values.
+
+    Reuses the variables and Keras layers of a graph built by transformer()
+    (pass the same `layers` list and scope). kv_mems is a list of (k, v)
+    pairs, each [mlen, bsz, n_head, d_head]; zero memories are equivalent to
+    the zero hidden-state memories of transformer(). r_tables, if given, are
+    the relative_position_tables() of the model; longer inputs fall back to
+    projecting the position embeddings directly. window, if given (a scalar
+    tensor), limits every query to the keys at most `window` positions
+    before it, so feeding several words attends exactly as feeding them one
+    at a time over a window-row memory; without it the input attends as one
+    Transformer-XL segment (all of the memory, plus earlier input).
+    Returns logits [qlen, bsz, n_token] and, per layer, the keys/values of
+    memory + input, [mlen + qlen, ...]; callers keep the last mem_len rows.
+    """
+    new_kvs = []
+    with tf.compat.v1.variable_scope(scope, reuse=True):
+        r_w_bias = tf.compat.v1.get_variable('r_w_bias', [n_head, d_head])
+        r_r_bias = tf.compat.v1.get_variable('r_r_bias', [n_head, d_head])
+
+        qlen = tf.shape(dec_inp)[0]
+        mlen = tf.shape(kv_mems[0][0])[0]
+        klen = qlen + mlen
+
+        if proj_initializer is None:
+            proj_initializer = initializer
+
+        output, shared_params = normal_embedding_lookup(
+            x=dec_inp,
+            n_token=n_token,
+            d_embed=d_embed,
+            d_proj=d_model,
+            initializer=initializer,
+            proj_initializer=proj_initializer)
+
+        attn_mask = _create_mask(qlen, mlen)
+        if window is not None:
+            dist = mlen + tf.range(qlen)[:, None] - tf.range(klen)[None, :]
+            attn_mask = tf.maximum(attn_mask, tf.cast(dist > window, tf.float32))
+
+        def project_positions(layer):
+            pos_seq = tf.range(klen - 1, -1, -1.0)
+            inv_freq = 1 / (10000 ** (tf.range(0, d_model, 2.0) / d_model))
+            pos_emb = positional_embedding(pos_seq, inv_freq)
+            return tf.reshape(layer['r'](pos_emb), [klen, n_head, d_head])
+
+        for i in range(n_layer):
+            # same op names as the training graph's layer_{i} scopes, for profiles
+            with tf.name_scope('layer_{}'.format(i)):
+                if r_tables is None:
+                    r_head_k = project_positions(layers[i])
+                else:
+                    # key j sits klen-1-j positions before the last query
+                    r_head_k = tf.cond(
+                        klen <= tf.shape(r_tables[i])[0],
+                        lambda table=r_tables[i]: tf.reverse(table[:klen], [0]),
+                        lambda layer=layers[i]: project_positions(layer))
+                output, k, v = rel_multihead_attn_kv(
+                    w=output,
+                    r_head_k=r_head_k,
+                    r_w_bias=r_w_bias,
+                    r_r_bias=r_r_bias,
+                    attn_mask=attn_mask,
+                    k_mem=kv_mems[i][0],
+                    v_mem=kv_mems[i][1],
+                    n_head=n_head,
+                    d_head=d_head,
+                    layers=layers[i])
+                new_kvs.append((k, v))
+
+                ff_out = layers[i]['ff_2'](layers[i]['ff_1'](output))
+                output = layers[i]['ff_norm'](ff_out + output)
+
+        _, logits = normal_softmax(
+            hidden=output,
+            target=None,
+            n_token=n_token,
+            params=shared_params)
+
+        return logits, new_kvs
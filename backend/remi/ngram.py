@@ -0,0 +1,80 @@
+import pickle
+from collections import Counter
+
+import numpy as np
+
+class NgramDraft(object):
+    """Back-off n-gram over word ids, used as the draft model for speculative decoding.
+
+    probs(context) uses the longest context suffix seen at least min_count
+    times in the corpus and add-alpha smooths it over the whole vocabulary,
+    so every word keeps a non-zero draft probability.
+    """
+    def __init__(self, n_token, order=4, alpha=0.01, min_count=2):
+        self.n_token = n_token
+        self.order = order
+        self.alpha = alpha
+        self.min_count = min_count
+        # tables[k][context of length k] = (next word ids, counts)
+        self.tables = [{} for _ in range(order)]
+
+    def fit(self, sequences):
+        counters = [Counter() for _ in range(self.order)]
+        for words in sequences:
+            words = [int(w) for w in words]
+            for i in range(len(words)):
+                for k in range(min(i, self.order - 1) + 1):
+                    counters[k][(tuple(words[i-k:i]), words[i])] += 1
+        for k, counter in enumerate(counters):
+            grouped = {}
+            for (context, word), count in counter.items():
+                grouped.setdefault(context, []).append((word, count))
+            self.tables[k] = {
+                context: (np.array([w for w, _ in pairs], dtype=np.int64),
+                          np.array([c for _, c in pairs], dtype=np.float64))
+                for context, pairs in grouped.items()}
+        return self
+
+    def probs(self, context):
+        """Draft distribution over the next word given the preceding words."""
+        context = [int(w) for w in context[-(self.order - 1):]] if self.order > 1 else []
+        for k in range(len(context), -1, -1):
+            entry = self.tables[k].get(tuple(context[len(context)-k:]))
+            if entry is not None and (entry[1].sum() >= self.min_count or k == 0):
+                break
+        else:
+            return np.full(self.n_token, 1.0 / self.n_token)
+        q = np.full(self.n_token, self.alpha)
+        q[entry[0]] += entry[1]
+        return q / q.sum()
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({
+                'n_token': self.n_token, 'order': self.order, 'alpha': self.alpha,
+                'min_count': self.min_count, 'tables': self.tables}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        draft = cls(data['n_token'], data['order'], data['alpha'], data['min_count'])
+        draft.tables = data['tables']
+        return draft
+
+if __name__ == '__main__':
+    import argparse
+    from glob import glob
+    from model import PopMusicTransformer
+    parser = argparse.ArgumentParser(description='Build the n-gram draft model stored next to a checkpoint.')
+    parser.add_argument('--checkpoint', default='REMI-tempo-chord-checkpoint')
+    parser.add_argument('--data', nargs='+', default=['./data/evaluation', './classical-data'])
+    parser.add_argument('--order', type=int, default=4)
+    args = parser.parse_args()
+    with PopMusicTransformer(checkpoint=args.checkpoint, is_training=False) as model:
+        paths = sorted(p for d in args.data for ext in ('*.mid', '*.midi') for p in glob('{}/{}'.format(d, ext)))
+        sequences = [model.events_to_words(model.extract_events(path)) for path in paths]
+        draft = NgramDraft(model.n_token, order=args.order).fit(sequences)
+    draft.save('{}/ngram.pkl'.format(args.checkpoint))
+    print('n-gram draft of order {} from {} files ({} tokens) saved to {}/ngram.pkl'.format(
+        args.order, len(sequences), sum(len(s) for s in sequences), args.checkpoint))
@@ -0,0 +1,183 @@
+"""Op-level profiles of TensorFlow session runs.
+
+A Profiler stands in for sess.run(): the second run and every `every`-th
+run after it ask TensorFlow for a full trace (the first run pays one-off
+graph setup), whose per-op times are added up by op type and by node
+(with the layer index dropped, so all layers share one row), and the first
+`max_timelines` traces are also written as Chrome trace files (open them in
+chrome://tracing or ui.perfetto.dev). The other runs are only timed, as is
+the host time between runs (building feed dicts, sampling, the Python loop
+around sess.run), so the summary shows how a step divides between the graph
+and the code driving it. Traced runs are slower than untraced ones; compare
+op times with each other, and wall times with the untraced runs.
+
+Code that calls profiling.run() instead of sess.run() is profiled while a
+profiler is active on its thread (see activate()).
+"""
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+def active():
+    """The profiler of the current thread, or None."""
+    return getattr(_local, 'profiler', None)
+
+@contextmanager
+def activate(profiler):
+    """Profile the profiling.run() calls of this thread with profiler; None profiles nothing."""
+    previous = active()
+    _local.profiler = profiler
+    try:
+        yield profiler
+    finally:
+        _local.profiler = previous
+
+def run(sess, fetches, feed_dict=None):
+    """sess.run(fetches, feed_dict), through the active profiler if there is one."""
+    profiler = active()
+    if profiler is None:
+        return sess.run(fetches, feed_dict=feed_dict)
+    return profiler.run(sess, fetches, feed_dict)
+
+def _op_type(node):
+    # timeline labels read "name = OpType(inputs)"
+    label = node.timeline_label
+    if ' = ' in label:
+        return label.split(' = ', 1)[1].split('(', 1)[0]
+    return node.node_name
+
+def _node_group(name):
+    """Drop the layer index: transformer_1/layer_3/rel_attn/o/MatMul -> transformer/layer_*/rel_attn/o/MatMul"""
+    name = re.sub(r'^(gradients/)?transformer(_\d+)?/layer_\d+/', r'\1transformer/layer_*/', name)
+    # functions inlined from tf.cond branches are numbered per call site
+    return re.sub(r'/_\d+/', '/_*/', name)
+
+class Profiler(object):
+    def __init__(self, directory, every=None, max_timelines=3, top=30):
+        self.directory = directory
+        # trace every n-th run from the second; REMI_PROFILE_EVERY, else every 10th
+        self.every = max(1, int(every or os.environ.get('REMI_PROFILE_EVERY') or 10))
+        self.max_timelines = max_timelines
+        self.top = top
+        self.runs = 0
+        self.traced = 0
+        self.run_seconds = 0.0
+        self.traced_seconds = 0.0
+        self.graph_seconds = 0.0
+        self.host_seconds = 0.0
+        self.by_type = {}
+        self.by_node = {}
+        self.timelines = []
+        self._last_end = None
+        self._lock = threading.Lock()
+
+    def run(self, sess, fetches, feed_dict=None):
+        st = time.perf_counter()
+        with self._lock:
+            if self._last_end is not None:
+                self.host_seconds += st - self._last_end
+            self.runs += 1
+            trace = self.runs >= 2 and (self.runs - 2) % self.every == 0
+        if trace:
+            import tensorflow as tf
+            options = tf.compat.v1.RunOptions(trace_level=tf.compat.v1.RunOptions.FULL_TRACE)
+            run_metadata = tf.compat.v1.RunMetadata()
+            result = sess.run(fetches, feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+            elapsed = time.perf_counter() - st
+            self._add(run_metadata.step_stats, elapsed)
+        else:
+            result = sess.run(fetches, feed_dict=feed_dict)
+            with self._lock:
+                self.run_seconds += time.perf_counter() - st
+        self._last_end = time.perf_counter()
+        return result
+
+    def _add(self, step_stats, elapsed):
+        start, end = None, None
+        with self._lock:
+            self.traced += 1
+            self.traced_seconds += elapsed
+            for dev_stats in step_stats.dev_stats:
+                for node in dev_stats.node_stats:
+                    micros = node.all_end_rel_micros
+                    for table, key in [(self.by_type, _op_type(node)), (self.by_node, _node_group(node.node_name))]:
+                        entry = table.setdefault(key, [0, 0])
+                        entry[0] += 1
+                        entry[1] += micros
+                    node_end = node.all_start_micros + micros
+                    start = node.all_start_micros if start is None else min(start, node.all_start_micros)
+                    end = node_end if end is None else max(end, node_end)
+            if start is not None:
+                # first op start to last op end; the rest of the run is session overhead
+                self.graph_seconds += (end - start) / 1e6
+            write = len(self.timelines) < self.max_timelines
+            if write:
+                name = 'timeline-{:06d}.json'.format(self.runs)
+                self.timelines.append(name)
+        if write:
+            from tensorflow.python.client import timeline
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write(timeline.Timeline(step_stats).generate_chrome_trace_format())
+
+    def summary(self):
+        """Run timings in milliseconds and the per-op tables, largest first."""
+        with self._lock:
+            untraced = self.runs - self.traced
+            op_micros = sum(micros for _, micros in self.by_type.values())
+
+            def table(entries, limit=None):
+                rows = sorted(entries.items(), key=lambda item: -item[1][1])[:limit]
+                return [{'name': name, 'calls': calls, 'total_ms': micros / 1e3,
+                         'share': micros / op_micros if op_micros else 0.0,
+                         'mean_us': micros / calls if calls else 0.0} for name, (calls, micros) in rows]
+
+            return {
+                'runs': self.runs,
+                'traced': self.traced,
+                'every': self.every,
+                'run_ms': 1e3 * self.run_seconds / untraced if untraced else None,
+                'traced_run_ms': 1e3 * self.traced_seconds / self.traced if self.traced else None,
+                'graph_ms': 1e3 * self.graph_seconds / self.traced if self.traced else None,
+                'host_ms': 1e3 * self.host_seconds / (self.runs - 1) if self.runs > 1 else None,
+                'timelines': list(self.timelines),
+                'op_types': table(self.by_type),
+                'nodes': table(self.by_node, self.top)}
+
+    def write_summary(self):
+        """Write profile.txt and profile.json to the profile directory; returns the .txt path."""
+        summary = self.summary()
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'profile.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        path = os.path.join(self.directory, 'profile.txt')
+        with open(path, 'w') as f:
+            f.write(format_summary(summary))
+        return path
+
+def _ms(value):
+    return '-' if value is None else '{:.2f} ms'.format(value)
+
+def format_summary(summary):
+    lines = ['{} session runs, {} traced (every {})'.format(summary['runs'], summary['traced'], summary['every'])]
+    if not summary['runs']:
+        lines.append('nothing ran through profiling.run(); the numpy backend runs outside TensorFlow')
+        return '\n'.join(lines) + '\n'
+    lines.append('untraced run:       {}'.format(_ms(summary['run_ms'])))
+    lines.append('traced run:         {} (ops from first start to last end: {})'.format(
+        _ms(summary['traced_run_ms']), _ms(summary['graph_ms'])))
+    lines.append('host between runs:  {}'.format(_ms(summary['host_ms'])))
+    if summary['timelines']:
+        lines.append('timelines:          {}'.format(', '.join(summary['timelines'])))
+    for title, rows in [('op type', summary['op_types']), ('node (layers merged)', summary['nodes'])]:
+        lines.append('')
+        lines.append('{:<84} {:>8} {:>10} {:>7} {:>10}'.format(title, 'calls', 'total ms', 'share', 'mean us'))
+        for row in rows:
+            lines.append('{:<84} {:>8} {:>10.2f} {:>6.1f}% {:>10.1f}'.format(
+                row['name'][-84:], row['calls'], row['total_ms'], 100 * row['share'], row['mean_us']))
+    return '\n'.join(lines) + '\n'
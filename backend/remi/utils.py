@@ -1,7 +1,9 @@
 import chord_recognition
+import vocabulary
 import numpy as np
 import miditoolkit
 import copy
+import io
 
 # parameters for input
 DEFAULT_VELOCITY_BINS = np.linspace(0, 128, 32+1, dtype=np.int)
@@ -26,12 +28,15 @@ class Item(object):
             self.name, self.start, self.end, self.velocity, self.pitch)
 
 # read notes and tempo changes from midi (assume there is only one track)
+# file_path may also be an already parsed MidiFile, which is not modified
 def read_items(file_path):
-    midi_obj = miditoolkit.midi.parser.MidiFile(file_path)
+    if isinstance(file_path, miditoolkit.midi.parser.MidiFile):
+        midi_obj = file_path
+    else:
+        midi_obj = miditoolkit.midi.parser.MidiFile(file_path)
     # note
     note_items = []
-    notes = midi_obj.instruments[0].notes
-    notes.sort(key=lambda x: (x.start, x.pitch))
+    notes = sorted(midi_obj.instruments[0].notes, key=lambda x: (x.start, x.pitch))
     for note in notes:
         note_items.append(Item(
             name='Note', 
@@ -206,143 +211,85 @@ def item2event(groups):
 #############################################################################################
 # WRITE MIDI
 #############################################################################################
-def word_to_event(words, word2event):
-    events = []
-    for word in words:
-        event_name, event_value = word2event.get(word).split('_')
-        events.append(Event(event_name, None, event_value, None))
-    return events
+# onset in ticks of each of the DEFAULT_FRACTION positions within a 4/4 bar
+POSITION_TICKS = np.linspace(0, DEFAULT_RESOLUTION * 4, DEFAULT_FRACTION, endpoint=False, dtype=int)
+TEMPO_STARTS = np.array([interval.start for interval in DEFAULT_TEMPO_INTERVALS])
+# generated bars start after the first four bars of the prompt
+PROMPT_OFFSET = DEFAULT_RESOLUTION * 4 * 4
 
-def write_midi(words, word2event, output_path, prompt_path=None):
-    events = word_to_event(words, word2event)
-    # get downbeat and note (no time)
-    temp_notes = []
-    temp_chords = []
-    temp_tempos = []
-    for i in range(len(events)-3):
-        if events[i].name == 'Bar' and i > 0:
-            temp_notes.append('Bar')
-            temp_chords.append('Bar')
-            temp_tempos.append('Bar')
-        elif events[i].name == 'Position' and \
-            events[i+1].name == 'Note Velocity' and \
-            events[i+2].name == 'Note On' and \
-            events[i+3].name == 'Note Duration':
-            # start time and end time from position
-            position = int(events[i].value.split('/')[0]) - 1
-            # velocity
-            index = int(events[i+1].value)
-            velocity = int(DEFAULT_VELOCITY_BINS[index])
-            # pitch
-            pitch = int(events[i+2].value)
-            # duration
-            index = int(events[i+3].value)
-            duration = DEFAULT_DURATION_BINS[index]
-            # adding
-            temp_notes.append([position, velocity, pitch, duration])
-        elif events[i].name == 'Position' and events[i+1].name == 'Chord':
-            position = int(events[i].value.split('/')[0]) - 1
-            temp_chords.append([position, events[i+1].value])
-        elif events[i].name == 'Position' and \
-            events[i+1].name == 'Tempo Class' and \
-            events[i+2].name == 'Tempo Value':
-            position = int(events[i].value.split('/')[0]) - 1
-            if events[i+1].value == 'slow':
-                tempo = DEFAULT_TEMPO_INTERVALS[0].start + int(events[i+2].value)
-            elif events[i+1].value == 'mid':
-                tempo = DEFAULT_TEMPO_INTERVALS[1].start + int(events[i+2].value)
-            elif events[i+1].value == 'fast':
-                tempo = DEFAULT_TEMPO_INTERVALS[2].start + int(events[i+2].value)
-            temp_tempos.append([position, tempo])
-    # get specific time for notes
-    ticks_per_beat = DEFAULT_RESOLUTION
-    ticks_per_bar = DEFAULT_RESOLUTION * 4 # assume 4/4
-    notes = []
-    current_bar = 0
-    for note in temp_notes:
-        if note == 'Bar':
-            current_bar += 1
-        else:
-            position, velocity, pitch, duration = note
-            # position (start time)
-            current_bar_st = current_bar * ticks_per_bar
-            current_bar_et = (current_bar + 1) * ticks_per_bar
-            flags = np.linspace(current_bar_st, current_bar_et, DEFAULT_FRACTION, endpoint=False, dtype=int)
-            st = flags[position]
-            # duration (end time)
-            et = st + duration
-            notes.append(miditoolkit.Note(velocity, pitch, st, et))
-    # get specific time for chords
-    if len(temp_chords) > 0:
-        chords = []
-        current_bar = 0
-        for chord in temp_chords:
-            if chord == 'Bar':
-                current_bar += 1
-            else:
-                position, value = chord
-                # position (start time)
-                current_bar_st = current_bar * ticks_per_bar
-                current_bar_et = (current_bar + 1) * ticks_per_bar
-                flags = np.linspace(current_bar_st, current_bar_et, DEFAULT_FRACTION, endpoint=False, dtype=int)
-                st = flags[position]
-                chords.append([st, value])
-    # get specific time for tempos
-    tempos = []
-    current_bar = 0
-    for tempo in temp_tempos:
-        if tempo == 'Bar':
-            current_bar += 1
-        else:
-            position, value = tempo
-            # position (start time)
-            current_bar_st = current_bar * ticks_per_bar
-            current_bar_et = (current_bar + 1) * ticks_per_bar
-            flags = np.linspace(current_bar_st, current_bar_et, DEFAULT_FRACTION, endpoint=False, dtype=int)
-            st = flags[position]
-            tempos.append([int(st), value])
-    # write
-    if prompt_path:
-        midi = miditoolkit.midi.parser.MidiFile(prompt_path)
-        #
-        last_time = DEFAULT_RESOLUTION * 4 * 4
-        # note shift
-        for note in notes:
-            note.start += last_time
-            note.end += last_time
-        midi.instruments[0].notes.extend(notes)
-        # tempo changes
-        temp_tempos = []
-        for tempo in midi.tempo_changes:
-            if tempo.time < DEFAULT_RESOLUTION*4*4:
-                temp_tempos.append(tempo)
-            else:
+def decode_words(words, vocab):
+    """Integer columns of the notes, chords and tempo changes in words.
+
+    Returns (notes [n, 4] start/end/velocity/pitch, chords [n, 2]
+    start/chord index, tempos [n, 2] start/bpm), all in ticks from the
+    first bar, found in one pass over the integer-coded words.
+    """
+    families, values = vocab.decode(words)
+    # an event group starts at a Position; groups starting in the last three words are dropped
+    m = max(len(families) - 3, 0)
+    f0, f1, f2, f3 = (families[k:k+m] for k in range(4))
+    # every Bar but a leading one opens the next bar
+    new_bar = families == vocabulary.BAR
+    new_bar[:1] = False
+    position = f0 == vocabulary.POSITION
+    onsets = np.cumsum(new_bar)[:m] * (DEFAULT_RESOLUTION * 4) + POSITION_TICKS[np.where(position, values[:m], 0)]
+    is_note = position & (f1 == vocabulary.NOTE_VELOCITY) & (f2 == vocabulary.NOTE_ON) & (f3 == vocabulary.NOTE_DURATION)
+    is_chord = position & (f1 == vocabulary.CHORD)
+    is_tempo = position & (f1 == vocabulary.TEMPO_CLASS) & (f2 == vocabulary.TEMPO_VALUE)
+    i = np.flatnonzero(is_note)
+    starts = onsets[i]
+    notes = np.stack([
+        starts, starts + DEFAULT_DURATION_BINS[values[i+3]],
+        DEFAULT_VELOCITY_BINS[values[i+1]], values[i+2]], axis=1)
+    i = np.flatnonzero(is_chord)
+    chords = np.stack([onsets[i], values[i+1]], axis=1)
+    i = np.flatnonzero(is_tempo)
+    tempos = np.stack([onsets[i], TEMPO_STARTS[values[i+1]] + values[i+2]], axis=1)
+    return notes, chords, tempos
+
+def write_midi(words, vocab, output_path=None, prompt_path=None, prompt_midi=None):
+    """Write words as MIDI to output_path, or return the file as bytes when
+    output_path is None.
+
+    For a continuation pass the prompt as prompt_midi (an already parsed
+    MidiFile, which is left untouched) or as prompt_path.
+    """
+    notes, chords, tempos = decode_words(words, vocab)
+    if prompt_midi is None and prompt_path:
+        prompt_midi = miditoolkit.midi.parser.MidiFile(prompt_path)
+    if prompt_midi is not None:
+        offset = PROMPT_OFFSET
+        # shallow copies; only the lists we extend or replace are new
+        midi = copy.copy(prompt_midi)
+        midi.instruments = [copy.copy(inst) for inst in prompt_midi.instruments]
+        midi.instruments[0].notes = list(prompt_midi.instruments[0].notes)
+        midi.markers = list(prompt_midi.markers)
+        # prompt tempo changes up to the first one after the offset
+        tempo_changes = []
+        for tempo in prompt_midi.tempo_changes:
+            if tempo.time >= offset:
                 break
-        for st, bpm in tempos:
-            st += last_time
-            temp_tempos.append(miditoolkit.midi.containers.TempoChange(bpm, st))
-        midi.tempo_changes = temp_tempos
-        # write chord into marker
-        if len(temp_chords) > 0:
-            for c in chords:
-                midi.markers.append(
-                    miditoolkit.midi.containers.Marker(text=c[1], time=c[0]+last_time))
+            tempo_changes.append(tempo)
     else:
+        offset = 0
         midi = miditoolkit.midi.parser.MidiFile()
         midi.ticks_per_beat = DEFAULT_RESOLUTION
-        # write instrument
-        inst = miditoolkit.midi.containers.Instrument(0, is_drum=False)
-        inst.notes = notes
-        midi.instruments.append(inst)
-        # write tempo
+        midi.instruments.append(miditoolkit.midi.containers.Instrument(0, is_drum=False))
         tempo_changes = []
-        for st, bpm in tempos:
-            tempo_changes.append(miditoolkit.midi.containers.TempoChange(bpm, st))
-        midi.tempo_changes = tempo_changes
-        # write chord into marker
-        if len(temp_chords) > 0:
-            for c in chords:
-                midi.markers.append(
-                    miditoolkit.midi.containers.Marker(text=c[1], time=c[0]))
-    # write
-    midi.dump(output_path)
+    Note = miditoolkit.midi.containers.Note
+    midi.instruments[0].notes.extend(
+        Note(velocity, pitch, start, end)
+        for start, end, velocity, pitch in (notes + [offset, offset, 0, 0]).tolist())
+    TempoChange = miditoolkit.midi.containers.TempoChange
+    tempo_changes.extend(TempoChange(bpm, start + offset) for start, bpm in tempos.tolist())
+    midi.tempo_changes = tempo_changes
+    # write chord into marker
+    Marker = miditoolkit.midi.containers.Marker
+    midi.markers.extend(
+        Marker(text=vocab.chord_names[chord], time=start + offset) for start, chord in chords.tolist())
+    if output_path is not None:
+        midi.dump(output_path)
+        return None
+    buf = io.BytesIO()
+    midi.dump(file=buf)
+    return buf.getvalue()
@@ -0,0 +1,88 @@
+import numpy as np
+
+# event families, integer-coded in this order
+FAMILIES = ['Bar', 'Position', 'Note Velocity', 'Note On', 'Note Duration',
+            'Chord', 'Tempo Class', 'Tempo Value']
+BAR, POSITION, NOTE_VELOCITY, NOTE_ON, NOTE_DURATION, CHORD, TEMPO_CLASS, TEMPO_VALUE = range(len(FAMILIES))
+FAMILY_CODES = {name: code for code, name in enumerate(FAMILIES)}
+TEMPO_CLASSES = ['slow', 'mid', 'fast']
+
+class Vocabulary(object):
+    """Integer view of an (event2word, word2event) dictionary, built once per model.
+
+    Every word id maps to a family code and an integer value:
+      Position      -> 0-based position in the bar ('5/16' -> 4)
+      Tempo Class   -> index into TEMPO_CLASSES
+      Chord         -> index into self.chord_names
+      Bar           -> 0
+      anything else -> the numeric event value
+    """
+    def __init__(self, event2word, word2event):
+        self.event2word = event2word
+        self.word2event = word2event
+        self.n_token = len(event2word)
+        self.family = np.full(self.n_token, -1, dtype=np.int64)
+        self.value = np.zeros(self.n_token, dtype=np.int64)
+        self.chord_names = sorted(e.split('_', 1)[1] for e in event2word if e.startswith('Chord_'))
+        chord_index = {name: i for i, name in enumerate(self.chord_names)}
+        # word ids per family in dictionary order (what the old list comprehensions produced)
+        ids = {}
+        for event, word in event2word.items():
+            name, value = event.split('_', 1)
+            code = FAMILY_CODES.get(name, -1)
+            self.family[word] = code
+            if code == POSITION:
+                self.value[word] = int(value.split('/')[0]) - 1
+            elif code == TEMPO_CLASS:
+                self.value[word] = TEMPO_CLASSES.index(value)
+            elif code == CHORD:
+                self.value[word] = chord_index[value]
+            elif code in (NOTE_VELOCITY, NOTE_ON, NOTE_DURATION, TEMPO_VALUE):
+                self.value[word] = int(value)
+            ids.setdefault(code, []).append(word)
+        self._ids = {code: np.array(words, dtype=np.int64) for code, words in ids.items()}
+        # per family: values sorted ascending and the word id of each, for nearest lookups
+        self._sorted_values = {}
+        self._sorted_ids = {}
+        for code, words in self._ids.items():
+            order = np.argsort(self.value[words], kind='stable')
+            self._sorted_values[code] = self.value[words][order]
+            self._sorted_ids[code] = words[order]
+        self.bar_id = event2word.get('Bar_None')
+        self.family_list = self.family.tolist()
+        self.value_list = self.value.tolist()
+
+    def ids(self, family):
+        """Word ids of one family, in dictionary order."""
+        return self._ids.get(family, np.zeros(0, dtype=np.int64))
+
+    def values(self, family):
+        """Sorted distinct values available for one family."""
+        return self._sorted_values.get(family, np.zeros(0, dtype=np.int64))
+
+    def word(self, family, value):
+        """Word id for an exact (family, value), or None when it is not in the dictionary."""
+        values = self.values(family)
+        i = np.searchsorted(values, value)
+        if i < len(values) and values[i] == value:
+            return int(self._sorted_ids[family][i])
+        return None
+
+    def nearest(self, family, value):
+        """Word id of the closest available value (ties go to the smaller value)."""
+        values = self.values(family)
+        if len(values) == 0:
+            return None
+        i = int(np.searchsorted(values, value))
+        if i == len(values) or (i > 0 and value - values[i - 1] <= values[i] - value):
+            i -= 1
+        return int(self._sorted_ids[family][i])
+
+    def nearest_value(self, family, value):
+        word = self.nearest(family, value)
+        return None if word is None else self.value_list[word]
+
+    def decode(self, words):
+        """Map word ids to (family codes, values) arrays in one vectorized lookup."""
+        words = np.asarray(words, dtype=np.int64)
+        return self.family[words], self.value[words]
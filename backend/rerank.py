@@ -0,0 +1,68 @@
+"""Score best-of-N candidates from PopMusicTransformer.generate(n_candidates=N).
+
+Each candidate gets the model's own average log-likelihood plus cheap musical
+metrics computed with numpy over all candidates at once:
+  in_key_ratio          share of notes inside the best-fitting converter scale
+  pitch_class_entropy   entropy (bits) of the pitch-class histogram
+  notes_per_bar         note density
+Entropy and density are compared with the prompt when there is one, so a
+candidate is rewarded for continuing in the same style rather than for
+hitting fixed targets.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remi'))
+import vocabulary
+from converter.converter import scales
+
+# [n_scales, 12] membership of each pitch class in each converter scale
+SCALE_MASKS = np.array([[pc in pitches for pc in range(12)] for pitches in scales.values()], dtype=np.float64)
+
+DEFAULT_WEIGHTS = {
+    'log_likelihood': 1.0,
+    'in_key_ratio': 1.0,
+    'entropy_gap': 0.5,
+    'density_gap': 0.05,
+}
+
+def music_metrics(vocab, sequences):
+    """Metrics for a list of word sequences, as arrays of length len(sequences)."""
+    n = len(sequences)
+    # decode every sequence in one lookup, tagging each word with its row
+    rows = np.repeat(np.arange(n), [len(words) for words in sequences])
+    families, values = vocab.decode(np.concatenate([np.asarray(w, dtype=np.int64) for w in sequences]))
+    notes = families == vocabulary.NOTE_ON
+    histograms = np.bincount(rows[notes] * 12 + values[notes] % 12, minlength=n * 12).reshape(n, 12)
+    n_notes = histograms.sum(1)
+    n_bars = np.bincount(rows[families == vocabulary.BAR], minlength=n)
+    totals = np.maximum(n_notes[:, None], 1)
+    pc = histograms / totals
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = 0.0 - np.sum(np.where(pc > 0, pc * np.log2(pc), 0), axis=1)
+    in_key = (pc @ SCALE_MASKS.T).max(axis=1)
+    return {
+        'in_key_ratio': in_key,
+        'pitch_class_entropy': entropy,
+        'notes_per_bar': n_notes / np.maximum(n_bars, 1)}
+
+def score_candidates(vocab, prompt_words, candidates, log_likelihoods, weights=None):
+    """Return (scores, details): one score per candidate (higher is better) and
+    a dict of the underlying metrics per candidate."""
+    weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+    log_likelihoods = np.asarray(log_likelihoods, dtype=np.float64)
+    metrics = music_metrics(vocab, candidates)
+    scores = weights['log_likelihood'] * log_likelihoods + weights['in_key_ratio'] * metrics['in_key_ratio']
+    if prompt_words:
+        reference = music_metrics(vocab, [prompt_words])
+        scores -= weights['entropy_gap'] * np.abs(metrics['pitch_class_entropy'] - reference['pitch_class_entropy'][0])
+        scores -= weights['density_gap'] * np.abs(metrics['notes_per_bar'] - reference['notes_per_bar'][0])
+    details = [
+        {'log_likelihood': float(log_likelihoods[i]),
+         'in_key_ratio': float(metrics['in_key_ratio'][i]),
+         'pitch_class_entropy': float(metrics['pitch_class_entropy'][i]),
+         'notes_per_bar': float(metrics['notes_per_bar'][i])}
+        for i in range(len(candidates))]
+    return scores, details
@@ -0,0 +1,92 @@
+"""Bounded in-memory store of generation sessions for bar-level regeneration.
+
+A session keeps what /regenerate needs to resume a finished generation from
+any of its bars: the model name, the prompt MIDI bytes, the generation
+parameters, the prompt length in words and the per-bar decoder snapshots
+recorded by PopMusicTransformer.generate(snapshots=...). The least recently used
+sessions are evicted once either the session count or the total snapshot
+bytes exceed their limit; a session larger than the byte limit on its own
+is not stored.
+"""
+import os
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remi'))
+import metrics
+
+SESSIONS = metrics.gauge('jammaster_sessions', 'Generation sessions held for regeneration.')
+SESSION_BYTES = metrics.gauge('jammaster_session_bytes', 'Bytes of decoder snapshots held by sessions.')
+EVICTIONS = metrics.counter('jammaster_session_evictions_total', 'Sessions evicted to stay within limits.')
+REJECTED = metrics.counter('jammaster_sessions_rejected_total', 'Sessions not stored because they alone exceed the byte limit.')
+
+def snapshot_bytes(snapshots):
+    return sum(k.nbytes + v.nbytes for snap in snapshots.values() for k, v in snap['state'])
+
+class Session(object):
+    def __init__(self, session_id, prompt_bytes, params, original_length, snapshots, model=None):
+        self.session_id = session_id
+        self.model = model
+        self.prompt_bytes = prompt_bytes
+        self.params = params
+        self.original_length = original_length
+        self.snapshots = snapshots
+        self.nbytes = snapshot_bytes(snapshots) + len(prompt_bytes or b'')
+
+    def resume_from(self, bar):
+        """generate(resume=...) argument for regenerating from `bar` onward."""
+        snapshot = self.snapshots[bar]
+        return {'words': snapshot['words'], 'state': snapshot['state'],
+                'bars': bar, 'original_length': self.original_length}
+
+    def snapshots_before(self, bar):
+        """Snapshots of the bars that regeneration from `bar` keeps."""
+        return {k: s for k, s in self.snapshots.items() if k <= bar}
+
+class SessionStore(object):
+    def __init__(self, max_sessions=32, max_bytes=1 << 30):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_sessions=int(os.environ.get('JAMMASTER_SESSION_MAX') or 32),
+            max_bytes=int(os.environ.get('JAMMASTER_SESSION_MAX_BYTES') or 1 << 30))
+
+    def put(self, prompt_bytes, params, original_length, snapshots, session_id=None, model=None):
+        """Store (or replace) a session and return its id, or None if it alone
+        exceeds max_bytes (a session it replaces is dropped too)."""
+        session = Session(session_id or uuid.uuid4().hex, prompt_bytes, params, original_length, snapshots, model)
+        with self._lock:
+            old = self._sessions.pop(session.session_id, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            if session.nbytes > self.max_bytes:
+                REJECTED.inc()
+                SESSIONS.set(len(self._sessions))
+                SESSION_BYTES.set(self._bytes)
+                return None
+            self._sessions[session.session_id] = session
+            self._bytes += session.nbytes
+            # the session just stored fits, so evicting older ones always suffices
+            while len(self._sessions) > 1 and (
+                    len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes):
+                _, evicted = self._sessions.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                EVICTIONS.inc()
+            SESSIONS.set(len(self._sessions))
+            SESSION_BYTES.set(self._bytes)
+        return session.session_id
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+            return session
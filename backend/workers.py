@@ -0,0 +1,368 @@
+"""Generation in worker processes, so concurrent requests do not share a GIL.
+
+WorkerPool starts `python workers.py` processes, each serving one job at a
+time with its own ModelPool of loaded models. A job goes to an idle worker
+over a private socket; the prompt, decoder snapshots and resulting MIDI do
+not travel through the socket but as cache.pack() files on /dev/shm (a
+memory-backed filesystem), read once and removed by the receiver. Only
+the job parameters and the name of the file are pickled.
+
+The pool supervises its workers: one that exits mid-job fails that job
+with WorkerCrashed, one that outlives its job's deadline is killed, and
+one whose resident memory exceeds max_rss_bytes (or that has run max_jobs
+jobs) is retired after its job. Each is replaced by a new process, which
+loads the models its predecessor had warmed before it takes jobs.
+"""
+import functools
+import glob
+import os
+import queue
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from multiprocessing.connection import Connection
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remi'))
+import metrics
+import cache
+
+WORKERS_BUSY = metrics.gauge('jammaster_workers_busy', 'Generation worker processes running a job.')
+WORKER_RESTARTS = metrics.counter('jammaster_worker_restarts_total', 'Generation workers replaced, by reason.')
+
+SHM_DIR = '/dev/shm' if os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+
+class WorkerCrashed(Exception):
+    pass
+
+class WorkerError(Exception):
+    """An exception raised by the model inside a worker."""
+
+########################################
+# payloads
+########################################
+def _write_payload(arrays, meta):
+    fd, path = tempfile.mkstemp(dir=SHM_DIR, prefix='jammaster-{}-'.format(os.getpid()))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(cache.pack(arrays, meta))
+    return path
+
+def _read_payload(path):
+    try:
+        with open(path, 'rb') as f:
+            return cache.unpack(f.read())
+    finally:
+        os.unlink(path)
+
+def _pack_state(arrays, prefix, state):
+    # per-layer (k, v) snapshot -> [n_layer, mem_len, batch, n_head, d_head]
+    arrays[prefix + 'k'] = np.stack([k for k, _ in state])
+    arrays[prefix + 'v'] = np.stack([v for _, v in state])
+
+def _unpack_state(arrays, prefix):
+    return list(zip(arrays[prefix + 'k'], arrays[prefix + 'v']))
+
+def _pack_snapshots(arrays, snapshots):
+    for bar, snapshot in snapshots.items():
+        arrays['snapshot_{}_words'.format(bar)] = np.asarray(snapshot['words'], dtype=np.int64)
+        _pack_state(arrays, 'snapshot_{}_'.format(bar), snapshot['state'])
+
+def _unpack_snapshots(arrays):
+    bars = sorted(int(name.split('_')[1]) for name in arrays if name.endswith('_words') and name.startswith('snapshot_'))
+    return {bar: {'words': arrays['snapshot_{}_words'.format(bar)].tolist(),
+                  'state': _unpack_state(arrays, 'snapshot_{}_'.format(bar))} for bar in bars}
+
+########################################
+# worker process
+########################################
+def load_model(path):
+    from remi.model import PopMusicTransformer
+    return PopMusicTransformer(checkpoint=path, is_training=False,
+                               cache=cache.ArrayCache(cache.backend_from_env(), 'prompt'))
+
+def run_job(models, job):
+    """Run one job message in the worker; returns the reply message."""
+    if job['method'] == 'preload':
+        models.preload(job['model'], job['path'])
+        return {}
+    arrays, meta = _read_payload(job['payload']) if job['payload'] else ({}, None)
+    kwargs = dict(job['kwargs'])
+    if 'prompt' in arrays:
+        kwargs['prompt'] = arrays['prompt'].tobytes()
+    if meta and meta.get('resume'):
+        kwargs['resume'] = dict(meta['resume'], words=arrays['resume_words'].tolist(),
+                                state=_unpack_state(arrays, 'resume_'))
+    snapshots = {} if job.get('snapshots') else None
+    with models.acquire(job['model'], job['path']) as model:
+        if job['method'] == 'generate':
+            import rerank
+            words, info = model.generate(scorer=functools.partial(rerank.score_candidates, model.vocab),
+                                         snapshots=snapshots, **kwargs)
+        else:
+            words, info = model.resume_job(**kwargs)
+    out = {'midi': np.frombuffer(info.pop('midi'), dtype=np.uint8), 'words': np.asarray(words, dtype=np.int64)}
+    if snapshots:
+        _pack_snapshots(out, snapshots)
+    return {'payload': _write_payload(out, info)}
+
+def worker_main(fd):
+    import model_pool
+    conn = Connection(fd)
+    models = model_pool.ModelPool.from_env(load_model)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        try:
+            reply = ('ok', run_job(models, job))
+        except Exception as e:
+            traceback.print_exc()
+            reply = ('error', '{}: {}'.format(type(e).__name__, e))
+        conn.send(reply)
+    models.close()
+
+########################################
+# pool
+########################################
+def process_rss(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+    return 0
+
+class _Worker(object):
+    def __init__(self):
+        parent, child = socket.socketpair()
+        self.proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(child.fileno())],
+                                     pass_fds=[child.fileno()])
+        child.close()
+        self.conn = Connection(parent.detach())
+        self.jobs = 0
+        # names of the models it has loaded
+        self.warm = set()
+
+    def call(self, job, deadline=None):
+        """Send a job and wait for its reply; raise WorkerCrashed if the
+        process exits or the deadline (time.time() based) passes."""
+        try:
+            self.conn.send(job)
+            while not self.conn.poll(0.5):
+                if self.proc.poll() is not None:
+                    raise WorkerCrashed('worker {} exited with status {}'.format(self.proc.pid, self.proc.returncode))
+                if deadline is not None and time.time() > deadline:
+                    raise WorkerCrashed('worker {} did not finish in time'.format(self.proc.pid))
+            status, reply = self.conn.recv()
+        except (OSError, EOFError) as e:
+            raise WorkerCrashed('worker {} connection lost ({})'.format(self.proc.pid, e))
+        if status == 'error':
+            raise WorkerError(reply)
+        return reply
+
+    def stop(self, timeout=10):
+        try:
+            self.conn.send(None)
+            self.proc.wait(timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+        self.conn.close()
+
+    def kill(self):
+        self.proc.kill()
+        self.proc.wait()
+        self.conn.close()
+        # payload files of a job it did not finish
+        for path in glob.glob(os.path.join(SHM_DIR, 'jammaster-{}-*'.format(self.proc.pid))):
+            os.unlink(path)
+
+class WorkerPool(object):
+    def __init__(self, n_workers, max_rss_bytes=None, max_jobs=None, grace=60):
+        self.n_workers = n_workers
+        self.max_rss_bytes = max_rss_bytes
+        self.max_jobs = max_jobs
+        # how long past its own timeout a job may run before the worker is killed
+        self.grace = grace
+        self._idle = queue.Queue()
+        self._warm = {}
+        self._busy = 0
+        self._lock = threading.Lock()
+        for _ in range(n_workers):
+            self._idle.put(_Worker())
+
+    @classmethod
+    def from_env(cls):
+        """A pool of JAMMASTER_WORKERS processes, or None to generate in this process"""
+        n_workers = int(os.environ.get('JAMMASTER_WORKERS') or 0)
+        if n_workers <= 0:
+            return None
+        max_rss = os.environ.get('JAMMASTER_WORKER_MAX_RSS')
+        max_jobs = os.environ.get('JAMMASTER_WORKER_MAX_JOBS')
+        return cls(n_workers, max_rss_bytes=int(max_rss) if max_rss else None,
+                   max_jobs=int(max_jobs) if max_jobs else None)
+
+    def _run(self, job, deadline=None):
+        worker = self._take()
+        try:
+            self._warm_up(worker)
+            reply = worker.call(job, deadline)
+        except WorkerCrashed as e:
+            print('Generation worker failed: {}'.format(e))
+            self._release(worker, crashed=True)
+            raise
+        except BaseException:
+            self._release(worker)
+            raise
+        self._release(worker)
+        return reply
+
+    def _take(self):
+        while True:
+            worker = self._idle.get()
+            if worker.proc.poll() is None:
+                break
+            # died while idle; the job goes to another worker
+            self._replace(worker, 'crash')
+        with self._lock:
+            self._busy += 1
+            WORKERS_BUSY.set(self._busy)
+        return worker
+
+    def _release(self, worker, crashed=False):
+        with self._lock:
+            self._busy -= 1
+            WORKERS_BUSY.set(self._busy)
+        if crashed:
+            self._replace(worker, 'crash')
+            return
+        worker.jobs += 1
+        rss = process_rss(worker.proc.pid)
+        if self.max_rss_bytes and rss > self.max_rss_bytes:
+            print('Retiring worker {} at {:.0f} MB RSS'.format(worker.proc.pid, rss / 1e6))
+            self._replace(worker, 'rss')
+        elif self.max_jobs and worker.jobs >= self.max_jobs:
+            self._replace(worker, 'jobs')
+        else:
+            self._idle.put(worker)
+
+    def _replace(self, worker, reason):
+        WORKER_RESTARTS.inc(reason=reason)
+        if reason == 'crash':
+            worker.kill()
+        else:
+            worker.stop()
+        # the replacement takes jobs once it has loaded the warmed models
+        threading.Thread(target=self._start_worker, name='worker-start', daemon=True).start()
+
+    def _start_worker(self):
+        worker = _Worker()
+        try:
+            self._warm_up(worker)
+        except WorkerCrashed as e:
+            print('Warming worker {} failed: {}'.format(worker.proc.pid, e))
+            self._replace(worker, 'crash')
+            return
+        self._idle.put(worker)
+
+    def _warm_up(self, worker):
+        """Load the warmed models worker has not loaded yet; a model that fails to load is skipped."""
+        for name, path in list(self._warm.items()):
+            if name in worker.warm:
+                continue
+            try:
+                worker.call({'method': 'preload', 'model': name, 'path': path})
+            except WorkerError as e:
+                print('Warming worker {} with {} failed: {}'.format(worker.proc.pid, name, e))
+                continue
+            worker.warm.add(name)
+
+    def preload(self, name, path):
+        """Load a model in the idle workers now; busy workers load it before
+        their next job and workers started later when they start."""
+        self._warm[name] = path
+        # only the workers idle right now, one at a time, so a preload never
+        # waits for running jobs or holds workers other requests are waiting for
+        for _ in range(self._idle.qsize()):
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker.proc.poll() is not None:
+                self._replace(worker, 'crash')
+                continue
+            try:
+                if name not in worker.warm:
+                    worker.call({'method': 'preload', 'model': name, 'path': path})
+                    worker.warm.add(name)
+            except WorkerCrashed as e:
+                print('Warming worker {} failed: {}'.format(worker.proc.pid, e))
+                self._replace(worker, 'crash')
+                continue
+            except BaseException:
+                self._idle.put(worker)
+                raise
+            self._idle.put(worker)
+
+    def generate(self, model_name, path, prompt=None, snapshots=None, resume=None, **kwargs):
+        """model.generate(output_path=None, ...) in a worker; prompt must be MIDI
+        bytes and the rerank scorer is always used. Like generate(), recorded
+        snapshots are added to the snapshots dict passed in, which keeps at
+        most max_snapshots of them."""
+        arrays, meta = {}, {}
+        if prompt is not None:
+            arrays['prompt'] = np.frombuffer(prompt, dtype=np.uint8)
+        if resume is not None:
+            arrays['resume_words'] = np.asarray(resume['words'], dtype=np.int64)
+            _pack_state(arrays, 'resume_', resume['state'])
+            meta['resume'] = {k: v for k, v in resume.items() if k not in ('words', 'state')}
+        kwargs['output_path'] = None
+        words, info, recorded = self._call('generate', model_name, path, kwargs, arrays, meta,
+                                           snapshots is not None)
+        if snapshots is not None:
+            snapshots.update(recorded)
+            # the worker only bounded the snapshots it recorded; bound the merged dict as generate() does
+            max_snapshots = kwargs.get('max_snapshots')
+            while max_snapshots is not None and len(snapshots) > max_snapshots:
+                del snapshots[min(snapshots)]
+        return words, info
+
+    def resume_job(self, model_name, path, state_path, timeout=None):
+        """model.resume_job(state_path, None, timeout) in a worker."""
+        words, info, _ = self._call('resume_job', model_name, path,
+                                    {'state_path': state_path, 'output_path': None, 'timeout': timeout})
+        return words, info
+
+    def _call(self, method, model_name, path, kwargs, arrays=None, meta=None, snapshots=False):
+        payload = _write_payload(arrays, meta) if arrays else None
+        timeout = kwargs.get('timeout')
+        deadline = time.time() + timeout + self.grace if timeout else None
+        try:
+            reply = self._run({'method': method, 'model': model_name, 'path': path, 'kwargs': kwargs,
+                               'payload': payload, 'snapshots': snapshots}, deadline)
+        finally:
+            # normally consumed by the worker
+            if payload is not None and os.path.exists(payload):
+                os.unlink(payload)
+        out, info = _read_payload(reply['payload'])
+        info['midi'] = out['midi'].tobytes()
+        return out['words'].tolist(), info, _unpack_snapshots(out)
+
+    def status(self):
+        return {'workers': self.n_workers, 'busy': self._busy, 'warm': sorted(self._warm)}
+
+    def close(self):
+        for _ in range(self.n_workers):
+            self._idle.get().stop()
+
+if __name__ == '__main__':
+    worker_main(int(sys.argv[1]))
@@ -618,18 +618,18 @@ const Piano = ({ onMidiSaved, onBack }) => {
       }
 
       const uploadData = await uploadResponse.json();
-      console.log("MIDI uploaded and saved on backend at:", uploadData.path);
+      console.log("MIDI uploaded and stored on backend as:", uploadData.id);
       console.log("Model parameters:", modelParams);
 
-      const sanitizeData = await fetchSanitizeAudio(uploadData.path);
+      const sanitizeData = await fetchSanitizeAudio(uploadData.id);
       console.log(sanitizeData)
-      console.log("Sanitized and saved on backend at:", sanitizeData.path);
+      console.log("Sanitized and stored on backend as:", sanitizeData.id);
 
       // 2. Call the generate endpoint - note that fetchGenerate already returns a blob
       try {
         // This directly returns a blob according to your implementation
         const generatedBlob = await fetchGenerate(
-          sanitizeData.path, 
+          sanitizeData.id, 
           modelParams.temperature, 
           modelParams.nTargetBar, 
           modelParams.topk
@@ -13,12 +13,12 @@ export const fetchHello = async () => {
 };
 
 // 2. POST /sanitize_audio
-export const fetchSanitizeAudio = async (inpath) => {
+export const fetchSanitizeAudio = async (id) => {
   try {
     const res = await fetch(`${apiUrl}/sanitize_audio`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ inpath })
+      body: JSON.stringify({ id })
     });
     const data = await res.json();
     return data;
@@ -29,7 +29,7 @@ export const fetchSanitizeAudio = async (inpath) => {
 
 // 3. POST /generate (with all parameters)
 export const fetchGenerate = async (
-  inpath, 
+  id, 
   temperature = 0.5, 
   nTargetBar = 8, // Changed from n_target_bar to match the parameter name in your component
   topk = 10
@@ -39,7 +39,7 @@ export const fetchGenerate = async (
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({
-        inpath,
+        id,
         temperature: Number(temperature),
         n_target_bar: Number(nTargetBar), // Convert to n_target_bar for backend compatibility
         topk: Number(topk)